@@ -402,10 +402,13 @@ class EvaluateQueries(ast.NodeVisitor):
 
         labels = query_info.labels
 
-        labels_generator = (l for l in labels)
-        bounding_box = self.tractography_spatial_indexing.label_bounding_boxes[labels_generator.next()]
-        for label in labels_generator:
-            bounding_box = bounding_box.union(self.tractography_spatial_indexing.label_bounding_boxes[label])
+        if hasattr(self.tractography_spatial_indexing, 'labels_bounding_box'):
+            bounding_box = self.tractography_spatial_indexing.labels_bounding_box(labels)
+        else:
+            labels_generator = (l for l in labels)
+            bounding_box = self.tractography_spatial_indexing.label_bounding_boxes[labels_generator.next()]
+            for label in labels_generator:
+                bounding_box = bounding_box.union(self.tractography_spatial_indexing.label_bounding_boxes[label])
 
         function_name = node.func.id.lower()
 
@@ -833,17 +836,23 @@ def eval_queries(
     return dict([(key, eq.evaluated_queries_info[key].tracts) for key in eq.queries_to_save])
 
 
-def queries_syntax_check(query_file_body):
-    class DummySpatialIndexing:
+class DummySpatialIndexing:
 
-        def __init__(self):
-            self.crossing_tracts_labels = {}
-            self.crossing_labels_tracts = {}
-            self.ending_tracts_labels = ({}, {})
-            self.ending_labels_tracts = ({}, {})
-            self.label_bounding_boxes = {}
-            self.tract_bounding_boxes = {}
+    r"""
+    Spatial indexing without tracts nor labels, queries evaluated with it
+    are checked without being computed
+    """
 
+    def __init__(self):
+        self.crossing_tracts_labels = {}
+        self.crossing_labels_tracts = {}
+        self.ending_tracts_labels = ({}, {})
+        self.ending_labels_tracts = ({}, {})
+        self.label_bounding_boxes = {}
+        self.tract_bounding_boxes = {}
+
+
+def queries_syntax_check(query_file_body):
     eval_queries(query_file_body, DummySpatialIndexing())
 
 
@@ -1,9 +1,12 @@
 import ast
 import cmd
 import fnmatch
+import sys
+import threading
+import time
 from query_processor import (
     EvaluateQueries, queries_preprocess,
-    TractQuerierSyntaxError, keywords
+    TractQuerierSyntaxError, keywords, DummySpatialIndexing
 )
 
 
@@ -92,6 +95,20 @@ class SaveQueries(ast.NodeVisitor):
 
 class TractQuerierCmd(cmd.Cmd):
 
+    r"""
+    Interactive WMQL shell
+
+    Parameters
+    ----------
+    tractography_spatial_indexing : TractographySpatialIndexing or callable
+        Spatial indexing to query or a function building it. The function
+        is run in a background thread: the shell starts at once, dir,
+        help and syntax errors are answered before the indexing finishes
+        and the commands computing queries wait for it.
+    initial_body : str or list of ast nodes, optional
+        Queries evaluated before the first command
+    """
+
     def __init__(
             self,
             tractography_spatial_indexing,
@@ -103,12 +120,7 @@ class TractQuerierCmd(cmd.Cmd):
         self.prompt = '[wmql] '
         self.include_folders = include_folders
         self.tractography = tractography
-        self.querier = EvaluateQueries(tractography_spatial_indexing)
-
         self.save_query_callback = save_query_callback
-        self.save_query_visitor = SaveQueries(
-            self.save_query_callback, self.querier
-        )
 
         if initial_body is not None:
             if isinstance(initial_body, str):
@@ -116,11 +128,82 @@ class TractQuerierCmd(cmd.Cmd):
                     initial_body,
                     filename='Shell', include_folders=self.include_folders
                 )
-
             if isinstance(initial_body, list):
-                self.querier.visit(ast.Module(initial_body))
-            else:
-                self.querier.visit(initial_body)
+                initial_body = ast.Module(initial_body)
+        self.initial_body = initial_body
+
+        self.indexing_error = None
+        self.indexing_done = threading.Event()
+        if callable(tractography_spatial_indexing):
+            # Query names and syntax errors are available from queries
+            # evaluated without tracts until the indexing is done
+            self._set_querier(DummySpatialIndexing())
+            self.indexing_start = time.time()
+            self.indexing_thread = threading.Thread(
+                target=self._build_querier,
+                args=(tractography_spatial_indexing,)
+            )
+            self.indexing_thread.daemon = True
+            self.indexing_thread.start()
+            self.update_prompt()
+        else:
+            self._set_querier(tractography_spatial_indexing)
+            self.indexing_done.set()
+
+    def _set_querier(self, tractography_spatial_indexing):
+        querier = EvaluateQueries(tractography_spatial_indexing)
+        if self.initial_body is not None:
+            querier.visit(self.initial_body)
+        self.querier = querier
+        self.save_query_visitor = SaveQueries(
+            self.save_query_callback, self.querier
+        )
+
+    def _build_querier(self, build_spatial_indexing):
+        try:
+            self._set_querier(build_spatial_indexing())
+        except Exception, e:
+            self.indexing_error = e
+        finally:
+            self.indexing_done.set()
+
+    def indexing_progress(self):
+        r"""
+        Description of the state of the spatial indexing
+        """
+        if not self.indexing_done.is_set():
+            return 'indexing %ds' % (time.time() - self.indexing_start)
+        elif self.indexing_error is not None:
+            return 'indexing failed: %s' % self.indexing_error
+        else:
+            return 'ready'
+
+    def update_prompt(self):
+        if self.indexing_done.is_set() and self.indexing_error is None:
+            self.prompt = '[wmql] '
+        else:
+            self.prompt = '[wmql %s] ' % self.indexing_progress()
+
+    def wait_for_indexing(self, report_interval=5):
+        r"""
+        Waits until the spatial indexing is done, reporting its progress
+
+        Returns
+        -------
+        ready : bool
+            False if the indexing failed
+        """
+        while not self.indexing_done.wait(report_interval):
+            sys.stdout.write('Waiting for the spatial indexing, %s\n' % self.indexing_progress())
+            sys.stdout.flush()
+        if self.indexing_error is not None:
+            print self.indexing_progress()
+            return False
+        return True
+
+    def postcmd(self, stop, line):
+        self.update_prompt()
+        return stop
 
     @safe_method
     def do_dir(self, patterns):
@@ -146,6 +229,8 @@ class TractQuerierCmd(cmd.Cmd):
                 line,
                 filename='shell', include_folders=self.include_folders
             )
+            if not self.wait_for_indexing():
+                return False
             self.save_query_visitor.visit(ast.Module(body=body))
         except SyntaxError, e:
             print e.value
@@ -167,6 +252,9 @@ class TractQuerierCmd(cmd.Cmd):
             <query name> = <query>: execute a query and save its result
             <query name> |= <query>: execute a query without saving its result
 
+        While the tractography is being indexed the prompt shows the
+        indexing time, expressions and save wait for it to finish.
+
         Exit pressing Ctrl+D
         '''
         return
@@ -186,6 +274,11 @@ class TractQuerierCmd(cmd.Cmd):
                 filename='shell', include_folders=self.include_folders
             )
             body = ast.Module(body=body)
+            if not self.indexing_done.is_set():
+                # Syntax errors are reported without waiting
+                self.querier.visit(body)
+                if not self.wait_for_indexing():
+                    return False
             self.querier.visit(body)
             self.save_query_visitor.visit(body)
         except SyntaxError, e:
@@ -0,0 +1,39 @@
+from ..shell import TractQuerierCmd
+from ..tract_label_indices import TractographySpatialIndexing
+
+import threading
+
+from numpy import diag
+from numpy.random import randint, rand
+
+
+def test_background_indexing():
+    labels = randint(0, 3, (10, 10, 10))
+    tracts = [rand(randint(2, 20), 3) * 18 for i in xrange(20)]
+    release = threading.Event()
+
+    def build_spatial_indexing():
+        release.wait()
+        return TractographySpatialIndexing(
+            tracts, labels, diag([2., 2., 2., 1.]), 0, 10
+        )
+
+    saved = {}
+    shell = TractQuerierCmd(
+        build_spatial_indexing, initial_body='a = 1',
+        save_query_callback=saved.__setitem__
+    )
+    # The shell answers before the indexing is done
+    assert('indexing' in shell.prompt)
+    assert(shell.names() == ['a'])
+    assert(len(shell.querier.evaluated_queries_info['a'].tracts) == 0)
+
+    release.set()
+    assert(shell.wait_for_indexing())
+    shell.postcmd(False, '')
+    assert(shell.prompt == '[wmql] ')
+    index = shell.querier.tractography_spatial_indexing
+    assert(shell.querier.evaluated_queries_info['a'].tracts == index.crossing_labels_tracts.get(1, set()))
+
+    shell.default('b = 2')
+    assert(saved['b'] == index.crossing_labels_tracts.get(2, set()))
@@ -0,0 +1,237 @@
+from ..tract_label_indices import (
+    TractographySpatialIndexing, compute_tract_label_indices
+)
+
+from numpy import diag, sqrt, diff, flatnonzero, r_, isnan
+from numpy.random import randint, rand
+from numpy.testing import assert_array_almost_equal
+
+
+def test_length_threshold():
+    labels = randint(0, 10, (10, 10, 10))
+    affine = diag([2., 2., 2., 1.])
+    tracts = [
+        rand(randint(2, 20), 3) * 18 * (i % 2 + 1) / 2.
+        for i in xrange(50)
+    ]
+    lengths = [sqrt((diff(tract, axis=0) ** 2).sum(1)).sum() for tract in tracts]
+    threshold = sorted(lengths)[25]
+    long_tracts = flatnonzero(lengths >= threshold)
+
+    index = TractographySpatialIndexing(tracts, labels, affine, threshold, 10)
+    assert_array_almost_equal(index.tract_lengths, lengths)
+    assert(sorted(index.crossing_tracts_labels) == long_tracts.tolist())
+    assert(sorted(index.ending_tracts_labels[0]) == long_tracts.tolist())
+    assert(len(index.tract_bounding_boxes) == len(tracts))
+    short_tracts = flatnonzero(lengths < threshold)
+    assert(isnan(index.tract_bounding_boxes['left'][short_tracts]).all())
+    assert(isnan(index.tract_endpoints_pos[short_tracts]).all())
+    assert(not isnan(index.tract_endpoints_pos[long_tracts]).any())
+
+    all_tracts = compute_tract_label_indices(
+        index.affine_ras_2_ijk, labels, tracts, 0, 10
+    )
+    for i in long_tracts:
+        assert(index.crossing_tracts_labels[i] == all_tracts[0][i])
+        assert(index.ending_tracts_labels[0][i] == all_tracts[2][0][i])
+        assert(index.ending_tracts_labels[1][i] == all_tracts[2][1][i])
+    for label, label_tracts in index.crossing_labels_tracts.iteritems():
+        assert(label_tracts == all_tracts[1][label].intersection(long_tracts))
+
+
+def test_compact_labels():
+    from numpy import array, unique
+    from ..tract_label_indices import compact_label_volume
+
+    values = array([0, 17, 1002, 2035, 3001])
+    labels = values[randint(1, 5, (10, 10, 10))].astype(float)
+    labels[:3] = 0
+    codes, label_values = compact_label_volume(labels, slab_size=3)
+    assert(codes.dtype.itemsize == 1)
+    assert((label_values == values).all())
+    assert((label_values[codes] == labels).all())
+    assert((compact_label_volume(labels + 1)[1] == unique(r_[0, values + 1])).all())
+
+    affine = diag([2., 2., 2., 1.])
+    tracts = [rand(randint(2, 20), 3) * 18 for i in xrange(20)]
+    index = TractographySpatialIndexing(tracts, labels, affine, 0, 10)
+    assert((index.image == labels).all())
+    assert(index.image is index.image)
+    index.image = labels
+    assert(index.image is labels)
+    indices = compute_tract_label_indices(
+        index.affine_ras_2_ijk, labels, tracts, 0, 10
+    )
+    assert(index.crossing_tracts_labels == indices[0])
+    assert(index.crossing_labels_tracts == indices[1])
+    assert(index.ending_tracts_labels == indices[2])
+    assert(index.ending_labels_tracts == indices[3])
+    assert(sorted(index.label_bounding_boxes) == values[1:].tolist())
+
+
+def test_label_statistics():
+    from numpy import array, nonzero, dot, c_, ones, cos, sin, allclose, isnan
+    from itertools import product
+
+    labels = randint(0, 4, (12, 10, 8)) * 1000
+    labels[labels == 2000] = 0
+    angle = .3
+    affine = array([
+        [cos(angle), -sin(angle), 0, 5],
+        [sin(angle), cos(angle), 0, -3],
+        [0, 0, 2, 1],
+        [0, 0, 0, 1.]
+    ])
+    tracts = [rand(randint(2, 20), 3) * 10 for i in xrange(5)]
+    index = TractographySpatialIndexing(tracts, labels, affine, 0, 10)
+
+    for code, label in enumerate(index.label_values):
+        ijk = array(nonzero(labels == label)).T
+        if label == 0 or len(ijk) == 0:
+            assert(label == 0 or index.label_voxel_counts[code] == 0)
+            assert(isnan(index.label_bounding_box_array[code]).all())
+            continue
+        assert(index.label_voxel_counts[code] == len(ijk))
+        ras = dot(affine, c_[ijk, ones(len(ijk))].T).T[:, :3]
+        assert(allclose(index.label_centroids[code], ras.mean(0)))
+
+        corners = array([
+            [(ijk[:, axis].min() - .5, ijk[:, axis].max() + .5)[c] for axis, c in enumerate(corner)]
+            for corner in product((0, 1), repeat=3)
+        ])
+        corners = dot(affine, c_[corners, ones(8)].T).T[:, :3]
+        box = r_[corners.min(0), corners.max(0)]
+        assert(allclose(index.label_bounding_box_array[code], box))
+        assert(allclose(index.label_bounding_boxes[label], box))
+
+    box = index.labels_bounding_box([1000, 3000])
+    assert(allclose(box, index.label_bounding_boxes[1000].union(index.label_bounding_boxes[3000])))
+
+
+def test_multi_atlas():
+    from collections import OrderedDict
+    from ..tract_label_indices import multi_atlas_spatial_indexing
+
+    affine = diag([2., 2., 2., 1.])
+    shifted = affine.copy()
+    shifted[:3, 3] = 1
+    atlases = OrderedDict((
+        ('a', (randint(0, 5, (10, 10, 10)), affine)),
+        ('b', (randint(0, 3, (10, 10, 10)) * 1000, affine)),
+        ('c', (randint(0, 5, (12, 12, 12)), shifted)),
+    ))
+    tracts = [rand(randint(2, 20), 3) * 18 for i in xrange(30)]
+    indices = multi_atlas_spatial_indexing(tracts, atlases, 5, 10)
+    assert(indices.keys() == atlases.keys())
+    for name, (labels, atlas_affine) in atlases.iteritems():
+        index = TractographySpatialIndexing(tracts, labels, atlas_affine, 5, 10)
+        assert(indices[name].crossing_tracts_labels == index.crossing_tracts_labels)
+        assert(indices[name].crossing_labels_tracts == index.crossing_labels_tracts)
+        assert(indices[name].ending_tracts_labels == index.ending_tracts_labels)
+        assert(indices[name].label_bounding_boxes.keys() == index.label_bounding_boxes.keys())
+
+
+def test_segment_crossings():
+    from numpy import array, zeros, bincount, allclose, repeat, arange
+    from ..tract_label_indices import compute_segment_labels
+    from ..tractography.packed import pack
+
+    labels = zeros((20, 20, 20), dtype=int)
+    labels[10] = 7
+    affine = diag([1., 1., 1., 1.])
+    # The points of the tract jump over the thin label
+    tracts = [array([[2., 5, 5], [8, 5, 5], [13, 6, 5], [18, 7, 5]])]
+
+    index = TractographySpatialIndexing(tracts, labels, affine, 0, 5)
+    assert(7 not in index.crossing_tracts_labels[0])
+    index = TractographySpatialIndexing(
+        tracts, labels, affine, 0, 5, sampling='segments'
+    )
+    assert(7 in index.crossing_tracts_labels[0])
+    piece_labels, piece_lengths, _ = compute_segment_labels(
+        tracts[0], [0, 4], affine, labels
+    )
+    assert(allclose(
+        piece_lengths[piece_labels == 7].sum(), sqrt(26) / 5
+    ))
+    assert(index.ending_tracts_labels[0][0] == 0)
+
+    tracts = [rand(randint(2, 20), 3) * 19 for i in xrange(20)]
+    points, offsets = pack(tracts)
+    piece_labels, piece_lengths, piece_offsets = compute_segment_labels(
+        points, offsets, affine, labels
+    )
+    lengths = [sqrt((diff(tract, axis=0) ** 2).sum(1)).sum() for tract in tracts]
+    assert(piece_offsets[-1] == len(piece_labels) == len(piece_lengths))
+    piece_tracts = repeat(arange(20), diff(piece_offsets))
+    assert(allclose(bincount(piece_tracts, weights=piece_lengths), lengths))
+
+
+def test_length_occupancy():
+    from numpy import array, zeros, linspace, c_, ones, allclose, bincount, repeat, arange
+    from ..tractography import features
+    from ..tractography.packed import pack
+
+    labels = zeros((20, 20, 20), dtype=int)
+    labels[:10] = 3
+    labels[10:] = 5
+    affine = diag([1., 1., 1., 1.])
+    # Densely sampled in label 3, sparsely in label 5, same length in both
+    x = r_[linspace(1, 9.4, 40), 11, 13, 15, 17.8]
+    tracts = [c_[x, ones(len(x)) * 5, ones(len(x)) * 5]]
+
+    index = TractographySpatialIndexing(tracts, labels, affine, 0, 20)
+    assert(index.crossing_tracts_labels[0] == set((3,)))
+    index = TractographySpatialIndexing(
+        tracts, labels, affine, 0, 20, occupancy='length'
+    )
+    assert(index.crossing_tracts_labels[0] == set((3, 5)))
+    indices = compute_tract_label_indices(
+        affine, labels, tracts, 0, 20, sampling='segments'
+    )
+    assert(indices[0][0] == set((3, 5)))
+
+    tracts = [rand(randint(1, 20), 3) * 19 for i in xrange(20)]
+    points, offsets = pack(tracts)
+    weights = features.point_length_weights(points, offsets)
+    assert(allclose(
+        bincount(repeat(arange(20), diff(offsets)), weights=weights, minlength=20),
+        features.tract_lengths(points, offsets)
+    ))
+
+
+def test_affine_transform_tracts():
+    from numpy import array, dot, c_, ones, allclose
+    from ..tract_label_indices import affine_transform_tracts
+    from ..tractography import Tractography
+
+    affine = array([
+        [0, -1, 0, 10],
+        [1, 0, 0, -5],
+        [0, 0, 2, 3],
+        [0, 0, 0, 1.]
+    ])
+    tracts = [rand(randint(1, 20), 3) for i in xrange(10)]
+    transformed = affine_transform_tracts(affine, Tractography(tracts))
+    assert(len(transformed) == len(tracts))
+    for tract, transformed_tract in zip(tracts, transformed):
+        expected = dot(affine, c_[tract, ones(len(tract))].T).T[:, :3]
+        assert(allclose(transformed_tract, expected))
+    assert(transformed[1].base is transformed[0].base)
+
+
+def test_relative_query_length_threshold():
+    from numpy import zeros, linspace, c_, ones, array
+    from ..query_processor import eval_queries, queries_preprocess
+
+    labels = zeros((10, 10, 10), dtype=int)
+    labels[:, :3] = 1
+    affine = diag([1., 1., 1., 1.])
+    y = linspace(4, 9, 15)
+    tracts = [
+        c_[ones(15) * 5, y, ones(15) * 5],
+        array([[5, 6, 5], [5, 6.5, 5.]]),
+    ]
+    index = TractographySpatialIndexing(tracts, labels, affine, 2, 10)
+    queries = eval_queries(queries_preprocess('b = 1\na = anterior_of(b)'), index)
+    assert(queries['a'] == set((0,)))
@@ -1,9 +1,18 @@
 import warnings
+from collections import OrderedDict
+
 import numpy as np
 
 from .aabb import BoundingBox
+from .tractography import Tractography, TractFeatures, features
+from .tractography.packed import (
+    pack, lengths_to_offsets, split_packed, affine_transform_points
+)
 
-__all__ = ['TractographySpatialIndexing']
+__all__ = [
+    'TractographySpatialIndexing', 'multi_atlas_spatial_indexing',
+    'affine_transform_tracts'
+]
 
 
 class TractographySpatialIndexing:
@@ -15,7 +24,8 @@ class TractographySpatialIndexing:
     Parameters
     ----------
     tractography : :class:`~tract_querier.tractography.Tractography`
-                Tractography object
+                Tractography object or list of tracts, the tract features
+                of a Tractography object are reused
     image : array_like, 3-dimensional
         a piecewise constant 3D image or image of labels
     affine_ijk_2_ras : array_like, :math:`4 \times 4`
@@ -24,13 +34,26 @@ class TractographySpatialIndexing:
         minimum length in mm of a tract to be considered in the indexing
     crossing_threshold : float
         the ratio of a tract that needs to be inside a label to be considered that it crosses it
+    label_values : array of int, optional
+        if given, image holds label codes, as returned by
+        compact_label_volume, and label_values the label of each code
+    point_labels : array of int, optional
+        label code of each point of the tracts, in the order of the
+        tracts, as computed by compute_point_labels
+    sampling : str
+        'points' to find the labels crossed by the tracts from their
+        points, 'segments' to rasterize their segments through the image,
+        see compute_tract_label_indices
+    occupancy : str
+        'points' to measure the ratio of a tract inside a label by its
+        points, 'length' by its length, see compute_tract_label_indices
 
     Attributes
     ----------
     tractography : :class:`~tract_querier.tractography.Tractography`
                 Tractography object
     image : array_like, 3-dimensional
-        a piecewise constant 3D image or image of labels
+        the image of labels, decoded from label_codes on its first access
     affine_ijk_2_ras : array_like, :math:`4 \times 4`
         the affine transform of each IJK coordinate on the image to RAS space
     length_threshold : float
@@ -49,96 +72,451 @@ class TractographySpatialIndexing:
         containing the tracts at which the endpoint in the label is
     tract_endpoints_pos : array_like of :math:`N\times 2 \times 3` where :math:`N` is the number of tracts
         Contains the position of both endpoints of each tract
+    tract_lengths : array of float of length :math:`N`
+        Length of each tract
+    label_codes : array_like, 3-dimensional
+        the image of labels with each label coded by its position in
+        label_values, see compact_label_volume
+    label_values : array of int
+        the labels of the image, sorted
+    label_voxel_counts : array of int
+        the number of voxels of each label of label_values
+    label_centroids : array of :math:`L\times 3`
+        the RAS centroid of the voxels of each label of label_values
+    label_bounding_box_array : array of :math:`L\times 6`
+        the RAS bounding box of each label of label_values, ordered as
+        a BoundingBox, NaN for labels without voxels
+    label_bounding_boxes : dict of BoundingBox
+        the bounding box of each label, indexed by label
+
+    Tracts shorter than length_threshold are left out of the label
+    indices and have NaN bounding boxes and endpoint positions, every
+    tract keeps its position in the tractography as index.
     """
 
-    def __init__(self, tractography, image, affine_ijk_2_ras,  length_threshold, crossing_threshold):
+    def __init__(
+        self, tractography, image, affine_ijk_2_ras, length_threshold,
+        crossing_threshold, label_values=None, point_labels=None,
+        sampling='points', occupancy='points'
+    ):
         self.tractography = tractography
-        self.image = image
+        if label_values is None:
+            self.label_codes, self.label_values = compact_label_volume(image)
+        else:
+            self.label_codes = image
+            self.label_values = np.asarray(label_values)
         self.affine_ijk_2_ras = affine_ijk_2_ras
         self.affine_ras_2_ijk = np.linalg.inv(affine_ijk_2_ras)
         self.length_threshold = length_threshold
         self.crossing_threshold = crossing_threshold
+        self.sampling = sampling
+        self.occupancy = occupancy
+
+        if isinstance(tractography, Tractography):
+            tracts = tractography.tracts()
+            tract_features = tractography.tract_features()
+        else:
+            tracts = tractography
+            tract_features = TractFeatures(tracts)
+        self.tract_lengths = tract_features.lengths
 
         (
             self.crossing_tracts_labels, self.crossing_labels_tracts,
             self.ending_tracts_labels, self.ending_labels_tracts
         ) = compute_tract_label_indices(
-            self.affine_ras_2_ijk, self.image,
-            self.tractography, self.length_threshold, self.crossing_threshold
+            self.affine_ras_2_ijk, self.label_codes,
+            tracts, self.length_threshold, self.crossing_threshold,
+            tract_lengths=self.tract_lengths, label_values=self.label_values,
+            point_labels=point_labels, sampling=sampling,
+            occupancy=occupancy
         )
 
-        self.label_bounding_boxes = compute_label_bounding_boxes(self.image.astype(int), self.affine_ijk_2_ras)
-        self.tract_bounding_boxes = compute_tract_bounding_boxes(self.tractography)
-
-        self.tract_endpoints_pos = np.empty((len(self.tractography), 2, 3))
-
-        for i, t in enumerate(self.tractography):
-            self.tract_endpoints_pos[i, 0] = t[0]
-            self.tract_endpoints_pos[i, 1] = t[-1]
-
-
-def compute_label_bounding_boxes(image, affine_ijk_2_ras):
-    linear_component = affine_ijk_2_ras[:3, :3]
-    translation = affine_ijk_2_ras[:-1, -1]
-    label_bounding_boxes = {}
-    image = image.astype(int)
-    try:
-        from scipy import ndimage
-        labels = ndimage.find_objects(image)
-        for i, label in enumerate(labels):
-            if label is not None:
-                ras_bounding_box = np.dot(
-                    linear_component,
-                    np.array([(s.start, s.stop) for s in label])
-                ).T + translation
-
-                label_bounding_boxes[i + 1] = BoundingBox(
-                    ras_bounding_box
-                )
-
-    except ImportError:
-        labels = np.unique(image)
-        for i, label in enumerate(np.sort(labels)):
-            if label == 0:
-                continue
-
-            coords = np.where(image == label)
-            ras_coords = (
-                (
-                    np.dot(linear_component, coords).T +
-                    translation
-                )
+        (
+            self.label_voxel_counts, self.label_centroids,
+            self.label_bounding_box_array
+        ) = compute_label_statistics(
+            self.label_codes, self.affine_ijk_2_ras, len(self.label_values)
+        )
+        self.label_bounding_boxes = _label_bounding_box_dict(
+            self.label_values, self.label_voxel_counts,
+            self.label_bounding_box_array
+        )
+        # The tracts left out by the length threshold get NaN boxes and
+        # endpoints, which no relative query selects
+        long_tracts = np.ones(len(tract_features), dtype=bool)
+        if length_threshold > 0:
+            long_tracts = np.asarray(self.tract_lengths) >= length_threshold
+        self.tract_bounding_boxes = compute_tract_bounding_boxes(
+            tracts, tract_features=tract_features, tract_mask=long_tracts
+        )
+        self.tract_endpoints_pos = tract_features.endpoints.copy()
+        self.tract_endpoints_pos[~long_tracts] = np.nan
+
+    def __getattr__(self, name):
+        # The image of labels is decoded from label_codes on its first
+        # access and then kept as a plain attribute, which can be set
+        if name == 'image':
+            self.image = self.label_values[self.label_codes]
+            return self.image
+        raise AttributeError(name)
+
+    def labels_bounding_box(self, labels):
+        r"""
+        Bounding box of the union of labels
+
+        Parameters
+        ----------
+        labels : iterable of int
+
+        Returns
+        -------
+        bounding_box : BoundingBox
+        """
+        labels = np.asarray(list(labels), dtype=int)
+        if len(labels) == 0:
+            raise ValueError('The bounding box of no labels is undefined')
+        codes = np.searchsorted(self.label_values, labels).clip(
+            0, len(self.label_values) - 1
+        )
+        missing = (
+            (self.label_values[codes] != labels) |
+            (self.label_voxel_counts[codes] == 0)
+        )
+        if missing.any():
+            raise KeyError(
+                'Labels without voxels in the image: %s' %
+                labels[missing].tolist()
             )
+        boxes = self.label_bounding_box_array[codes]
+        return BoundingBox(np.r_[boxes[:, :3].min(0), boxes[:, 3:].max(0)])
 
-            label_bounding_boxes[label] = BoundingBox(ras_coords)
 
-    return label_bounding_boxes
+MAX_LABEL_TABLE_SIZE = 1 << 24
 
 
-def compute_tract_bounding_boxes(tracts, affine_transform=None):
-    bounding_boxes = np.empty((len(tracts), 6), dtype=float)
+def compact_label_volume(image, slab_size=16):
+    r'''
+    Image of labels with each label coded by a consecutive integer, in
+    the smallest integer type holding every code. The image is read by
+    slabs, so an image memory mapped from disk is never fully loaded
+    or converted.
 
-    if affine_transform is not None:
-        linear_component = affine_transform[:3, :3]
-        translation = affine_transform[:-1, -1]
-
-    for i, tract in enumerate(tracts):
-        if affine_transform is not None:
-            ras_coords = (
-                np.dot(linear_component, tract.T).T +
-                translation
+    Parameters
+    ----------
+    image : array_like, 3-dimensional
+        a piecewise constant 3D image or image of labels
+    slab_size : int
+        Number of slices of the image converted at a time
+
+    Returns
+    -------
+    label_codes : array of uint8, uint16 or int32 with the shape of image
+        Position in label_values of the label of each voxel
+    label_values : array of int
+        The labels of the image, sorted, label_values[0] is 0 so the
+        code 0 is the background
+    '''
+    image = np.asanyarray(image)
+    slabs = [
+        slice(start, start + slab_size)
+        for start in xrange(0, len(image), slab_size)
+    ]
+
+    # Labels are counted in a table indexed by label while they are
+    # small non negative integers, as atlases labels usually are
+    present = np.zeros(1, dtype=bool)
+    values = set((0,))
+    for slab in slabs:
+        labels = image[slab].astype(int).ravel()
+        if len(labels) == 0:
+            continue
+        if (
+            present is not None and labels.min() >= 0 and
+            labels.max() < MAX_LABEL_TABLE_SIZE
+        ):
+            counts = np.bincount(labels, minlength=len(present))
+            present = np.r_[present, np.zeros(
+                len(counts) - len(present), dtype=bool
+            )]
+            present |= counts > 0
+        else:
+            if present is not None:
+                values.update(np.flatnonzero(present).tolist())
+                present = None
+            values.update(np.unique(labels).tolist())
+    if present is not None:
+        values.update(np.flatnonzero(present).tolist())
+    label_values = np.array(sorted(values), dtype=int)
+
+    if len(label_values) <= 1 << 8:
+        dtype = np.uint8
+    elif len(label_values) <= 1 << 16:
+        dtype = np.uint16
+    else:
+        dtype = np.int32
+    label_codes = np.empty(image.shape, dtype=dtype)
+    if present is not None:
+        label_table = np.zeros(label_values[-1] + 1, dtype=dtype)
+        label_table[label_values] = np.arange(len(label_values))
+    for slab in slabs:
+        if present is not None:
+            label_codes[slab] = label_table[image[slab].astype(int)]
+        else:
+            label_codes[slab] = np.searchsorted(
+                label_values, image[slab].astype(int)
             )
+    return label_codes, label_values
+
+
+def multi_atlas_spatial_indexing(
+    tractography, atlases, length_threshold, crossing_threshold,
+    sampling='points', occupancy='points'
+):
+    r'''
+    Spatial indexing of a tractography with several atlases in a single
+    pass over the tract points, which are transformed once per distinct
+    affine transform of the atlases
+
+    Parameters
+    ----------
+    tractography : :class:`~tract_querier.tractography.Tractography`
+        Tractography object or list of tracts
+    atlases : OrderedDict of <atlas name>=(image, affine_ijk_2_ras)
+        the image of labels of each atlas and its affine transform
+    length_threshold : float
+        minimum length in mm of a tract to be considered in the indexing
+    crossing_threshold : float
+        the ratio of a tract that needs to be inside a label to be considered that it crosses it
+    sampling : str
+        'points' or 'segments', see TractographySpatialIndexing
+    occupancy : str
+        'points' or 'length', see TractographySpatialIndexing
+
+    Returns
+    -------
+    indices : OrderedDict of <atlas name>=TractographySpatialIndexing
+    '''
+    if isinstance(tractography, Tractography):
+        tracts = tractography.tracts()
+    else:
+        tracts = tractography
+    points, _ = pack(tracts)
+
+    names = list(atlases)
+    affines = [np.asarray(atlases[name][1], dtype=float) for name in names]
+    compact_atlases = [compact_label_volume(atlases[name][0]) for name in names]
+    point_labels = compute_point_labels(points, [
+        (label_codes, np.linalg.inv(affine))
+        for (label_codes, _), affine in zip(compact_atlases, affines)
+    ])
+
+    return OrderedDict(
+        (name, TractographySpatialIndexing(
+            tractography, label_codes, affine, length_threshold,
+            crossing_threshold, label_values=label_values,
+            point_labels=atlas_point_labels, sampling=sampling,
+            occupancy=occupancy
+        ))
+        for name, (label_codes, label_values), affine, atlas_point_labels
+        in zip(names, compact_atlases, affines, point_labels)
+    )
+
+
+def compute_point_labels(points, atlases, chunk_size=1 << 20):
+    r'''
+    Label of the voxel nearest to each point in several images. The
+    points are processed in chunks, each chunk is transformed once per
+    distinct affine transform and looked up in all the images.
+
+    Parameters
+    ----------
+    points : array of :math:`N \times 3`
+        RAS points
+    atlases : list of (image, affine_ras_2_ijk)
+    chunk_size : int
+        number of points processed at a time
+
+    Returns
+    -------
+    point_labels : list of array of length :math:`N`
+        the labels of the points in each image
+    '''
+    transforms = []
+    for position, (image, affine_ras_2_ijk) in enumerate(atlases):
+        for affine, positions in transforms:
+            if np.array_equal(affine, affine_ras_2_ijk):
+                positions.append(position)
+                break
         else:
-            ras_coords = tract
-
-        if len(ras_coords) < 2:
-            raise ValueError(
-                'Tracts in the tractography must have at least 2 points'
-                ' tract #%d has less than two points.'
-                ' You can use the tract_math tool to prune short tracts'
-                ' and solve this problem.' % i
+            transforms.append((np.asarray(affine_ras_2_ijk), [position]))
+
+    point_labels = [
+        np.empty(len(points), dtype=image.dtype) for image, _ in atlases
+    ]
+    outside = False
+    for start in xrange(0, len(points), chunk_size):
+        chunk = points[start: start + chunk_size]
+        for affine, positions in transforms:
+            ijk = np.round(affine_transform_points(affine, chunk)).astype(int)
+            for position in positions:
+                image = atlases[position][0]
+                shape = np.array(image.shape[:3])
+                if ((ijk < 0) | (ijk >= shape)).any():
+                    outside = True
+                    voxels = ijk.clip(0, shape - 1)
+                else:
+                    voxels = ijk
+                point_labels[position][start: start + len(chunk)] = (
+                    image[tuple(voxels.T)]
+                )
+
+    if outside:
+        warnings.warn("Warning tract points fall outside the image")
+    return point_labels
+
+
+def compute_label_statistics(
+    label_codes, affine_ijk_2_ras, number_of_labels=None, slab_size=16
+):
+    r'''
+    Voxel count, centroid and bounding box of each label, computed in a
+    single pass over the labelled voxels of an image of label codes
+
+    The bounding box of a label holds the 8 corners of the box of its
+    voxels in IJK space, the voxels extending half a voxel around their
+    centers, transformed to RAS space, so it is right for oblique
+    affine transforms too.
+
+    Parameters
+    ----------
+    label_codes : array of int, 3-dimensional
+        image of labels coded by consecutive integers, as returned by
+        compact_label_volume, 0 is the background
+    affine_ijk_2_ras : array_like, :math:`4 \times 4`
+        the affine transform of each IJK coordinate on the image to RAS space
+    number_of_labels : int, optional
+        number of label codes, including the background
+    slab_size : int
+        number of slices of the image processed at a time
+
+    Returns
+    -------
+    voxel_counts : array of int of length L
+    centroids : array of :math:`L \times 3`
+        RAS centroids, NaN for labels without voxels
+    bounding_boxes : array of :math:`L \times 6`
+        RAS bounding boxes ordered as a BoundingBox, NaN for labels
+        without voxels
+    '''
+    label_codes = np.asanyarray(label_codes)
+    if number_of_labels is None:
+        number_of_labels = int(label_codes.max()) + 1
+    shape = label_codes.shape
+
+    voxel_counts = np.zeros(number_of_labels, dtype=int)
+    coordinate_sums = np.zeros((3, number_of_labels))
+    # occupied[axis][label, coordinate] tells whether the label has
+    # voxels at that coordinate along the axis
+    occupied = [
+        np.zeros(number_of_labels * size, dtype=bool) for size in shape
+    ]
+    for start in xrange(0, shape[0], slab_size):
+        slab = np.asarray(label_codes[start: start + slab_size])
+        ijk = list(np.nonzero(slab))
+        codes = slab[tuple(ijk)].astype(int)
+        ijk[0] += start
+        voxel_counts += np.bincount(codes, minlength=number_of_labels)
+        for axis, size in enumerate(shape):
+            coordinate_sums[axis] += np.bincount(
+                codes, weights=ijk[axis], minlength=number_of_labels
             )
-        bounding_boxes[i] = BoundingBox(ras_coords)
+            occupied[axis] |= np.bincount(
+                codes * size + ijk[axis], minlength=number_of_labels * size
+            ) > 0
+
+    labelled = voxel_counts > 0
+    ijk_min = np.empty((number_of_labels, 3))
+    ijk_max = np.empty((number_of_labels, 3))
+    for axis, size in enumerate(shape):
+        axis_occupied = occupied[axis].reshape(number_of_labels, size)
+        ijk_min[:, axis] = axis_occupied.argmax(1)
+        ijk_max[:, axis] = size - 1 - axis_occupied[:, ::-1].argmax(1)
+
+    corners = np.empty((number_of_labels, 8, 3))
+    for corner in xrange(8):
+        for axis in xrange(3):
+            if corner & (1 << axis):
+                corners[:, corner, axis] = ijk_max[:, axis] + .5
+            else:
+                corners[:, corner, axis] = ijk_min[:, axis] - .5
+    corners = affine_transform_points(
+        affine_ijk_2_ras, corners.reshape(-1, 3)
+    ).reshape(number_of_labels, 8, 3)
+    bounding_boxes = np.hstack((corners.min(1), corners.max(1)))
+    bounding_boxes[~labelled] = np.nan
+
+    centroids = np.full((number_of_labels, 3), np.nan)
+    centroids[labelled] = affine_transform_points(
+        affine_ijk_2_ras,
+        coordinate_sums.T[labelled] / voxel_counts[labelled, None]
+    )
+    return voxel_counts, centroids, bounding_boxes
+
+
+def _label_bounding_box_dict(label_values, voxel_counts, bounding_boxes):
+    return dict(
+        (int(label_values[code]), BoundingBox(bounding_boxes[code]))
+        for code in np.flatnonzero(voxel_counts).tolist()
+        if code > 0
+    )
+
+
+def compute_label_bounding_boxes(image, affine_ijk_2_ras, label_values=None):
+    r'''
+    Bounding box in RAS space of each label of an image, the labels are
+    the values of the image, or label_values[image] if label_values
+    is given, see compute_label_statistics
+    '''
+    if label_values is None:
+        image, label_values = compact_label_volume(image)
+    voxel_counts, _, bounding_boxes = compute_label_statistics(
+        image, affine_ijk_2_ras, len(label_values)
+    )
+    return _label_bounding_box_dict(label_values, voxel_counts, bounding_boxes)
+
+
+def compute_tract_bounding_boxes(
+    tracts, affine_transform=None, tract_features=None, tract_mask=None
+):
+    r'''
+    Bounding box of each tract as a record array with the fields of a
+    BoundingBox
+
+    The tracts outside of tract_mask, a boolean array with one element
+    per tract, get NaN boxes and are not required to have two points.
+    '''
+    if affine_transform is not None:
+        points, offsets = pack(tracts)
+        bounding_boxes = features.tract_bounding_boxes(
+            affine_transform_points(affine_transform, points), offsets
+        )
+        point_counts = features.tract_point_counts(offsets)
+    else:
+        if tract_features is None:
+            tract_features = TractFeatures(tracts)
+        bounding_boxes = tract_features.bounding_boxes
+        point_counts = tract_features.point_counts
+
+    if tract_mask is None:
+        tract_mask = np.ones(len(point_counts), dtype=bool)
+    short_tracts = np.flatnonzero((point_counts < 2) & tract_mask)
+    if len(short_tracts) > 0:
+        raise ValueError(
+            'Tracts in the tractography must have at least 2 points'
+            ' tract #%d has less than two points.'
+            ' You can use the tract_math tool to prune short tracts'
+            ' and solve this problem.' % short_tracts[0]
+        )
 
     box_array = np.empty(
         len(tracts),
@@ -146,22 +524,38 @@ def compute_tract_bounding_boxes(tracts, affine_transform=None):
             'left', 'posterior', 'inferior',
             'right', 'anterior', 'superior'
         )])
-    bounding_boxes = bounding_boxes.T
+    bounding_boxes = np.where(tract_mask[:, None], bounding_boxes, np.nan).T
     for i, name in enumerate(box_array.dtype.names):
         box_array[name] = bounding_boxes[i]
 
     return box_array
 
 
-def compute_label_crossings(tract_cumulative_lengths, point_labels, threshold):
+def _tract_ids(tract_cumulative_lengths, tract_ids):
+    if tract_ids is None:
+        return range(len(tract_cumulative_lengths) - 1)
+    return list(tract_ids)
+
+
+def compute_label_crossings(
+    tract_cumulative_lengths, point_labels, threshold, tract_ids=None,
+    label_values=None, weights=None
+):
     tracts_labels = {}
+    tract_ids = _tract_ids(tract_cumulative_lengths, tract_ids)
     for i in xrange(len(tract_cumulative_lengths) - 1):
         start = tract_cumulative_lengths[i]
         end = tract_cumulative_lengths[i + 1]
         label_crossings = np.asanyarray(point_labels[start:end], dtype=int)
-        bincount = np.bincount(label_crossings)
+        if weights is not None and weights[start:end].sum() > 0:
+            bincount = np.bincount(label_crossings, weights=weights[start:end])
+        else:
+            bincount = np.bincount(label_crossings)
         percentages = bincount * 1. / bincount.sum()
-        tracts_labels[i] = set(np.where(percentages >= (threshold / 100.))[0])
+        labels = np.where(percentages >= (threshold / 100.))[0]
+        if label_values is not None:
+            labels = label_values[labels]
+        tracts_labels[tract_ids[i]] = set(labels.tolist())
 
     labels_tracts = {}
     for i, f in tracts_labels.items():
@@ -173,12 +567,13 @@ def compute_label_crossings(tract_cumulative_lengths, point_labels, threshold):
     return tracts_labels, labels_tracts
 
 
-def compute_label_endings(tract_cumulative_lengths, point_labels):
+def compute_label_endings(tract_cumulative_lengths, point_labels, tract_ids=None):
     tracts_labels = {}
+    tract_ids = _tract_ids(tract_cumulative_lengths, tract_ids)
     for i in xrange(len(tract_cumulative_lengths) - 1):
         start = tract_cumulative_lengths[i]
         end = tract_cumulative_lengths[i + 1]
-        tracts_labels[i] = set((int(point_labels[
+        tracts_labels[tract_ids[i]] = set((int(point_labels[
                                start]), int(point_labels[end - 1])))
 
     labels_tracts = {}
@@ -191,14 +586,19 @@ def compute_label_endings(tract_cumulative_lengths, point_labels):
     return tracts_labels, labels_tracts
 
 
-def compute_label_endings_start_end(tract_cumulative_lengths, point_labels):
+def compute_label_endings_start_end(
+    tract_cumulative_lengths, point_labels, tract_ids=None, label_values=None
+):
     tracts_labels_start = {}
     tracts_labels_end = {}
+    tract_ids = _tract_ids(tract_cumulative_lengths, tract_ids)
+    if label_values is not None:
+        point_labels = label_values[point_labels]
     for i in xrange(len(tract_cumulative_lengths) - 1):
         start = tract_cumulative_lengths[i]
         end = tract_cumulative_lengths[i + 1]
-        tracts_labels_start[i] = int(point_labels[start])
-        tracts_labels_end[i] = int(point_labels[end - 1])
+        tracts_labels_start[tract_ids[i]] = int(point_labels[start])
+        tracts_labels_end[tract_ids[i]] = int(point_labels[end - 1])
 
     labels_tracts_start = {}
     labels_tracts_end = {}
@@ -215,41 +615,246 @@ def compute_label_endings_start_end(tract_cumulative_lengths, point_labels):
     return (tracts_labels_start, tracts_labels_end), (labels_tracts_start, labels_tracts_end)
 
 
+def affine_transform_tracts(affine, tracts):
+    r'''
+    Applies an affine transform to tracts, all their points are
+    transformed at once
+
+    Parameters
+    ----------
+    affine : array_like, :math:`4 \times 4`
+    tracts : :class:`~tract_querier.tractography.Tractography`
+        Tractography object or list of tracts
+
+    Returns
+    -------
+    transformed_tracts : list of array :math:`N_i \times 3`
+        views on a single array of transformed points, which are
+        packed again without a copy
+    '''
+    if isinstance(tracts, Tractography):
+        tracts = tracts.tracts()
+    points, offsets = pack(tracts)
+    return split_packed(affine_transform_points(affine, points), offsets)
+
+
+def compute_segment_labels(
+    points, offsets, affine_ras_2_ijk, img, chunk_size=1 << 18
+):
+    r'''
+    Rasterizes the segments of the tracts through the voxel grid of an
+    image. Each segment is cut where it crosses the faces of the voxels,
+    as a 3D DDA does, and each piece is labelled with the voxel holding
+    it, so thin labels between two distant points are not skipped.
+
+    All the crossings of a chunk of segments with the voxel faces are
+    computed at once and sorted along their segment.
+
+    Parameters
+    ----------
+    points : array of :math:`N \times 3`
+        RAS points of the tracts, packed
+    offsets : array of int of length T + 1
+        offsets of the tracts in points
+    affine_ras_2_ijk : array_like, :math:`4 \times 4`
+    img : array_like, 3-dimensional
+    chunk_size : int
+        number of segments processed at a time
+
+    Returns
+    -------
+    piece_labels : array
+        label of each piece of segment, in the order of the tracts
+    piece_lengths : array of float
+        RAS length of each piece of segment
+    piece_offsets : array of int of length T + 1
+        offsets of the pieces of each tract
+    '''
+    offsets = np.asarray(offsets, dtype=int)
+    number_of_tracts = len(offsets) - 1
+    segments = np.ones(max(len(points) - 1, 0), dtype=bool)
+    tract_ends = offsets[1:] - 1
+    segments[tract_ends[(tract_ends >= 0) & (tract_ends < len(segments))]] = False
+    segment_starts = np.flatnonzero(segments)
+    segment_tracts = np.repeat(
+        np.arange(number_of_tracts), np.diff(offsets)
+    )[segment_starts]
+
+    ijk = affine_transform_points(affine_ras_2_ijk, points)
+    shape = np.array(img.shape[:3])
+    outside = False
+    piece_labels = []
+    piece_lengths = []
+    piece_tracts = []
+    for chunk_start in xrange(0, len(segment_starts), chunk_size):
+        starts = segment_starts[chunk_start: chunk_start + chunk_size]
+        first = ijk[starts].astype(float)
+        step = ijk[starts + 1] - first
+        segment_lengths = np.sqrt(
+            ((points[starts + 1] - points[starts]).astype(float) ** 2).sum(1)
+        )
+        first_voxel = np.round(first)
+        last_voxel = np.round(first + step)
+
+        # Parameter along its segment of each crossing of a voxel face,
+        # the ends of the segments included
+        crossing_segments = [np.arange(len(starts))] * 2
+        crossing_parameters = [np.zeros(len(starts)), np.ones(len(starts))]
+        for axis in xrange(3):
+            crossings = np.abs(last_voxel[:, axis] - first_voxel[:, axis]).astype(int)
+            crossing_segment = np.repeat(np.arange(len(starts)), crossings)
+            face = (
+                np.arange(crossings.sum()) -
+                np.repeat(lengths_to_offsets(crossings)[:-1], crossings)
+            ) + .5 + np.minimum(
+                first_voxel[:, axis], last_voxel[:, axis]
+            )[crossing_segment]
+            crossing_segments.append(crossing_segment)
+            crossing_parameters.append(
+                (face - first[crossing_segment, axis]) /
+                step[crossing_segment, axis]
+            )
+        crossing_segments = np.concatenate(crossing_segments)
+        crossing_parameters = np.concatenate(crossing_parameters).clip(0, 1)
+        order = np.lexsort((crossing_parameters, crossing_segments))
+        crossing_segments = crossing_segments[order]
+        crossing_parameters = crossing_parameters[order]
+
+        # Pieces between consecutive crossings of the same segment
+        same_segment = crossing_segments[1:] == crossing_segments[:-1]
+        piece_segments = crossing_segments[:-1][same_segment]
+        piece_starts = crossing_parameters[:-1][same_segment]
+        piece_ends = crossing_parameters[1:][same_segment]
+        middles = (
+            first[piece_segments] +
+            step[piece_segments] * ((piece_starts + piece_ends) / 2)[:, None]
+        )
+        voxels = np.round(middles).astype(int)
+        if ((voxels < 0) | (voxels >= shape)).any():
+            outside = True
+            voxels = voxels.clip(0, shape - 1)
+
+        piece_labels.append(img[tuple(voxels.T)])
+        piece_lengths.append(
+            (piece_ends - piece_starts) * segment_lengths[piece_segments]
+        )
+        piece_tracts.append(segment_tracts[chunk_start + piece_segments])
+
+    if outside:
+        warnings.warn("Warning tract points fall outside the image")
+
+    if len(piece_labels) == 0:
+        return (
+            np.empty(0, dtype=img.dtype), np.empty(0),
+            np.zeros(number_of_tracts + 1, dtype=int)
+        )
+    piece_offsets = lengths_to_offsets(np.bincount(
+        np.concatenate(piece_tracts), minlength=number_of_tracts
+    ))
+    return (
+        np.concatenate(piece_labels), np.concatenate(piece_lengths),
+        piece_offsets
+    )
+
+
 def compute_tract_label_indices(
     affine_ras_2_ijk, img,
-    tracts, length_threshold, crossing_threshold
+    tracts, length_threshold, crossing_threshold, tract_lengths=None,
+    label_values=None, point_labels=None, sampling='points',
+    occupancy='points'
 ):
+    r'''
+    Labels crossed by each tract and labels at the endpoints of
+    each tract
+
+    The points are transformed to IJK space in their own floating point
+    type. With float32 points the labels are the ones obtained with
+    float64 points except for points closer than about 1e-4 voxels to
+    the boundary between two voxels.
+
+    Tracts shorter than length_threshold are left out, the others are
+    indexed by their position in tracts. tract_lengths, the length of
+    each tract, is computed from the tracts if it is not given.
+
+    If label_values is given, img holds the codes of the labels, as
+    returned by compact_label_volume, and the per tract label counts
+    are sized by the number of labels instead of the largest label.
+    point_labels, the label of each point of the tracts in img, is
+    computed with compute_point_labels if it is not given.
+
+    With sampling='points' the labels crossed by a tract are the labels
+    of its points, with sampling='segments' the labels in which its
+    segments run, weighted by the length of the segments in each label,
+    see compute_segment_labels. The labels of the endpoints are the
+    labels of the first and last points in both cases.
+
+    With occupancy='points' the ratio of a tract inside a label is the
+    ratio of its points in the label, which depends on the step size of
+    the tractography. With occupancy='length' each point is weighted by
+    the length of tract it represents, see
+    features.point_length_weights, and the ratio is a ratio of the tract
+    length. Segments are always weighted by their length.
+    '''
+    if sampling not in ('points', 'segments'):
+        raise ValueError('Label sampling %s not supported' % sampling)
+    if occupancy not in ('points', 'length'):
+        raise ValueError('Label occupancy %s not supported' % occupancy)
+
+    all_points, tract_cumulative_lengths = pack(tracts)
+    tract_ids = None
     if length_threshold > 0:
-        tract_length = lambda tract: ((((tract[
-                                      1:] - tract[:-1]) ** 2).sum(1)) ** .5).sum()
-        tracts = [f for f in tracts if tract_length(f) >= length_threshold]
-
-    all_points = np.vstack(tracts)
-    all_points_ijk = (np.dot(affine_ras_2_ijk[:-1, :-1], all_points.T).T +
-                      affine_ras_2_ijk[:-1, -1])
-    all_points_ijk_rounded = np.round(all_points_ijk).astype(int)
-
-    if (
-        any(((all_points_ijk_rounded[:, i] >= img.shape[i]).any() for i in xrange(3))) or
-        (all_points_ijk_rounded < 0).any()
-    ):
-        warnings.warn("Warning tract points fall outside the image")
+        if tract_lengths is None:
+            tract_lengths = features.tract_lengths(
+                all_points, tract_cumulative_lengths
+            )
+        long_tracts = np.asarray(tract_lengths) >= length_threshold
+        tract_ids = np.flatnonzero(long_tracts).tolist()
+        points_per_tract = np.diff(tract_cumulative_lengths)
+        long_points = np.repeat(long_tracts, points_per_tract)
+        all_points = all_points[long_points]
+        if point_labels is not None:
+            point_labels = point_labels[long_points]
+        tract_cumulative_lengths = lengths_to_offsets(
+            points_per_tract[long_tracts]
+        )
 
-    for i in xrange(3):
-        all_points_ijk_rounded[:, i] = all_points_ijk_rounded[
-            :,
-            i
-        ].clip(0, img.shape[i] - 1)
+    if sampling == 'segments':
+        piece_labels, piece_lengths, piece_offsets = compute_segment_labels(
+            all_points, tract_cumulative_lengths, affine_ras_2_ijk, img
+        )
+        piece_label_values = label_values
+        if piece_label_values is None:
+            piece_label_values, piece_labels = np.unique(
+                piece_labels.astype(int), return_inverse=True
+            )
 
-    point_labels = img[tuple(all_points_ijk_rounded.T)]
-    tract_cumulative_lengths = np.cumsum([0] + [len(f) for f in tracts])
+    if point_labels is None:
+        point_labels = compute_point_labels(
+            all_points, [(img, affine_ras_2_ijk)]
+        )[0]
+    if label_values is None:
+        label_values, point_labels = np.unique(
+            point_labels.astype(int), return_inverse=True
+        )
 
-    crossing_tracts_labels, crossing_labels_tracts = compute_label_crossings(
-        tract_cumulative_lengths, point_labels, crossing_threshold
-    )
+    if sampling == 'segments':
+        crossing_tracts_labels, crossing_labels_tracts = compute_label_crossings(
+            piece_offsets, piece_labels, crossing_threshold, tract_ids,
+            piece_label_values, weights=piece_lengths
+        )
+    else:
+        weights = None
+        if occupancy == 'length':
+            weights = features.point_length_weights(
+                all_points, tract_cumulative_lengths
+            )
+        crossing_tracts_labels, crossing_labels_tracts = compute_label_crossings(
+            tract_cumulative_lengths, point_labels, crossing_threshold, tract_ids,
+            label_values, weights=weights
+        )
 
     ending_tracts_labels, ending_labels_tracts = compute_label_endings_start_end(
-        tract_cumulative_lengths, point_labels
+        tract_cumulative_lengths, point_labels, tract_ids, label_values
     )
 
     return (
@@ -12,6 +12,7 @@ import nibabel
 from nibabel.spatialimages import SpatialImage
 
 from ..tractography import Tractography, tractography_to_file, tractography_from_files
+from ..tract_label_indices import affine_transform_points
 
 
 @tract_math_operation(': counts the number of tracts', needs_one_tract=False)
@@ -38,10 +39,7 @@ def scalars(tractography):
 
 @tract_math_operation(': calculates mean and std of tract length')
 def length_mean_std(tractography):
-    lengths = numpy.empty(len(tractography.tracts()))
-
-    for i, tract in enumerate(tractography.tracts()):
-        lengths[i] = tract_length(tract)
+    lengths = tractography.tract_features().lengths
 
     mean = lengths.mean()
     std = lengths.std()
@@ -235,13 +233,8 @@ def tract_dump_endpoints(tractography):
 
 @tract_math_operation(': Minimum and maximum distance between two consecutive points')
 def tract_point_distance_min_max(tractography):
-    dist_min = numpy.empty(len(tractography.tracts()))
-    dist_max = numpy.empty(len(tractography.tracts()))
-    for i, tract in enumerate(tractography.tracts()):
-        dist = tract_length(tract)
-        dist_min[i] = dist.min()
-        dist_max[i] = dist.max()
-    print dist_min.min(), dist_max.max()
+    step_ranges = tractography.tract_features().step_ranges
+    print numpy.nanmin(step_ranges[:, 0]), numpy.nanmax(step_ranges[:, 1])
 
 
 @tract_math_operation('<points per tract> <tractography_file_output>: subsamples tracts to a maximum number of points')
@@ -262,10 +255,9 @@ def tract_remove_short_tracts(tractography, min_tract_length, file_output):
     tracts = tractography.tracts()
     data = tractography.tracts_data()
 
-    tract_ix_to_keep = [
-        i for i, tract in enumerate(tractography.tracts())
-        if tract_length(tract) > min_tract_length
-    ]
+    tract_ix_to_keep = numpy.flatnonzero(
+        tractography.tract_features().lengths > min_tract_length
+    ).tolist()
 
     selected_tracts = [tracts[i] for i in tract_ix_to_keep]
 
@@ -330,34 +322,32 @@ def tract_map_image(tractography, image, quantity_name, file_output):
 def tract_deform(tractography, image, file_output=None):
     from scipy import ndimage
     import numpy as np
+    from ..tractography.packed import pack, split_packed
 
     image = nibabel.load(image)
     coord_adjustment = np.sign(np.diag(image.get_affine())[:-1])
-    ijk_points = tract_in_ijk(image, tractography)
+    ras_2_ijk = np.linalg.inv(image.get_affine())
     image_data = image.get_data().squeeze()
 
     if image_data.ndim != 4 and image_data.shape[-1] != 3:
         raise ValueError('Image is not a deformation field')
 
-    new_points = np.vstack(tractography.tracts())  # ijk_points.copy()
-    for i in (0, 1, 2):
-        image_ = image_data[..., i]
-        deformation = ndimage.map_coordinates(
-            image_, ijk_points.T
-        ).squeeze()
-        new_points[:, i] -= coord_adjustment[i] * deformation
-
-    new_ras_points = new_points  # tract_in_ras(image, new_points)
-    start = 0
-    new_tracts = []
-    for tract in tractography.original_tracts():
-        new_tracts.append(
-            new_ras_points[start: start + len(tract)].copy()
-        )
-        start += len(tract)
+    # The deformation is applied to chunks of points written to a
+    # single array of deformed points
+    chunk_size = 1 << 20
+    points, offsets = pack(tractography.original_tracts())
+    new_points = np.array(points, dtype=np.result_type(points.dtype, np.float32))
+    for start in xrange(0, len(points), chunk_size):
+        new_chunk = new_points[start: start + chunk_size]
+        ijk_points = affine_transform_points(ras_2_ijk, new_chunk)
+        for i in (0, 1, 2):
+            deformation = ndimage.map_coordinates(
+                image_data[..., i], ijk_points.T
+            )
+            new_chunk[:, i] -= coord_adjustment[i] * deformation
 
     return Tractography(
-        new_tracts,  tractography.original_tracts_data(),
+        split_packed(new_points, offsets), tractography.original_tracts_data(),
         **tractography.extra_args
     )
 
@@ -380,15 +370,6 @@ def tract_affine_transform(
     if invert:
         print "Inverting transform"
         transform = np.linalg.inv(transform)
-    orig_points = np.vstack(tractography.tracts())
-    new_points = nibabel.affines.apply_affine(transform, orig_points)
-    start = 0
-    new_tracts = []
-    for tract in tractography.original_tracts():
-        new_tracts.append(
-            new_points[start: start + len(tract)].copy()
-        )
-        start += len(tract)
 
     extra_args = {
         'affine': ref_affine,
@@ -399,21 +380,23 @@ def tract_affine_transform(
     #    tractography.extra_args.update(extra_args)
     #    extra_args = tractography.extra_args
 
-    return Tractography(
-        new_tracts,  tractography.original_tracts_data(),
-        **extra_args
+    # The points are only transformed when the tractography is written
+    new_tractography = Tractography(
+        tractography.original_tracts(), tractography.original_tracts_data(),
+        validate=False, **extra_args
     )
+    new_tractography.affine_transform(transform)
+    return new_tractography
 
 
 @tract_math_operation('<bins> <qty> <output>')
 def tract_tract_confidence(tractography, bins, qty, file_output=None):
     bins = int(bins)
-    lengths = numpy.empty(len(tractography.tracts()))
+    lengths = tractography.tract_features().lengths
     tracts = tractography.tracts()
     tracts_prob_data = []
     tracts_length_bin = []
-    for i, tract in enumerate(tracts):
-        lengths[i] = tract_length(tract)
+    for tract in tracts:
         tracts_prob_data.append(numpy.zeros(len(tract)))
         tracts_length_bin.append(numpy.zeros(len(tract)))
 
@@ -746,11 +729,9 @@ def each_tract_in_ijk(image, tractography):
 
 def tract_in_ijk(image, tractography):
     ras_points = numpy.vstack(tractography.tracts())
-    ijk_points = numpy.linalg.solve(image.get_affine(), numpy.hstack((
-        ras_points,
-        numpy.ones((len(ras_points), 1))
-    )).T).T[:, :-1]
-    return ijk_points
+    return affine_transform_points(
+        numpy.linalg.inv(image.get_affine()), ras_points
+    )
 
 
 def tract_in_ras(image, tract_ijk):
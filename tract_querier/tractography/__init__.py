@@ -1,59 +1,273 @@
-from .tractography import Tractography
+from .tractography import (
+    Tractography, TractFeatures, LazyTractsData, array_fields,
+    packed_tracts_data
+)
 from .trackvis import tractography_from_trackvis_file, tractography_to_trackvis_file
+from .vtk_legacy import (
+    tractography_from_vtk_legacy_file, tractography_to_vtk_legacy_file
+)
+from .vtp import tractography_from_vtp_file, tractography_to_vtp_file
+from .tck import tractography_from_tck_file, tractography_to_tck_file
+from .trx import tractography_from_trx_file, tractography_to_trx_file
 
+from functools import partial
+from itertools import chain
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from warnings import warn
 import numpy
 
+from .packed import lengths_to_offsets, split_packed
+from .features import load_tract_features, save_tract_features
+
 __all__ = [
-    'Tractography',
+    'Tractography', 'TractFeatures',
     'tractography_from_trackvis_file', 'tractography_to_trackvis_file',
+    'tractography_from_vtk_legacy_file', 'tractography_to_vtk_legacy_file',
+    'tractography_from_vtp_file', 'tractography_to_vtp_file',
+    'tractography_from_tck_file', 'tractography_to_tck_file',
+    'tractography_from_trx_file', 'tractography_to_trx_file',
+    'tractography_from_vtk_files', 'tractography_to_vtk_file',
     'tractography_from_files',
     'tractography_from_file', 'tractography_to_file',
 ]
 
 try:
-    __all__ += [
-        'tractography_from_vtk_files', 'tractography_to_vtk_file',
-        'vtkPolyData_to_tracts', 'tracts_to_vtkPolyData'
-    ]
     from .vtkInterface import (
         tractography_from_vtk_files, tractography_to_vtk_file,
         vtkPolyData_to_tracts, tracts_to_vtkPolyData
     )
-
+    __all__ += ['vtkPolyData_to_tracts', 'tracts_to_vtkPolyData']
+    vtk_support = True
 except ImportError:
     warn(
         'VTK support not installed in this python distribution, '
-        'VTK files will not be read or written'
+        'VTK files will be read and written without it'
     )
+    vtk_support = False
+
+
+def tractography_from_files(
+    filenames, source_field=None, processes=None, fields=None, dtype=None
+):
+    r'''
+    Reads and concatenates tractography files. The files are read
+    concurrently and their tracts are concatenated once.
 
+    Parameters
+    ----------
+    filenames : str or list of str
+        Tractography filenames
+    source_field : str, optional
+        If given, name of a tract data field holding, for every point,
+        the position in filenames of the file its tract comes from
+    processes : int, optional
+        Number of files read at a time, by default the number of CPUs
+    fields : list of str, optional
+        Tract data fields to keep, by default all of them
+    dtype : numpy dtype, optional
+        Type of the points of the tracts, see Tractography
 
-def tractography_from_files(filenames):
+    Returns
+    -------
+    tractography : Tractography
+    '''
     if isinstance(filenames, str):
         filenames = [filenames]
 
-    tracts = tractography_from_file(filenames[0])
+    load = partial(tractography_from_file, fields=fields, dtype=dtype)
+    if len(filenames) == 1:
+        tractographies = [load(filenames[0])]
+    else:
+        pool = ThreadPool(min(processes or cpu_count(), len(filenames)))
+        try:
+            tractographies = pool.map(load, filenames)
+        finally:
+            pool.close()
+
+    if len(tractographies) == 1 and source_field is None:
+        return tractographies[0]
+    return _concatenate_tractographies(tractographies, source_field)
 
-    for filename in filenames[1:]:
-        tracts_ = tractography_from_file(filename)
-        tracts.append(tracts_.tracts(), tracts_.tracts_data())
 
-    return tracts
+def _is_decoded(tracts_data, name):
+    return not (
+        isinstance(tracts_data, LazyTractsData) and
+        not tracts_data.is_loaded(name)
+    )
 
 
-def tractography_from_file(filename):
-    if filename.endswith('trk'):
-        return tractography_from_trackvis_file(filename)
-    elif filename.endswith('vtk') or filename.endswith('vtp'):
-        if 'tractography_from_vtk_files' in __all__:
-            return tractography_from_vtk_files(filename)
+def _concatenate_field(all_tracts_data, name):
+    r'''
+    Packed array of a field concatenated over several tract data
+    '''
+    return numpy.concatenate([
+        packed_tracts_data(tracts_data, name) for tracts_data in all_tracts_data
+    ])
+
+
+def _concatenate_tractographies(tractographies, source_field=None):
+    r'''
+    Concatenates the tracts and tract data of already validated
+    tractographies, keeping the extra arguments of the first one
+
+    The fields of a LazyTractsData which have not been decoded stay
+    lazy: they are concatenated on their first access.
+    '''
+    all_data = [
+        tractography.original_tracts_data() for tractography in tractographies
+    ]
+    first_data = all_data[0]
+    arrays = array_fields(first_data)
+    for tracts_data in all_data[1:]:
+        if (
+            set(tracts_data.keys()) != set(first_data.keys()) or
+            set(array_fields(tracts_data)) != set(arrays) or
+            any(
+                len(tracts_data[k]) > 0 and len(first_data[k]) > 0 and
+                first_data[k][0].shape[1] != tracts_data[k][0].shape[1]
+                for k in arrays
+                if _is_decoded(first_data, k) and _is_decoded(tracts_data, k)
+            )
+        ):
+            raise ValueError("Tract data to append not compatible")
+
+    tracts = list(chain.from_iterable(
+        tractography.original_tracts() for tractography in tractographies
+    ))
+    offsets = lengths_to_offsets([len(tract) for tract in tracts])
+    if all(all(_is_decoded(d, k) for k in arrays) for d in all_data):
+        tracts_data = {}
+    else:
+        tracts_data = LazyTractsData(offsets)
+    for k in first_data:
+        if k not in arrays:
+            tracts_data[k] = first_data[k]
+        elif all(_is_decoded(d, k) for d in all_data):
+            tracts_data[k] = list(chain.from_iterable(d[k] for d in all_data))
         else:
-            raise IOError("No VTK support installed, VTK files could not be read")
+            tracts_data.add_field(k, partial(_concatenate_field, all_data, k))
+
+    if source_field is not None:
+        sources = numpy.repeat(
+            numpy.arange(len(tractographies)),
+            [len(tractography.original_tracts()) for tractography in tractographies]
+        )
+        source_ids = numpy.repeat(sources, numpy.diff(offsets))[:, None]
+        tracts_data[source_field] = split_packed(source_ids, offsets)
+
+    return Tractography(
+        tracts, tracts_data, validate=False,
+        dtype=tractographies[0].dtype,
+        **tractographies[0].extra_args
+    )
+
+
+def tractography_from_file(filename, indices=None, fields=None, dtype=None):
+    r'''
+    Reads a tractography file
+
+    Parameters
+    ----------
+    filename : str
+        Tractography filename, its format is given by the extension
+    indices : array of int, optional
+        Indices of the tracts to read, by default all of them. TrackVis
+        and binary VTK files are then read through an offset index,
+        built on the first use and saved next to the file, and only the
+        requested tracts are read from disk.
+    fields : list of str, optional
+        Tract data fields to keep, by default all of them. The fields
+        of TrackVis, binary VTK and TRX files are decoded on their
+        first access, so the other ones are never read.
+    dtype : numpy dtype, optional
+        Type of the points of the tracts, see Tractography. TrackVis,
+        TCK and TRX files store float32 points, which are kept as they
+        are with numpy.float32.
+
+    Returns
+    -------
+    tractography : Tractography
+        When all the tracts are read, the tract features saved next to
+        the file by tractography_to_file are set on its tract_features
+    '''
+    read_all = indices is None
+    if filename.endswith('trk'):
+        tractography = tractography_from_trackvis_file(filename, indices=indices)
+        indices = None
+    elif filename.endswith('vtk'):
+        tractography = tractography_from_vtk_legacy_file(filename, indices=indices)
+        indices = None
+    elif filename.endswith('vtp'):
+        tractography = tractography_from_vtp_file(filename)
+    elif filename.endswith('tck'):
+        tractography = tractography_from_tck_file(filename)
+    elif filename.endswith('trx'):
+        tractography = tractography_from_trx_file(filename)
     else:
         raise IOError("File format not supported")
 
+    if fields is not None:
+        _select_fields(tractography.original_tracts_data(), fields)
+    if indices is not None or dtype is not None:
+        tractography = _tractography_subset(tractography, indices, dtype)
+    if read_all:
+        tractography.tract_features().update(load_tract_features(filename))
+    return tractography
+
+
+def _select_fields(tracts_data, fields):
+    r'''
+    Removes the tract data fields not in fields, keeping the strings,
+    such as ActiveScalars, which name a field in fields
+    '''
+    arrays = set(array_fields(tracts_data))
+    for name in list(tracts_data):
+        if name in fields:
+            continue
+        if name not in arrays and tracts_data[name] in fields:
+            continue
+        del tracts_data[name]
+
+
+def _tractography_subset(tractography, indices=None, dtype=None):
+    tracts = tractography.original_tracts()
+    tracts_data = tractography.original_tracts_data()
+    if indices is not None:
+        indices = numpy.asarray(indices, dtype=int).ravel().tolist()
+        tracts = [tracts[i] for i in indices]
+        tracts_data = dict(
+            (name, value if isinstance(value, str) else [value[i] for i in indices])
+            for name, value in tracts_data.iteritems()
+        )
+    return Tractography(
+        tracts, tracts_data, validate='fast',
+        dtype=dtype if dtype is not None else tractography.dtype,
+        **tractography.extra_args
+    )
+
 
 def tractography_to_file(filename, tractography, **kwargs):
+    r'''
+    Writes a tractography file, the tract features computed for the
+    tractography are saved next to it, see tractography_from_file
+
+    Parameters
+    ----------
+    filename : str
+        Tractography filename, its format is given by the extension
+    tractography : Tractography
+    kwargs :
+        Further arguments of the writer of the format
+    '''
+    result = _write_tractography_file(filename, tractography, **kwargs)
+    computed = tractography.tract_features().computed()
+    if len(computed) > 0:
+        save_tract_features(filename, computed)
+    return result
+
+
+def _write_tractography_file(filename, tractography, **kwargs):
     if filename.endswith('trk'):
         if 'affine' not in kwargs:
             if hasattr(tractography, 'affine'):
@@ -68,10 +282,21 @@ def tractography_to_file(filename, tractography, **kwargs):
                 warn('Setting image_dimensions of trk file to: 1 1 1')
                 kwargs['image_dimensions'] = numpy.ones(3)
         return tractography_to_trackvis_file(filename, tractography, **kwargs)
-    elif filename.endswith('vtk') or filename.endswith('vtp'):
-        if 'tractography_from_vtk_files' in __all__:
-            return tractography_to_vtk_file(filename, tractography, **kwargs)
-        else:
-            raise IOError("No VTK support installed, VTK files could not be read")
+    elif filename.endswith('vtk'):
+        return tractography_to_vtk_legacy_file(filename, tractography)
+    elif filename.endswith('vtp'):
+        return tractography_to_vtp_file(filename, tractography, **kwargs)
+    elif filename.endswith('tck'):
+        return tractography_to_tck_file(filename, tractography)
+    elif filename.endswith('trx'):
+        return tractography_to_trx_file(filename, tractography, **kwargs)
     else:
         raise IOError("File format not supported")
+
+
+if not vtk_support:
+    def tractography_from_vtk_files(vtk_file_names):
+        return tractography_from_files(vtk_file_names)
+
+    def tractography_to_vtk_file(vtk_file_name, tractography):
+        return tractography_to_file(vtk_file_name, tractography)
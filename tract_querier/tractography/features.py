@@ -0,0 +1,253 @@
+r"""
+Features of each tract of a set, computed at once over the packed
+points of the tracts
+
+The features computed for a tractography can be saved next to its file
+as a sidecar file, ``<filename>.features.npz``, which is only used
+while the file does not change.
+"""
+import os
+
+import numpy as np
+
+from .offset_index import _file_stamp
+from .packed import lengths_to_offsets
+
+__all__ = [
+    'tract_point_counts', 'tract_lengths', 'tract_step_ranges',
+    'point_length_weights',
+    'tract_bounding_boxes', 'tract_endpoints', 'tract_means',
+    'TRACT_FEATURES_SUFFIX', 'tract_features_filename',
+    'load_tract_features', 'save_tract_features'
+]
+
+TRACT_FEATURES_SUFFIX = '.features.npz'
+
+
+def _nonempty(offsets):
+    r'''
+    Mask of the non empty tracts and their first point
+    '''
+    offsets = np.asarray(offsets, dtype=int)
+    nonempty = offsets[1:] > offsets[:-1]
+    return nonempty, offsets[:-1][nonempty]
+
+
+def _reduce(ufunc, values, offsets, empty_value):
+    r'''
+    Segmented reduction of a packed array, empty_value for empty tracts
+    '''
+    nonempty, starts = _nonempty(offsets)
+    result = np.empty((len(nonempty),) + values.shape[1:], dtype=float)
+    result[~nonempty] = empty_value
+    if len(starts) > 0:
+        result[nonempty] = ufunc.reduceat(values, starts, axis=0)
+    return result
+
+
+def tract_point_counts(offsets):
+    r'''
+    Number of points of each tract
+
+    Parameters
+    ----------
+    offsets : array of int of length T + 1
+
+    Returns
+    -------
+    counts : array of int of length T
+    '''
+    return np.diff(offsets)
+
+
+def _steps(points, offsets):
+    r'''
+    Length of the segment ending at each point, 0 for the first point
+    of each tract
+    '''
+    steps = np.zeros(len(points))
+    if len(points) > 1:
+        steps[1:] = np.sqrt(
+            (np.diff(points, axis=0).astype(float) ** 2).sum(1)
+        )
+    # Segments joining consecutive tracts
+    steps[_nonempty(offsets)[1]] = 0
+    return steps
+
+
+def tract_lengths(points, offsets):
+    r'''
+    Length of each tract, the sum of the lengths of its segments
+
+    Parameters
+    ----------
+    points : array of Nx3
+    offsets : array of int of length T + 1
+
+    Returns
+    -------
+    lengths : array of float of length T
+    '''
+    return _reduce(np.add, _steps(points, offsets), offsets, 0)
+
+
+def point_length_weights(points, offsets):
+    r'''
+    Length of tract represented by each point, half the length of each
+    of its adjacent segments. The weights of the points of a tract add
+    up to its length.
+
+    Parameters
+    ----------
+    points : array of Nx3
+    offsets : array of int of length T + 1
+
+    Returns
+    -------
+    weights : array of float of length N
+    '''
+    half_steps = _steps(points, offsets) / 2
+    weights = half_steps.copy()
+    weights[:-1] += half_steps[1:]
+    return weights
+
+
+def tract_step_ranges(points, offsets):
+    r'''
+    Shortest and longest segment of each tract, NaN for tracts of less
+    than two points
+
+    Parameters
+    ----------
+    points : array of Nx3
+    offsets : array of int of length T + 1
+
+    Returns
+    -------
+    step_ranges : array of Tx2
+    '''
+    steps = _steps(points, offsets)
+    # Drop the first point of each tract, which ends no segment
+    segments = np.ones(len(points), dtype=bool)
+    segments[_nonempty(offsets)[1]] = False
+    steps = steps[segments]
+    segment_offsets = lengths_to_offsets(
+        np.maximum(tract_point_counts(offsets) - 1, 0)
+    )
+    return np.c_[
+        _reduce(np.minimum, steps, segment_offsets, np.nan),
+        _reduce(np.maximum, steps, segment_offsets, np.nan)
+    ]
+
+
+def tract_bounding_boxes(points, offsets):
+    r'''
+    Bounding box of each tract, NaN for empty tracts
+
+    Parameters
+    ----------
+    points : array of Nx3
+    offsets : array of int of length T + 1
+
+    Returns
+    -------
+    bounding_boxes : array of Tx6
+        Each row holds the left, posterior, inferior, right, anterior
+        and superior limits of a tract, as a BoundingBox does
+    '''
+    return np.hstack((
+        _reduce(np.minimum, points, offsets, np.nan),
+        _reduce(np.maximum, points, offsets, np.nan)
+    ))
+
+
+def tract_endpoints(points, offsets):
+    r'''
+    First and last points of each tract, NaN for empty tracts
+
+    Parameters
+    ----------
+    points : array of Nx3
+    offsets : array of int of length T + 1
+
+    Returns
+    -------
+    endpoints : array of Tx2x3
+    '''
+    offsets = np.asarray(offsets, dtype=int)
+    nonempty, starts = _nonempty(offsets)
+    endpoints = np.empty((len(nonempty), 2, 3))
+    endpoints[~nonempty] = np.nan
+    endpoints[nonempty, 0] = points[starts]
+    endpoints[nonempty, 1] = points[offsets[1:][nonempty] - 1]
+    return endpoints
+
+
+def tract_means(values, offsets):
+    r'''
+    Mean over the points of each tract of a packed data field, NaN for
+    empty tracts
+
+    Parameters
+    ----------
+    values : array of NxM or of length N
+    offsets : array of int of length T + 1
+
+    Returns
+    -------
+    means : array of TxM or of length T
+    '''
+    counts = tract_point_counts(offsets).astype(float)
+    sums = _reduce(np.add, values, offsets, np.nan)
+    return sums / counts.reshape((-1,) + (1,) * (sums.ndim - 1))
+
+
+def tract_features_filename(filename):
+    return filename + TRACT_FEATURES_SUFFIX
+
+
+def load_tract_features(filename):
+    r'''
+    Tract features saved next to a tractography file
+
+    Parameters
+    ----------
+    filename : str
+        Tractography filename
+
+    Returns
+    -------
+    features : dict of <feature name>=array
+        Empty if there is no sidecar file or the tractography file
+        changed since it was saved
+    '''
+    features_filename = tract_features_filename(filename)
+    if not os.path.exists(features_filename):
+        return {}
+    try:
+        with np.load(features_filename) as sidecar:
+            features = dict(sidecar.items())
+        if np.array_equal(features.pop('file_stamp'), _file_stamp(filename)):
+            return features
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def save_tract_features(filename, features):
+    r'''
+    Saves tract features next to a tractography file, once the file
+    has been written
+
+    Parameters
+    ----------
+    filename : str
+        Tractography filename
+    features : dict of <feature name>=array
+    '''
+    try:
+        with open(tract_features_filename(filename), 'wb') as file_:
+            np.savez(file_, file_stamp=_file_stamp(filename), **features)
+    except (IOError, OSError):
+        # The features are computed again when they can not be saved
+        pass
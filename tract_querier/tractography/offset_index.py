@@ -0,0 +1,117 @@
+r"""
+Random access to the tracts of a file through an offset index
+
+The index of a file holds where each tract is stored in it. It is built
+once, by scanning the file, and saved next to it as a sidecar file,
+``<filename>.offsets.npz``, which is rebuilt when the file changes.
+"""
+import os
+
+import numpy as np
+
+__all__ = [
+    'OFFSET_INDEX_SUFFIX', 'offset_index_filename', 'load_offset_index',
+    'read_ranges'
+]
+
+OFFSET_INDEX_SUFFIX = '.offsets.npz'
+
+
+def offset_index_filename(filename):
+    return filename + OFFSET_INDEX_SUFFIX
+
+
+def _file_stamp(filename):
+    stat = os.stat(filename)
+    return np.array([stat.st_size, stat.st_mtime])
+
+
+def load_offset_index(filename, build_index):
+    r'''
+    Offset index of a file, read from its sidecar file when this is
+    up to date, built and saved otherwise
+
+    Parameters
+    ----------
+    filename : str
+        Tractography filename
+    build_index : callable
+        Maps the filename to the index, a dict of <key>=array
+
+    Returns
+    -------
+    index : dict of <key>=array
+    '''
+    stamp = _file_stamp(filename)
+    index_filename = offset_index_filename(filename)
+    if os.path.exists(index_filename):
+        try:
+            with np.load(index_filename) as sidecar:
+                index = dict(sidecar.items())
+            if np.array_equal(index.pop('file_stamp'), stamp):
+                return index
+        except (IOError, ValueError, KeyError):
+            pass
+
+    index = build_index(filename)
+    try:
+        with open(index_filename, 'wb') as file_:
+            np.savez(file_, file_stamp=stamp, **index)
+    except (IOError, OSError):
+        # The index still works when it can not be saved
+        pass
+    return index
+
+
+def read_ranges(file_, starts, sizes, max_gap=1 << 16):
+    r'''
+    Reads byte ranges of a file. Ranges separated by less than max_gap
+    bytes are read at once, so the file is read sequentially when
+    most of it is requested.
+
+    Parameters
+    ----------
+    file_ : file
+    starts : array of int
+        Byte offset of each range
+    sizes : array of int
+        Byte size of each range
+    max_gap : int
+        Largest number of bytes read and dropped between two ranges
+
+    Returns
+    -------
+    chunks : list of str
+        The contents of each range, in the order of starts
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    chunks = [''] * len(starts)
+    if len(starts) == 0:
+        return chunks
+
+    order = np.argsort(starts, kind='mergesort')
+    sorted_starts = starts[order]
+    sorted_ends = sorted_starts + sizes[order]
+    reach = np.maximum.accumulate(sorted_ends)
+    new_read = np.ones(len(starts), dtype=bool)
+    new_read[1:] = sorted_starts[1:] - reach[:-1] > max_gap
+    firsts = np.flatnonzero(new_read)
+    read_ends = np.maximum.reduceat(sorted_ends, firsts)
+
+    order = order.tolist()
+    sorted_starts = sorted_starts.tolist()
+    sorted_ends = sorted_ends.tolist()
+    lasts = np.r_[firsts[1:], len(starts)].tolist()
+    for first, last, read_end in zip(firsts.tolist(), lasts, read_ends.tolist()):
+        read_start = sorted_starts[first]
+        file_.seek(read_start)
+        block = file_.read(read_end - read_start)
+        if len(block) != read_end - read_start:
+            raise IOError('Unexpected end of file %s' % file_.name)
+        for position in xrange(first, last):
+            chunks[order[position]] = block[
+                sorted_starts[position] - read_start:
+                sorted_ends[position] - read_start
+            ]
+    return chunks
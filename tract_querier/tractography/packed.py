@@ -0,0 +1,512 @@
+r"""
+Packed representation of a set of tracts
+
+A set of :math:`T` tracts with :math:`N` points in total is stored as a single
+:math:`N\times 3` points array and an offsets array of length :math:`T + 1`,
+the i-th tract being ``points[offsets[i]:offsets[i + 1]]``. Point data
+arrays follow the same layout.
+"""
+import numpy as np
+
+__all__ = [
+    'lengths_to_offsets', 'offsets_to_lengths', 'record_starts',
+    'cell_array_to_offsets', 'offsets_to_cell_array', 'pack', 'split_packed',
+    'lines_to_tracts', 'subsample_indices', 'arc_length_samples',
+    'affine_transform_points'
+]
+
+
+def lengths_to_offsets(lengths):
+    r'''
+    Offsets of a packed array from the lengths of its elements
+
+    Parameters
+    ----------
+    lengths : array of int of length T
+
+    Returns
+    -------
+    offsets : array of int of length T + 1
+        offsets[0] is 0 and offsets[-1] is the sum of the lengths
+    '''
+    offsets = np.zeros(len(lengths) + 1, dtype=int)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def offsets_to_lengths(offsets):
+    return np.diff(offsets)
+
+
+def record_starts(array, candidates, record_length, number_of_records=None):
+    r'''
+    Positions of consecutive variable length records in an array
+
+    Each record starts with a prefix from which its total length,
+    including the prefix, is computed. Finding the starts is inherently
+    sequential: the candidate starts are chained in bulk and the array
+    is only walked one record at a time where the candidates fail to
+    predict the next record.
+
+    Parameters
+    ----------
+    array : array
+        Array holding the records, the first record starts at 0
+    candidates : sorted array of int
+        Positions which are likely to be record starts
+    record_length : callable
+        Maps an array of prefixes to an array of record lengths
+    number_of_records : int, optional
+        If None, the records span the whole array
+
+    Returns
+    -------
+    starts : array of int of length number_of_records
+    '''
+    size = len(array)
+    if number_of_records == 0 or size == 0:
+        return np.empty(0, dtype=int)
+    if number_of_records is None:
+        until_end = True
+        number_of_records = size
+    else:
+        until_end = False
+
+    candidates = np.asarray(candidates, dtype=int)
+    next_candidates = candidates + record_length(array[candidates]).astype(int)
+
+    # Only keep the candidates which are predicted by another one, this
+    # drops most of the spurious ones which would break the runs below
+    predicted = np.zeros(size + 1, dtype=bool)
+    predicted[0] = True
+    predicted[next_candidates[
+        (next_candidates > candidates) & (next_candidates <= size)
+    ]] = True
+    kept = predicted[candidates]
+    candidates = candidates[kept]
+    next_candidates = next_candidates[kept]
+    breaks = np.flatnonzero(next_candidates[:-1] != candidates[1:])
+
+    starts = []
+    found_records = 0
+    position = 0
+    if len(breaks) > min(number_of_records, len(candidates)) // 4:
+        # The candidates are too poor to help, walk the records directly
+        while position < size and found_records < number_of_records:
+            starts.append(position)
+            length = int(record_length(array[position]))
+            if length <= 0:
+                break
+            position += length
+            found_records += 1
+        starts = np.array(starts, dtype=int)
+    else:
+        while position < size and found_records < number_of_records:
+            index = np.searchsorted(candidates, position)
+            if index < len(candidates) and candidates[index] == position:
+                break_index = np.searchsorted(breaks, index)
+                if break_index < len(breaks):
+                    run_end = breaks[break_index]
+                else:
+                    run_end = len(candidates) - 1
+                starts.append(candidates[index: run_end + 1])
+                position = next_candidates[run_end]
+            else:
+                starts.append(np.array([position]))
+                length = int(record_length(array[position: position + 1])[0])
+                if length <= 0:
+                    break
+                position += length
+            found_records += len(starts[-1])
+        starts = np.hstack(starts)[:number_of_records]
+
+    if until_end:
+        number_of_records = len(starts)
+    if (
+        len(starts) != number_of_records or
+        record_length(array[starts[-1:]])[0] <= 0 or
+        starts[-1] + record_length(array[starts[-1:]])[0] > size or
+        (until_end and starts[-1] + record_length(array[starts[-1:]])[0] != size)
+    ):
+        raise ValueError('Records are inconsistent with the array size')
+
+    return starts
+
+
+def cell_array_to_offsets(cell_array, number_of_lines):
+    r'''
+    Decodes a VTK cell array organized as K, ix_1, ..., ix_K, L, ix_1, ...
+
+    In the usual layout, where consecutive lines use consecutive point
+    ids, the length prefixes are the entries which break the sequence of
+    point ids, which are taken as the candidate starts of the lines.
+
+    Parameters
+    ----------
+    cell_array : array of int
+    number_of_lines : int
+
+    Returns
+    -------
+    offsets : array of int of length number_of_lines + 1
+    connectivity : array of int
+        Point ids of the lines, the ones of the i-th line are
+        connectivity[offsets[i]:offsets[i + 1]]
+    '''
+    cell_array = np.asarray(cell_array).ravel()
+    size = len(cell_array)
+
+    candidates = np.ones(size, dtype=bool)
+    candidates[1:] = cell_array[1:] != cell_array[:-1] + 1
+    candidates[2:] &= cell_array[2:] != cell_array[:-2] + 1
+    line_starts = record_starts(
+        cell_array, np.flatnonzero(candidates),
+        lambda prefixes: prefixes + 1, number_of_lines
+    )
+
+    offsets = lengths_to_offsets(cell_array[line_starts])
+    ids_mask = np.ones(size, dtype=bool)
+    ids_mask[line_starts] = False
+    connectivity = cell_array[ids_mask]
+    if len(connectivity) != offsets[-1]:
+        raise ValueError('Lines are inconsistent with the cell array size')
+
+    return offsets, connectivity
+
+
+def offsets_to_cell_array(offsets, connectivity=None, dtype=int):
+    r'''
+    Encodes lines as a VTK cell array organized as K, ix_1, ..., ix_K, ...
+
+    Parameters
+    ----------
+    offsets : array of int of length T + 1
+    connectivity : array of int, optional
+        Point ids of the lines, by default the lines use consecutive
+        point ids starting at offsets[0]
+    dtype : numpy dtype
+
+    Returns
+    -------
+    cell_array : array of length T + offsets[-1] - offsets[0]
+    '''
+    offsets = np.asarray(offsets)
+    lengths = np.diff(offsets)
+    number_of_lines = len(lengths)
+    number_of_points = offsets[-1] - offsets[0]
+
+    cell_array = np.empty(number_of_lines + number_of_points, dtype=dtype)
+    line_starts = offsets[:-1] - offsets[0] + np.arange(number_of_lines)
+    ids_mask = np.ones(len(cell_array), dtype=bool)
+    ids_mask[line_starts] = False
+    cell_array[line_starts] = lengths
+    if connectivity is None:
+        cell_array[ids_mask] = np.arange(offsets[0], offsets[-1])
+    else:
+        cell_array[ids_mask] = connectivity
+    return cell_array
+
+
+def _consecutive_views(arrays):
+    r'''
+    The array spanned by arrays if they are consecutive C-contiguous
+    views on the same buffer, None otherwise
+    '''
+    first = arrays[0]
+    base = first.base
+    if base is None:
+        return None
+    try:
+        if isinstance(base, np.ndarray):
+            base_array = base
+        else:
+            base_array = np.frombuffer(base, dtype=np.uint8)
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+    address = first.__array_interface__['data'][0]
+    start = address - base_array.__array_interface__['data'][0]
+    for array in arrays:
+        if (
+            array.base is not base or array.dtype != first.dtype or
+            array.shape[1:] != first.shape[1:] or
+            not array.flags.c_contiguous
+        ):
+            return None
+        if len(array) == 0:
+            continue
+        if array.__array_interface__['data'][0] != address:
+            return None
+        address += array.nbytes
+
+    length = sum(len(array) for array in arrays)
+    try:
+        return np.ndarray(
+            (length,) + first.shape[1:], dtype=first.dtype,
+            buffer=base_array, offset=start
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+def pack(arrays, dtype=None):
+    r'''
+    Packs a list of arrays into a single one
+
+    When the arrays are consecutive views on the same array, as the
+    tracts read from a file usually are, no data is copied.
+
+    Parameters
+    ----------
+    arrays : list of array of N_ixM or of length N_i
+    dtype : numpy dtype, optional
+        dtype of the packed array, by default the one of the arrays
+
+    Returns
+    -------
+    packed : array of NxM or of length N
+        Where N is the sum of the N_i
+    offsets : array of int of length T + 1
+    '''
+    offsets = lengths_to_offsets([len(array) for array in arrays])
+    if len(arrays) == 0:
+        return np.empty((0,), dtype=dtype or float), offsets
+
+    arrays = [np.asarray(array) for array in arrays]
+    packed = _consecutive_views(arrays)
+    if packed is None:
+        packed = np.concatenate(arrays)
+    if dtype is not None:
+        packed = np.ascontiguousarray(packed, dtype=dtype)
+    return packed, offsets
+
+
+def split_packed(array, offsets):
+    r'''
+    Views on each of the elements of a packed array
+    '''
+    offsets = np.asarray(offsets).tolist()
+    return [
+        array[start: end]
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+
+
+def _contiguous_line_starts(offsets, connectivity):
+    r'''
+    First point id of each line when every line uses consecutive
+    point ids, None otherwise
+    '''
+    if len(connectivity) == 0 or np.any(offsets[1:] == offsets[:-1]):
+        return None
+    steps = np.diff(connectivity) == 1
+    steps[offsets[1:-1] - 1] = True
+    if not steps.all():
+        return None
+    return connectivity[offsets[:-1]]
+
+
+def lines_to_tracts(points, offsets, connectivity, point_data, copy=False):
+    r'''
+    Tracts and tract data from the points, lines and point data
+    arrays of a PolyData
+
+    When every line uses consecutive point ids, the tracts are views on
+    the points and point data arrays, otherwise these are gathered
+    once. Strings in the point data are kept as they are.
+
+    Parameters
+    ----------
+    points : array of float Nx3
+    offsets : array of int of length T + 1
+        offsets[0] is 0 and offsets[-1] is the length of connectivity
+    connectivity : array of int
+        Point ids of the lines, the ones of the i-th line are
+        connectivity[offsets[i]:offsets[i + 1]]
+    point_data : dict of <data name>= array of NxM or str
+    copy : bool
+        Never return views on the input arrays
+
+    Returns
+    -------
+    tracts : list of float array N_ix3
+    tracts_data : dict of <data name>= list of float array of N_ixM
+    '''
+    offsets = np.asarray(offsets, dtype=int)
+    connectivity = np.asarray(connectivity, dtype=int)
+    number_of_tracts = len(offsets) - 1
+
+    if number_of_tracts > 0 and len(connectivity) > 0 and (
+        connectivity.max() >= len(points) or connectivity.min() < 0
+    ):
+        raise ValueError('Lines refer to non-existent points')
+
+    if number_of_tracts == 0:
+        line_starts = None
+    else:
+        line_starts = _contiguous_line_starts(offsets, connectivity)
+
+    if number_of_tracts == 0:
+        def split_lines(array):
+            return []
+    elif (
+        line_starts is not None and
+        np.all(line_starts - line_starts[0] == offsets[:-1])
+    ):
+        first = line_starts[0]
+
+        def split_lines(array):
+            array = array[first: first + offsets[-1]]
+            if copy:
+                array = array.copy()
+            return split_packed(array, offsets)
+    elif line_starts is not None and not copy:
+        line_ends = (line_starts + np.diff(offsets)).tolist()
+        line_starts = line_starts.tolist()
+
+        def split_lines(array):
+            return [
+                array[start: end]
+                for start, end in zip(line_starts, line_ends)
+            ]
+    else:
+        def split_lines(array):
+            return split_packed(array[connectivity], offsets)
+
+    tracts = split_lines(points)
+    tracts_data = {}
+    for name, array in point_data.iteritems():
+        if isinstance(array, str):
+            tracts_data[name] = array
+        else:
+            array = np.asarray(array)
+            if array.ndim == 1:
+                array = array[:, None]
+            tracts_data[name] = split_lines(array)
+
+    return tracts, tracts_data
+
+
+def _element_ids(offsets):
+    r'''
+    Index of the element each item of a packed array belongs to
+    '''
+    lengths = np.diff(offsets)
+    return np.repeat(np.arange(len(lengths)), lengths)
+
+
+def subsample_indices(offsets, points_per_tract):
+    r'''
+    Indices of at most points_per_tract evenly spaced points of each
+    tract, the same as numpy.linspace(0, N_i - 1, M_i).round() for
+    each tract
+
+    Parameters
+    ----------
+    offsets : array of int of length T + 1
+    points_per_tract : int
+
+    Returns
+    -------
+    indices : array of int
+        Indices of the points in the packed array
+    new_offsets : array of int of length T + 1
+        Offsets of the subsampled tracts in indices
+    '''
+    offsets = np.asarray(offsets, dtype=int)
+    lengths = np.diff(offsets)
+    new_lengths = np.minimum(lengths, points_per_tract)
+    new_offsets = lengths_to_offsets(new_lengths)
+
+    tract_ids = _element_ids(new_offsets)
+    steps = (lengths - 1.) / np.maximum(new_lengths - 1, 1)
+    positions = np.arange(new_offsets[-1]) - new_offsets[tract_ids]
+    indices = np.round(positions * steps[tract_ids]).astype(int)
+    indices += offsets[tract_ids]
+    return indices, new_offsets
+
+
+def arc_length_samples(points, offsets, points_per_tract):
+    r'''
+    Positions of at most points_per_tract points of each tract evenly
+    spaced along its arc length, the first and last points included
+
+    A sample lies on the segment from point indices[k] to point
+    indices[k] + 1, or on point indices[k] if it is the last one of
+    its tract, at fractions[k] of the segment. Data is interpolated as
+    values[indices] * (1 - fractions) + values[indices + 1] * fractions
+
+    Parameters
+    ----------
+    points : array of Nx3
+    offsets : array of int of length T + 1
+    points_per_tract : int
+
+    Returns
+    -------
+    indices : array of int
+    next_indices : array of int
+        indices + 1 except where the sample is on the last point
+    fractions : array of float
+    new_offsets : array of int of length T + 1
+    '''
+    offsets = np.asarray(offsets, dtype=int)
+    lengths = np.diff(offsets)
+    new_lengths = np.minimum(lengths, points_per_tract)
+    new_offsets = lengths_to_offsets(new_lengths)
+    if offsets[-1] == 0:
+        empty = np.empty(0, dtype=int)
+        return empty, empty, np.empty(0), new_offsets
+
+    # Cumulative arc length over the packed points, without the
+    # segments joining consecutive tracts
+    segments = np.zeros(len(points))
+    segments[1:] = np.sqrt(
+        (np.diff(points.astype(float), axis=0) ** 2).sum(1)
+    )
+    segments[offsets[:-1][lengths > 0]] = 0
+    arc_length = np.cumsum(segments)
+
+    tract_ids = _element_ids(new_offsets)
+    starts = offsets[:-1][tract_ids]
+    lasts = offsets[1:][tract_ids] - 1
+    tract_arc_length = arc_length[lasts] - arc_length[starts]
+    positions = np.arange(new_offsets[-1]) - new_offsets[tract_ids]
+    targets = arc_length[starts] + tract_arc_length * (
+        positions / np.maximum(new_lengths - 1., 1)[tract_ids]
+    )
+
+    indices = np.searchsorted(arc_length, targets, side='right') - 1
+    indices = np.clip(indices, starts, np.maximum(lasts - 1, starts))
+    next_indices = np.minimum(indices + 1, lasts)
+    segment_lengths = arc_length[next_indices] - arc_length[indices]
+    fractions = np.zeros(len(indices))
+    nonzero = segment_lengths > 0
+    fractions[nonzero] = np.clip(
+        (targets - arc_length[indices])[nonzero] / segment_lengths[nonzero],
+        0, 1
+    )
+    return indices, next_indices, fractions, new_offsets
+
+
+def affine_transform_points(affine, points):
+    r'''
+    Applies an affine transform to points keeping their floating point
+    type, only the transform is converted to it
+
+    Parameters
+    ----------
+    affine : array_like, :math:`4 \times 4`
+    points : array of :math:`N \times 3`
+
+    Returns
+    -------
+    transformed_points : array of :math:`N \times 3`
+    '''
+    points = np.asarray(points)
+    if points.dtype.kind != 'f':
+        points = points.astype(float)
+    affine = np.asarray(affine, dtype=points.dtype)
+    transformed_points = np.dot(points, affine[:3, :3].T)
+    transformed_points += affine[:3, 3]
+    return transformed_points
@@ -0,0 +1,253 @@
+from collections import OrderedDict
+from warnings import warn
+
+import numpy as np
+
+from .tractography import Tractography
+from .packed import pack
+
+__all__ = [
+    'tractography_from_tck_file', 'tractography_to_tck_file',
+    'read_tck', 'iterate_tck', 'write_tck'
+]
+
+TCK_TYPES = {
+    'Float32LE': '<f4', 'Float32BE': '>f4',
+    'Float64LE': '<f8', 'Float64BE': '>f8',
+}
+
+
+def tractography_from_tck_file(filename):
+    tracts, _ = read_tck(filename)
+    return Tractography(tracts, {}, validate='fast')
+
+
+def tractography_to_tck_file(filename, tractography):
+    tracts_data = tractography.tracts_data()
+    if any(not isinstance(v, str) for v in tracts_data.itervalues()):
+        warn(
+            "Tract data ignored as the TCK format does not "
+            "store data of the points"
+        )
+    return write_tck(filename, tractography.tracts())
+
+
+def read_tck_header(file_):
+    r'''
+    Reads the header of a TCK file
+
+    Parameters
+    ----------
+    file_ : file
+        File object positioned at the start of a TCK file
+
+    Returns
+    -------
+    header : OrderedDict of <key>=str
+        The values of repeated keys are joined by new lines
+    '''
+    if file_.readline().strip() != 'mrtrix tracks':
+        raise IOError('%s is not a TCK file' % file_.name)
+
+    header = OrderedDict()
+    for line in file_:
+        line = line.strip()
+        if line == 'END':
+            break
+        key, separator, value = line.partition(':')
+        if separator == '':
+            raise IOError('Invalid line in the TCK header: %s' % line)
+        key, value = key.strip(), value.strip()
+        if key in header:
+            header[key] += '\n' + value
+        else:
+            header[key] = value
+    else:
+        raise IOError('TCK header not terminated by END')
+
+    if 'file' not in header or header.get('datatype') not in TCK_TYPES:
+        raise IOError('TCK header without a valid file or datatype')
+
+    file_name, offset = header['file'].split()
+    if file_name != '.':
+        raise IOError('TCK files with their data in a separate file are not supported')
+    return header
+
+
+def _tck_points(filename):
+    r'''
+    Memory mapped array of the points of a TCK file and its header
+    '''
+    with open(filename, 'rb') as file_:
+        header = read_tck_header(file_)
+
+    dtype = np.dtype(TCK_TYPES[header['datatype']])
+    offset = int(header['file'].split()[1])
+    size = (
+        (_file_size(filename) - offset) // (3 * dtype.itemsize)
+    )
+    if size <= 0:
+        return np.empty((0, 3), dtype=dtype), header
+
+    points = np.memmap(
+        filename, dtype=dtype, mode='r', offset=offset, shape=(size, 3)
+    )
+    return np.asarray(points), header
+
+
+def _file_size(filename):
+    with open(filename, 'rb') as file_:
+        file_.seek(0, 2)
+        return file_.tell()
+
+
+def _split_on_delimiters(points, delimiters):
+    r'''
+    Views on the tracts of a block of points given the positions of
+    the NaN rows closing each tract
+    '''
+    starts = np.r_[0, delimiters[:-1] + 1].tolist()
+    ends = delimiters.tolist()
+    return [points[start: end] for start, end in zip(starts, ends)]
+
+
+def read_tck(filename):
+    r'''
+    Reads a TCK file. The tracts are views on the memory mapped file,
+    which is scanned once to find the delimiters of the tracts.
+
+    Parameters
+    ----------
+    filename : str
+        TCK filename
+
+    Returns
+    -------
+    tracts : list of array N_ix3
+        Each element of the list is a tract represented as point array,
+        the length of the i-th tract is N_i
+    header : OrderedDict of <key>=str
+        TCK header
+    '''
+    points, header = _tck_points(filename)
+
+    not_finite = ~np.isfinite(points[:, 0])
+    delimiters = np.flatnonzero(not_finite)
+    ends = np.flatnonzero(np.isinf(points[delimiters, 0]))
+    if len(ends) > 0:
+        delimiters = delimiters[:ends[0]]
+
+    count = int(header.get('count', 0))
+    if count > 0:
+        if len(delimiters) < count:
+            raise IOError(
+                'Expecting %d tracts in %s, found %d' %
+                (count, filename, len(delimiters))
+            )
+        delimiters = delimiters[:count]
+
+    return _split_on_delimiters(points, delimiters), header
+
+
+def iterate_tck(filename, chunk_size=1 << 20):
+    r'''
+    Iterates over the tracts of a TCK file in chunks
+
+    Parameters
+    ----------
+    filename : str
+        TCK filename
+    chunk_size : int
+        Approximate number of points read at a time
+
+    Returns
+    -------
+    chunks : iterator of list of array N_ix3
+        The tracts of each chunk, in the order of the file
+    '''
+    points, header = _tck_points(filename)
+    count = int(header.get('count', 0))
+    if count <= 0:
+        count = None
+
+    start = 0
+    size = chunk_size
+    number_of_tracts = 0
+    while start < len(points):
+        chunk = points[start: start + size]
+        delimiters = np.flatnonzero(~np.isfinite(chunk[:, 0]))
+        ends = np.flatnonzero(np.isinf(chunk[delimiters, 0]))
+        finished = len(ends) > 0
+        if finished:
+            delimiters = delimiters[:ends[0]]
+        if count is not None and number_of_tracts + len(delimiters) >= count:
+            delimiters = delimiters[:count - number_of_tracts]
+            finished = True
+
+        if len(delimiters) == 0 and not finished:
+            if start + size >= len(points):
+                break
+            # The chunk is shorter than the tract being read
+            size *= 2
+            continue
+
+        tracts = _split_on_delimiters(chunk, delimiters)
+        number_of_tracts += len(tracts)
+        if len(tracts) > 0:
+            yield tracts
+        if finished:
+            break
+        start += delimiters[-1] + 1
+        size = chunk_size
+
+
+def write_tck(filename, tracts, header=None, datatype='Float32LE'):
+    r'''
+    Writes tracts as a TCK file
+
+    Parameters
+    ----------
+    filename : str
+        TCK filename
+    tracts : list of float array N_ix3
+        Each element of the list is a tract represented as point array,
+        the length of the i-th tract is N_i
+    header : dict of <key>=str, optional
+        Further fields of the TCK header
+    datatype : str
+        One of Float32LE, Float32BE, Float64LE, Float64BE
+    '''
+    if datatype not in TCK_TYPES:
+        raise ValueError('TCK datatype %s not supported' % datatype)
+
+    points, offsets = pack(tracts)
+    points = points.reshape(-1, 3)
+    number_of_tracts = len(tracts)
+
+    data = np.empty((len(points) + number_of_tracts + 1, 3), dtype=TCK_TYPES[datatype])
+    delimiters = offsets[1:] + np.arange(number_of_tracts)
+    point_rows = np.ones(len(data), dtype=bool)
+    point_rows[delimiters] = False
+    point_rows[-1] = False
+    data[point_rows] = points
+    data[delimiters] = np.nan
+    data[-1] = np.inf
+
+    lines = ['mrtrix tracks']
+    fields = OrderedDict(header or {})
+    for key in ('datatype', 'file', 'count'):
+        fields.pop(key, None)
+    for key, value in fields.iteritems():
+        for value_line in str(value).split('\n'):
+            lines.append('%s: %s' % (key, value_line))
+    lines.append('datatype: %s' % datatype)
+    lines.append('count: %d' % number_of_tracts)
+
+    header_text = '\n'.join(lines) + '\nfile: . %d\nEND\n'
+    offset = len(header_text % 0)
+    while len(header_text % offset) != offset:
+        offset = len(header_text % offset)
+
+    with open(filename, 'wb') as file_:
+        file_.write(header_text % offset)
+        data.tofile(file_)
@@ -0,0 +1,73 @@
+from ..packed import (
+    lengths_to_offsets, cell_array_to_offsets, offsets_to_cell_array,
+    lines_to_tracts, pack
+)
+
+from numpy import arange, hstack, vstack, float32, may_share_memory
+from numpy.random import randint, randn, permutation
+from numpy.testing import assert_array_equal
+
+
+def test_cell_array_roundtrip():
+    lengths = randint(1, 20, 100)
+    offsets = lengths_to_offsets(lengths)
+    number_of_points = offsets[-1]
+
+    for connectivity in (
+        arange(number_of_points),
+        randint(0, number_of_points, number_of_points),
+        hstack([
+            arange(offsets[i], offsets[i + 1])
+            for i in permutation(len(lengths))
+        ])
+    ):
+        cell_array = offsets_to_cell_array(offsets, connectivity)
+        new_offsets, new_connectivity = cell_array_to_offsets(
+            cell_array, len(lengths)
+        )
+        assert_array_equal(offsets, new_offsets)
+        assert_array_equal(connectivity, new_connectivity)
+
+
+def test_lines_to_tracts_views():
+    lengths = randint(1, 20, 100)
+    offsets = lengths_to_offsets(lengths)
+    points = randn(offsets[-1], 3)
+    connectivity = arange(offsets[-1])
+
+    tracts, tracts_data = lines_to_tracts(
+        points, offsets, connectivity,
+        {'a': points[:, 0], 'ActiveScalars': 'a'}
+    )
+    assert(all(may_share_memory(tract, points) for tract in tracts))
+    assert(tracts_data['ActiveScalars'] == 'a')
+    for i, (tract, data) in enumerate(zip(tracts, tracts_data['a'])):
+        assert_array_equal(tract, points[offsets[i]: offsets[i + 1]])
+        assert_array_equal(data[:, 0], tract[:, 0])
+
+    tracts, _ = lines_to_tracts(points, offsets, connectivity, {}, copy=True)
+    assert(not any(may_share_memory(tract, points) for tract in tracts))
+
+    connectivity = connectivity[::-1].copy()
+    tracts, _ = lines_to_tracts(points, offsets, connectivity, {})
+    for i, tract in enumerate(tracts):
+        assert_array_equal(tract, points[connectivity[offsets[i]: offsets[i + 1]]])
+
+
+def test_pack():
+    lengths = randint(1, 20, 100)
+    offsets = lengths_to_offsets(lengths)
+    points = randn(offsets[-1], 3)
+    tracts, _ = lines_to_tracts(points, offsets, arange(offsets[-1]), {})
+
+    packed, new_offsets = pack(tracts)
+    assert(may_share_memory(packed, points))
+    assert_array_equal(packed, points)
+    assert_array_equal(offsets, new_offsets)
+
+    packed, new_offsets = pack(tracts[::-1])
+    assert(not may_share_memory(packed, points))
+    assert_array_equal(packed, vstack(tracts[::-1]))
+
+    packed, _ = pack(tracts, dtype='float32')
+    assert(packed.dtype == float32)
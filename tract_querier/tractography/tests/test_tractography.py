@@ -1,15 +1,19 @@
 from .. import Tractography
 from .. import (
     tractography_from_vtk_files, tractography_to_vtk_file,
+    tractography_from_vtk_legacy_file, tractography_to_vtk_legacy_file,
+    tractography_from_vtp_file, tractography_to_vtp_file,
+    tractography_from_tck_file, tractography_to_tck_file,
+    tractography_from_trx_file, tractography_to_trx_file,
     tractography_from_trackvis_file, tractography_to_trackvis_file,
-    tractography_from_files, tractography_to_file
+    tractography_from_files, tractography_from_file, tractography_to_file
 )
 
 from nose.tools import with_setup
 import copy
 from itertools import izip, chain
 
-from numpy import all, eye, ones, allclose
+from numpy import all, array, eye, ones, zeros, allclose
 from numpy.random import randint, randn
 from numpy.testing import assert_array_equal
 
@@ -139,6 +143,45 @@ def test_append():
     assert(equal_tracts_data(tractography.tracts_data(), new_data))
 
 
+@with_setup(setup)
+def test_validation():
+    from nose.tools import assert_raises
+
+    bad_tracts = tracts[:-1] + [tracts[-1][:, :2]]
+    assert_raises(ValueError, Tractography, bad_tracts)
+    Tractography(bad_tracts, validate='fast')
+
+    k = tracts_data.keys()[0]
+    bad_data = {k: tracts_data[k][:-1] + [tracts_data[k][0][:1]]}
+    assert_raises(ValueError, Tractography, tracts, bad_data)
+    assert_raises(ValueError, Tractography, tracts, {k: tracts_data[k][:-1]}, validate='fast')
+    assert_raises(ValueError, Tractography, [tracts[0][:, 0]])
+    assert_raises(ValueError, Tractography, [tracts[0], tracts[0][:, 0]])
+
+
+@with_setup(setup)
+def test_append_subsampled_filtered():
+    def criterium(tract):
+        return tract[0, 0] > 0
+
+    tractography_ = Tractography(tracts[:10], {k: v[:10] for k, v in tracts_data.iteritems()})
+    tractography_.subsample_tracts(5)
+    tractography_.filter_tracts(criterium)
+    for start in xrange(10, len(tracts), 10):
+        tractography_.append(
+            tracts[start: start + 10],
+            {k: v[start: start + 10] for k, v in tracts_data.iteritems()}
+        )
+    assert(len(tractography_.original_tracts()) == len(tracts))
+
+    tractography.subsample_tracts(5)
+    tractography.filter_tracts(criterium)
+    assert_array_equal(tractography_.filtered_tracts_map(), tractography.filtered_tracts_map())
+    assert(len(tractography_.tracts()) == len(tractography.tracts()))
+    assert(equal_tracts(tractography_.tracts(), tractography.tracts()))
+    assert(equal_tracts_data(tractography_.tracts_data(), tractography.tracts_data()))
+
+
 @with_setup(setup)
 def test_saveload_vtk():
     import tempfile
@@ -154,6 +197,43 @@ def test_saveload_vtk():
     os.remove(fname)
 
 
+@with_setup(setup)
+def test_saveload_vtk_legacy():
+    import tempfile
+    import os
+    fname = tempfile.mkstemp('.vtk')[1]
+
+    tracts_data_new = dict(tractography.tracts_data())
+    tracts_data_new['name with spaces'] = tracts_data_new.values()[0]
+    tractography_ = Tractography(tractography.tracts(), tracts_data_new)
+    tractography_to_vtk_legacy_file(fname, tractography_)
+
+    new_tractography = tractography_from_vtk_legacy_file(fname)
+
+    assert(equal_tracts(tractography_.tracts(), new_tractography.tracts()))
+    assert(equal_tracts_data(tractography_.tracts_data(), new_tractography.tracts_data()))
+
+    os.remove(fname)
+
+
+def test_load_vtk_legacy_written_by_vtk():
+    import os
+    fname = os.path.join(os.path.dirname(__file__), 'CG_L.vtk')
+
+    new_tractography = tractography_from_vtk_legacy_file(fname)
+
+    assert(len(new_tractography.tracts()) == 147)
+    assert(sum(len(t) for t in new_tractography.tracts()) == 22499)
+    assert(new_tractography.tracts_data()['ActiveTensors'] == 'Tensors_')
+    assert(all(
+        len(d) == len(t) and d.shape[1] == 9
+        for t, d in izip(
+            new_tractography.tracts(),
+            new_tractography.tracts_data()['Tensors_']
+        )
+    ))
+
+
 @with_setup(setup)
 def test_saveload_vtp():
     import tempfile
@@ -169,6 +249,107 @@ def test_saveload_vtp():
     os.remove(fname)
 
 
+@with_setup(setup)
+def test_saveload_vtp_native():
+    import tempfile
+    import os
+    fname = tempfile.mkstemp('.vtp')[1]
+
+    for compress, block_size in ((False, None), (True, 1 << 8)):
+        kwargs = {'compress': compress}
+        if block_size is not None:
+            kwargs['block_size'] = block_size
+        tractography_to_vtp_file(fname, tractography, **kwargs)
+
+        new_tractography = tractography_from_vtp_file(fname)
+
+        assert(equal_tracts(tractography.tracts(), new_tractography.tracts()))
+        assert(equal_tracts_data(tractography.tracts_data(), new_tractography.tracts_data()))
+
+    os.remove(fname)
+
+
+@with_setup(setup)
+def test_saveload_tck():
+    import tempfile
+    import os
+    from ..tck import read_tck, iterate_tck, write_tck
+    fname = tempfile.mkstemp('.tck')[1]
+
+    tractography_ = Tractography(tractography.tracts())
+    tractography_to_tck_file(fname, tractography_)
+
+    new_tractography = tractography_from_tck_file(fname)
+    assert(equal_tracts(tractography_.tracts(), new_tractography.tracts()))
+
+    chunks = list(iterate_tck(fname, chunk_size=max_tract_length // 2))
+    assert(len(chunks) > 1)
+    assert(equal_tracts(tractography_.tracts(), chain(*chunks)))
+    assert(sum(len(chunk) for chunk in chunks) == n_tracts)
+
+    write_tck(
+        fname, tractography_.tracts(),
+        header={'command_history': 'a\nb', 'count': 1},
+        datatype='Float64BE'
+    )
+    tracts_, header = read_tck(fname)
+    assert(equal_tracts(tractography_.tracts(), tracts_))
+    assert(header['command_history'] == 'a\nb')
+    assert(header['count'] == str(n_tracts))
+
+    os.remove(fname)
+
+
+@with_setup(setup)
+def test_saveload_trx():
+    import tempfile
+    import os
+    import shutil
+    from nose.tools import assert_raises
+    from ..trx import read_trx, add_trx_groups
+
+    folder = tempfile.mkdtemp()
+    for fname in (
+        os.path.join(folder, 'tracts.trx'),
+        os.path.join(folder, 'tracts_directory')
+    ):
+        tractography_to_trx_file(
+            fname, tractography,
+            affine=eye(4) * 2, image_dimensions=(10, 20, 30),
+            groups={'a': [0, 2]}
+        )
+        add_trx_groups(fname, {'b': [1, 3]})
+        add_trx_groups(fname, {'a': [4]})
+
+        trx = read_trx(fname)
+        assert(set(trx['groups']) == set(('a', 'b')))
+        assert_array_equal(trx['groups']['a'], [4])
+        assert_array_equal(trx['groups']['b'], [1, 3])
+
+        new_tractography = tractography_from_trx_file(fname)
+        assert(equal_tracts(tractography.tracts(), new_tractography.tracts()))
+        assert(equal_tracts_data(tractography.tracts_data(), new_tractography.tracts_data()))
+        assert_array_equal(eye(4) * 2, new_tractography.affine)
+        assert_array_equal((10, 20, 30), new_tractography.image_dims)
+
+    # A TRX directory is replaced, any other directory is left untouched
+    fname = os.path.join(folder, 'tracts_directory')
+    tractography_to_trx_file(
+        fname, tractography, affine=eye(4), image_dimensions=(10, 20, 30)
+    )
+    assert(len(read_trx(fname)['groups']) == 0)
+    fname = os.path.join(folder, 'results_trx')
+    os.makedirs(fname)
+    open(os.path.join(fname, 'keep.txt'), 'w').close()
+    assert_raises(
+        IOError, tractography_to_file, fname, tractography,
+        affine=eye(4), image_dimensions=(10, 20, 30)
+    )
+    assert(os.path.exists(os.path.join(fname, 'keep.txt')))
+
+    shutil.rmtree(folder)
+
+
 @with_setup(setup)
 def test_saveload_trk():
     import tempfile
@@ -198,12 +379,188 @@ def test_saveload_trk():
     os.remove(fname)
 
 
+@with_setup(setup)
+def test_load_indices():
+    import tempfile
+    import os
+    import shutil
+    from ..offset_index import offset_index_filename
+
+    folder = tempfile.mkdtemp()
+    tract_data_new = {
+        k: v
+        for k, v in tractography.tracts_data().iteritems()
+        if v[0].shape[1] == 1
+    }
+    tractography_ = Tractography(tractography.tracts(), tract_data_new)
+    indices = [7, 3, 4, 5, 40, 3]
+
+    for fname in (
+        os.path.join(folder, 'tracts.trk'),
+        os.path.join(folder, 'tracts.vtk'),
+        os.path.join(folder, 'tracts.tck')
+    ):
+        tractography_to_file(fname, tractography_)
+        for _ in xrange(2):
+            new_tractography = tractography_from_file(fname, indices=indices)
+            assert(len(new_tractography.tracts()) == len(indices))
+            assert(equal_tracts(
+                [tractography_.tracts()[i] for i in indices],
+                new_tractography.tracts()
+            ))
+            if not fname.endswith('tck'):
+                assert(equal_tracts_data(
+                    {
+                        k: [v[i] for i in indices]
+                        for k, v in tract_data_new.iteritems()
+                    },
+                    new_tractography.tracts_data()
+                ))
+        assert(fname.endswith('tck') or os.path.exists(offset_index_filename(fname)))
+
+    shutil.rmtree(folder)
+
+
+@with_setup(setup)
+def test_lazy_tracts_data():
+    import tempfile
+    import os
+    import shutil
+    from ..tractography import LazyTractsData
+
+    folder = tempfile.mkdtemp()
+    tract_data_new = {
+        k: v
+        for k, v in tractography.tracts_data().iteritems()
+        if v[0].shape[1] == 1
+    }
+    tractography_ = Tractography(tractography.tracts(), tract_data_new)
+    name = sorted(tract_data_new)[0]
+
+    for ext in ('.trk', '.vtk', '.trx', '.vtp'):
+        fname = os.path.join(folder, 'tracts' + ext)
+        tractography_to_file(fname, tractography_)
+
+        new_tractography = tractography_from_file(fname)
+        tracts_data_ = new_tractography.tracts_data()
+        assert(isinstance(tracts_data_, LazyTractsData))
+        assert(not any(tracts_data_.is_loaded(k) for k in tract_data_new))
+
+        # Untouched fields are written as they are read
+        copy_fname = os.path.join(folder, 'copy' + ext)
+        tractography_to_file(copy_fname, new_tractography)
+        assert(not any(tracts_data_.is_loaded(k) for k in tract_data_new))
+        assert(equal_tracts_data(
+            tract_data_new, tractography_from_file(copy_fname).tracts_data()
+        ))
+        assert(equal_tracts_data(tract_data_new, tracts_data_))
+
+        # Subsampling leaves the fields of the file undecoded
+        new_tractography = tractography_from_file(fname)
+        new_tractography.subsample_tracts(3)
+        assert(not new_tractography.original_tracts_data().is_loaded(name))
+        tractography_.subsample_tracts(3)
+        assert(equal_tracts_data(
+            tractography_.tracts_data(), new_tractography.tracts_data()
+        ))
+        tractography_.unsubsample_tracts()
+
+        # So does filtering, the filtered fields are decoded on access
+        new_tractography = tractography_from_file(fname)
+        new_tractography.filter_tracts([0, 2])
+        assert(not new_tractography.original_tracts_data().is_loaded(name))
+        assert(not new_tractography.tracts_data().is_loaded(name))
+        assert(equal_tracts(
+            new_tractography.tracts_data()[name],
+            [tract_data_new[name][0], tract_data_new[name][2]]
+        ))
+
+        new_tractography = tractography_from_file(fname, fields=[name])
+        assert(new_tractography.tracts_data().keys() == [name])
+        assert(equal_tracts(tractography_.tracts(), new_tractography.tracts()))
+
+    shutil.rmtree(folder)
+
+
+@with_setup(setup)
+def test_trk_against_nibabel():
+    import tempfile
+    import os
+    import warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from nibabel import trackvis
+
+    fname = tempfile.mkstemp('.trk')[1]
+    affine = array([
+        [-2., 0, 0, 90],
+        [0, 2, 0, -126],
+        [0, 0, 2, -72],
+        [0, 0, 0, 1]
+    ])
+
+    tract_data_new = {
+        k: v
+        for k, v in tractography.tracts_data().iteritems()
+        if v[0].shape[1] == 1
+    }
+    tractography_ = Tractography(tractography.tracts(), tract_data_new)
+    tractography_to_trackvis_file(
+        fname, tractography_,
+        affine=affine, image_dimensions=(91, 109, 91)
+    )
+
+    nibabel_tracts, header = trackvis.read(fname, points_space='rasmm')
+    scalar_names = list(header['scalar_name'][:len(tract_data_new)])
+    # Points go through float32 voxmm coordinates
+    assert(all(
+        allclose(t1, t2[0], atol=1e-4)
+        for t1, t2 in izip(tractography_.tracts(), nibabel_tracts)
+    ))
+    assert(equal_tracts_data(
+        tractography_.tracts_data(),
+        {
+            name: [t[1][:, i][:, None] for t in nibabel_tracts]
+            for i, name in enumerate(scalar_names)
+        }
+    ))
+
+    trackvis.write(fname, nibabel_tracts, header, points_space='rasmm')
+    new_tractography = tractography_from_trackvis_file(fname)
+    assert(equal_tracts(
+        [t[0] for t in nibabel_tracts], new_tractography.tracts()
+    ))
+    assert(equal_tracts_data(
+        tractography_.tracts_data(), new_tractography.tracts_data()
+    ))
+    assert_array_equal(affine, new_tractography.affine)
+
+    os.remove(fname)
+
+
+def test_trk_without_affine():
+    import tempfile
+    import os
+    import warnings
+    from nose.tools import assert_raises
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        from nibabel import trackvis
+
+    # Without a voxel to RAS affine the points can not be put in RAS
+    fname = tempfile.mkstemp('.trk')[1]
+    points = randn(10, 3).astype('f4')
+    trackvis.write(fname, [(points, None, None)], trackvis.empty_header())
+    assert_raises(IOError, tractography_from_file, fname)
+    os.remove(fname)
+
+
 @with_setup(setup)
 def test_saveload():
     import tempfile
     import os
 
-    for ext in ('.vtk', '.vtp', '.trk'):
+    for ext in ('.vtk', '.vtp', '.trk', '.tck', '.trx'):
         fname = tempfile.mkstemp(ext)[1]
 
         kwargs = {}
@@ -219,6 +576,8 @@ def test_saveload():
             }
 
             tractography_ = Tractography(tractography.tracts(), tract_data_new)
+        elif ext == '.tck':
+            tractography_ = Tractography(tractography.tracts())
         else:
             tractography_ = tractography
 
@@ -233,3 +592,217 @@ def test_saveload():
         assert(equal_tracts_data(tractography_.tracts_data(), new_tractography.tracts_data()))
 
         os.remove(fname)
+
+
+@with_setup(setup)
+def test_load_several_files():
+    import tempfile
+    import os
+    import shutil
+
+    folder = tempfile.mkdtemp()
+    fnames = [os.path.join(folder, 'tracts%d.vtk' % i) for i in xrange(3)]
+    for i, fname in enumerate(fnames):
+        tractography_to_file(fname, Tractography(
+            tractography.tracts()[i::3],
+            {k: v[i::3] for k, v in tractography.tracts_data().iteritems()}
+        ))
+
+    new_tractography = tractography_from_files(fnames, source_field='source')
+    tracts = list(chain(*(tractography.tracts()[i::3] for i in xrange(3))))
+    assert(len(new_tractography.tracts()) == len(tracts))
+    assert(equal_tracts(tracts, new_tractography.tracts()))
+
+    sources = new_tractography.tracts_data()['source']
+    assert(len(sources) == len(tracts))
+    for i, (tract, source) in enumerate(zip(tracts, sources)):
+        assert(len(source) == len(tract))
+        assert(all(source == (i >= 17) + (i >= 34)))
+
+    # The fields of the files are concatenated on their first access
+    tracts_data = new_tractography.original_tracts_data()
+    for k, v in tractography.tracts_data().iteritems():
+        assert(not tracts_data.is_loaded(k))
+        assert(equal_tracts(
+            list(chain(*(v[i::3] for i in xrange(3)))), tracts_data[k]
+        ))
+
+    shutil.rmtree(folder)
+
+
+@with_setup(setup)
+def test_float32():
+    import tempfile
+    import os
+    import shutil
+    from numpy import float32, diag
+    from ...tract_label_indices import compute_tract_label_indices
+
+    tractography_ = Tractography(tracts, tracts_data, dtype=float32)
+    assert(all(tract.dtype == float32 for tract in tractography_.tracts()))
+    tractography_.append([tract * 2 for tract in tracts], tracts_data)
+    assert(all(tract.dtype == float32 for tract in tractography_.tracts()))
+    assert(equal_tracts(tracts, tractography_.tracts()))
+
+    folder = tempfile.mkdtemp()
+    for ext in ('.vtk', '.vtp'):
+        fname = os.path.join(folder, 'tracts' + ext)
+        tractography_to_file(fname, tractography_)
+        new_tractography = tractography_from_file(fname)
+        assert(all(tract.dtype == float32 for tract in new_tractography.tracts()))
+        new_tractography = tractography_from_file(fname, dtype='float64')
+        assert(new_tractography.tracts()[0].dtype == float)
+    shutil.rmtree(folder)
+
+    labels = randint(0, 10, (20, 20, 20))
+    affine = diag([.25, .25, .25, 1.])
+    affine[:3, 3] = 10
+    tracts_ = [tract + 10 for tract in tracts]
+    indices = compute_tract_label_indices(affine, labels, tracts_, 0, 2)
+    indices32 = compute_tract_label_indices(
+        affine, labels, [tract.astype(float32) for tract in tracts_], 0, 2
+    )
+    assert(indices == indices32)
+
+
+@with_setup(setup)
+def test_subsample_modes():
+    from numpy import linspace, cumsum, sqrt, diff
+
+    tractography.subsample_tracts(5)
+    for i, tract in enumerate(tracts):
+        s = linspace(0, len(tract) - 1, min(len(tract), 5)).round().astype(int)
+        assert_array_equal(tractography.tracts()[i], tract[s])
+        for k, v in tracts_data.iteritems():
+            assert_array_equal(tractography.tracts_data()[k][i], v[i][s])
+
+    # The steps of the first half of the tract are 10 times shorter
+    steps = array([.1] * 10 + [1.] * 10)
+    tract = zeros((21, 3))
+    tract[1:, 0] = cumsum(steps)
+    tractography_ = Tractography([tract, tract[:1]], {'x': [tract[:, :1], tract[:1, :1]]})
+    tractography_.subsample_tracts(5, mode='arc_length')
+    subsampled = tractography_.tracts()[0]
+    assert(len(subsampled) == 5 and len(tractography_.tracts()[1]) == 1)
+    assert(allclose(subsampled[:, 0], linspace(0, 11, 5)))
+    assert(allclose(tractography_.tracts_data()['x'][0][:, 0], subsampled[:, 0]))
+    assert(allclose(sqrt((diff(subsampled, axis=0) ** 2).sum(1)), 11 / 4.))
+
+    tractography_.append([tract], {'x': [tract[:, :1]]})
+    assert_array_equal(tractography_.tracts()[2], subsampled)
+
+    # Adding data keeps the subsampling mode
+    tractography_.add_tract_data_from_array('y', [1, 2, 3])
+    assert(allclose(tractography_.tracts()[0], subsampled))
+    assert_array_equal(tractography_.tracts_data()['y'][2], ones((5, 1)) * 3)
+
+
+@with_setup(setup)
+def test_filter_tracts():
+    from numpy import flatnonzero, diff, sqrt, arange
+
+    lengths = array([sqrt((diff(tract, axis=0) ** 2).sum(1)).sum() for tract in tracts])
+    threshold = lengths.mean()
+    tractography.filter_tracts(lambda features: features.lengths > threshold, vectorized=True)
+    tract_map = flatnonzero(lengths > threshold)
+    assert_array_equal(tractography.filtered_tracts_map(), tract_map)
+    assert(equal_tracts(tractography.tracts(), [tracts[i] for i in tract_map]))
+    for k, v in tracts_data.iteritems():
+        assert(equal_tracts(tractography.tracts_data()[k], [v[i] for i in tract_map]))
+
+    tractography.filter_tracts(
+        lambda features: (features.bounding_boxes[:, 0] < 0) &
+        (features.endpoints[:, 1, 1] > 0) &
+        (features.mean(tracts_data.keys()[0])[:, 0] > 0) &
+        (features.point_counts > 2),
+        vectorized=True
+    )
+    tract_map = [
+        i for i, tract in enumerate(tracts)
+        if tract[:, 0].min() < 0 and tract[-1, 1] > 0 and len(tract) > 2 and
+        tracts_data.values()[0][i][:, 0].mean() > 0
+    ]
+    assert_array_equal(tractography.filtered_tracts_map(), tract_map)
+
+    mask = arange(len(tracts)) % 3 == 0
+    tractography.filter_tracts(mask)
+    assert_array_equal(tractography.filtered_tracts_map(), flatnonzero(mask))
+    tractography.filter_tracts([5, 1])
+    assert_array_equal(tractography.filtered_tracts_map(), [1, 5])
+    tractography.append(tracts, tracts_data)
+    assert_array_equal(tractography.filtered_tracts_map(), [1, 5])
+    assert(equal_tracts(tractography.tracts(), [tracts[1], tracts[5]]))
+
+
+@with_setup(setup)
+def test_tract_features():
+    import tempfile
+    import os
+    import shutil
+    from numpy import sqrt, diff, nan
+
+    steps = [sqrt((diff(tract, axis=0) ** 2).sum(1)) for tract in tracts]
+    features = tractography.tract_features()
+    assert(features is tractography.tract_features())
+    assert(allclose(features.lengths, [s.sum() for s in steps]))
+    assert(allclose(features.mean_steps, [s.mean() for s in steps]))
+    assert(allclose(features.step_ranges, [(s.min(), s.max()) for s in steps]))
+    assert(allclose(features.endpoints, [tract[(0, -1), :] for tract in tracts]))
+    assert(allclose(
+        features.bounding_boxes,
+        [list(tract.min(0)) + list(tract.max(0)) for tract in tracts]
+    ))
+    name = tracts_data.keys()[0]
+    assert(allclose(features.mean(name), [v.mean(0) for v in tracts_data[name]]))
+
+    tractography.subsample_tracts(5)
+    assert(features is not tractography.tract_features())
+    assert(len(tractography.tract_features().step_ranges) == len(tracts))
+    tractography.unsubsample_tracts()
+    tractography.append(tracts[:2], {k: v[:2] for k, v in tracts_data.iteritems()})
+    assert(len(tractography.tract_features().lengths) == len(tracts) + 2)
+
+    folder = tempfile.mkdtemp()
+    fname = os.path.join(folder, 'tracts.vtk')
+    tractography_to_file(fname, tractography)
+    assert(os.path.exists(fname + '.features.npz'))
+    new_tractography = tractography_from_file(fname)
+    assert('lengths' in new_tractography.tract_features().computed())
+    assert(allclose(new_tractography.tract_features().lengths, tractography.tract_features().lengths))
+    # A changed file invalidates the saved features
+    tractography_to_file(fname, Tractography(tracts, tracts_data))
+    os.utime(fname, (0, 0))
+    assert(len(tractography_from_file(fname).tract_features().computed()) == 0)
+    shutil.rmtree(folder)
+
+    short = Tractography([tracts[0], tracts[0][:1]])
+    assert(allclose(short.tract_features().step_ranges[1], [nan, nan], equal_nan=True))
+
+
+@with_setup(setup)
+def test_affine_transform():
+    from numpy import dot, c_, diag
+
+    rotation = array([[0, -1, 0, 2], [1, 0, 0, -1], [0, 0, 1, 3], [0, 0, 0, 1.]])
+    scaling = diag([2., 2., 1., 1.])
+    affine = dot(scaling, rotation)
+
+    def transformed(tracts):
+        return [dot(affine, c_[t, ones(len(t))].T).T[:, :3] for t in tracts]
+
+    tractography.filter_tracts(lambda t: len(t) > 10)
+    original = tractography.tracts()
+    tractography.affine_transform(rotation)
+    tractography.affine_transform(scaling)
+    assert(allclose(tractography.pending_affine_transform(), affine))
+    # The points are not transformed until they are read
+    assert(tractography._tracts[0] is tracts[0])
+    assert(equal_tracts(tractography.tracts(), transformed(original)))
+    assert(tractography.pending_affine_transform() is None)
+    assert(equal_tracts(tractography.original_tracts(), transformed(tracts)))
+
+    tractography.affine_transform(eye(4))
+    tractography.append(tracts[:2], {k: v[:2] for k, v in tracts_data.iteritems()})
+    assert(equal_tracts(
+        tractography.original_tracts(), transformed(tracts) + tracts[:2]
+    ))
@@ -1,15 +1,55 @@
-from itertools import izip
+from functools import partial
 from warnings import warn
 
 import numpy
+from nibabel.orientations import aff2axcodes
 
-from tractography import Tractography
+from .tractography import (
+    Tractography, LazyTractsData, packed_tracts_data, array_fields
+)
+from .packed import lengths_to_offsets, pack, record_starts, split_packed
+from .offset_index import load_offset_index, read_ranges
 
-from nibabel import trackvis
+__all__ = [
+    'tractography_from_trackvis_file', 'tractography_to_trackvis_file',
+    'read_trk', 'write_trk', 'empty_trk_header',
+    'build_trk_offset_index', 'read_trk_tracts'
+]
+
+# TrackVis header, version 2,
+# see http://www.trackvis.org/docs/?subsect=fileformat
+TRK_HEADER_DTYPE = numpy.dtype([
+    ('id_string', 'S6'),
+    ('dim', 'h', 3),
+    ('voxel_size', 'f4', 3),
+    ('origin', 'f4', 3),
+    ('n_scalars', 'h'),
+    ('scalar_name', 'S20', 10),
+    ('n_properties', 'h'),
+    ('property_name', 'S20', 10),
+    ('vox_to_ras', 'f4', (4, 4)),
+    ('reserved', 'S444'),
+    ('voxel_order', 'S4'),
+    ('pad2', 'S4'),
+    ('image_orientation_patient', 'f4', 6),
+    ('pad1', 'S2'),
+    ('invert_x', 'S1'),
+    ('invert_y', 'S1'),
+    ('invert_z', 'S1'),
+    ('swap_xy', 'S1'),
+    ('swap_yz', 'S1'),
+    ('swap_zx', 'S1'),
+    ('n_count', 'i4'),
+    ('version', 'i4'),
+    ('hdr_size', 'i4'),
+])
+
+# affine to go from DICOM LPS to MNI RAS space
+DPCS_TO_TAL = numpy.diag([-1, -1, 1, 1])
 
 
 def tractography_to_trackvis_file(filename, tractography, affine=None, image_dimensions=None):
-    trk_header = trackvis.empty_header()
+    trk_header = empty_trk_header()
 
     if affine is not None:
         pass
@@ -18,91 +58,461 @@ def tractography_to_trackvis_file(filename, tractography, affine=None, image_dim
     else:
         raise ValueError("Affine transform has to be provided")
 
-    trackvis.aff_to_hdr(affine, trk_header, True, True)
+    affine_to_trk_header(affine, trk_header)
     trk_header['origin'] = 0.
     if image_dimensions is not None:
         trk_header['dim'] = image_dimensions
-    elif hasattr(tractography, 'image_dimensions'):
-        trk_header['dim'] = image_dimensions
+    elif hasattr(tractography, 'image_dims'):
+        trk_header['dim'] = tractography.image_dims
     else:
         raise ValueError("Image dimensions needed to save a trackvis file")
 
     orig_data = tractography.tracts_data()
-    data = {}
-    for k, v in orig_data.iteritems():
-        if not isinstance(v[0], numpy.ndarray):
+    data = orig_data.copy()
+    fields = array_fields(orig_data)
+    for k in orig_data.keys():
+        if k not in fields:
+            del data[k]
             continue
-        if (v[0].ndim > 1 and any(d > 1 for d in v[0].shape[1:])):
+        value = packed_tracts_data(orig_data, k)
+        if (value.ndim > 1 and any(d > 1 for d in value.shape[1:])):
             warn(
                 "Scalar data %s ignored as trackvis "
                 "format does not handle multivalued data" % k
             )
-        else:
-            data[k] = v
-
-    #data_new = {}
-    # for k, v in data.iteritems():
-    #    if (v[0].ndim > 1 and v[0].shape[1] > 1):
-    #        for i in xrange(v[0].shape[1]):
-    #            data_new['%s_%02d' % (k, i)] = [
-    #                v_[:, i] for v_ in v
-    #            ]
-    #    else:
-    #       data_new[k] = v
-    trk_header['n_count'] = len(tractography.tracts())
-    trk_header['n_properties'] = 0
-    trk_header['n_scalars'] = len(data)
-
-    if len(data) > 10:
-        raise ValueError('At most 10 scalars permitted per point')
-
-    trk_header['scalar_name'][:len(data)] = numpy.array(
-        [n[:20] for n in data],
-        dtype='|S20'
+            del data[k]
+
+    write_trk(filename, tractography.tracts(), data, trk_header)
+
+
+def tractography_from_trackvis_file(filename, indices=None):
+    if indices is None:
+        tracts, tracts_data, _, header = read_trk(filename, lazy=True)
+    else:
+        tracts, tracts_data, header = read_trk_tracts(filename, indices)
+
+    affine = header['vox_to_ras']
+    image_dims = header['dim']
+
+    tr = Tractography(
+        tracts, tracts_data, validate='fast',
+        affine=affine, image_dims=image_dims
     )
-    trk_tracts = []
-    for i, sl in enumerate(tractography.tracts()):
-        scalars = None
-        if len(data) > 0:
-            scalars = numpy.vstack([
-                data[k][i].squeeze()
-                for k in trk_header['scalar_name'][:len(data)]
-            ]).T
 
-        trk_tracts.append((sl, scalars, None))
+    return tr
 
-    trackvis.write(filename, trk_tracts, trk_header, points_space='rasmm')
 
+def empty_trk_header():
+    r'''
+    TrackVis version 2 header with the mandatory fields set
+    '''
+    header = numpy.zeros((), dtype=TRK_HEADER_DTYPE)
+    header['id_string'] = 'TRACK'
+    header['version'] = 2
+    header['hdr_size'] = TRK_HEADER_DTYPE.itemsize
+    return header
 
-def tractography_from_trackvis_file(filename):
-    tracts_and_data, header = trackvis.read(filename, points_space='rasmm')
 
-    tracts, scalars, properties = izip(*tracts_and_data)
+def affine_to_trk_header(affine, header):
+    r'''
+    Sets the voxel to RAS affine, voxel order, voxel size and
+    orientation fields of a TrackVis header from an affine transform,
+    as nibabel's trackvis.aff_to_hdr with positive voxel sizes
+    '''
+    header['vox_to_ras'] = affine
+    header['voxel_order'] = ''.join(aff2axcodes(affine))
 
-    scalar_names = [n for n in header['scalar_name'] if len(n) > 0]
+    affine = numpy.dot(DPCS_TO_TAL, affine)
+    rzs = affine[:3, :3]
+    zooms = numpy.sqrt(numpy.sum(rzs * rzs, axis=0))
+    p, _, qs = numpy.linalg.svd(rzs / zooms)
+    rotation = numpy.dot(p, qs)
 
-    #scalar_names_unique = []
-    #scalar_names_subcomp = {}
-    # for sn in scalar_names:
-    #    if re.match('.*_[0-9]{2}', sn):
-    #        prefix = sn[:sn.rfind('_')]
-    #        if prefix not in scalar_names_unique:
-    #            scalar_names_unique.append(prefix)
-    #            scalar_names_subcomp[prefix] = int(sn[-2:])
-    #        scalar_names_subcomp[prefix] = max(sn[-2:], scalar_names_subcomp[prefix])
-    #    else:
-    #        scalar_names_unique.append(sn)
+    header['origin'] = affine[:3, 3]
+    header['voxel_size'] = zooms
+    header['image_orientation_patient'] = rotation[:, 0:2].T.ravel()
 
-    tracts_data = {}
-    for i, sn in enumerate(scalar_names):
-        tracts_data[sn] = [scalar[:, i][:, None] for scalar in scalars]
 
+def _trk_to_ras_affine(header):
+    r'''
+    Affine transform from TrackVis voxmm coordinates to RAS mm
+    '''
     affine = header['vox_to_ras']
-    image_dims = header['dim']
+    if numpy.all(affine == 0) or affine[3, 3] == 0:
+        raise IOError('TrackVis file without a voxel to RAS affine transform')
+    zooms = header['voxel_size']
+    return numpy.dot(
+        affine, numpy.diag((1. / zooms).tolist() + [1])
+    ).astype('f4')
 
-    tr = Tractography(
-        tracts, tracts_data,
-        affine=affine, image_dims=image_dims
+
+def _names(names, number_of_values, default):
+    r'''
+    Data names from the TrackVis name fields. A name with the form
+    name\0<n> labels n consecutive values.
+    '''
+    result = []
+    number_of_named_values = 0
+    for name in names:
+        if number_of_named_values >= number_of_values:
+            break
+        if '\x00' in name:
+            name, count = name.split('\x00', 1)
+            count = int(count) if count.isdigit() else 1
+        else:
+            count = 1
+        if len(name) == 0:
+            name = default % len(result)
+        result.append((name, count))
+        number_of_named_values += count
+
+    for i in xrange(number_of_values - number_of_named_values):
+        result.append((default % len(result), 1))
+    return result
+
+
+def _read_trk_header(file_):
+    r'''
+    TrackVis header and byte order of a file positioned at its start
+    '''
+    header_string = file_.read(TRK_HEADER_DTYPE.itemsize)
+    if (
+        len(header_string) != TRK_HEADER_DTYPE.itemsize or
+        not header_string.startswith('TRACK')
+    ):
+        raise IOError('%s is not a TrackVis file' % file_.name)
+    header = numpy.frombuffer(
+        header_string, dtype=TRK_HEADER_DTYPE
+    ).reshape(()).copy()
+    if header['hdr_size'] == TRK_HEADER_DTYPE.itemsize:
+        byte_order = '='
+    else:
+        header = header.newbyteorder()
+        if header['hdr_size'] != TRK_HEADER_DTYPE.itemsize:
+            raise IOError('Invalid TrackVis header size')
+        byte_order = '>' if numpy.little_endian else '<'
+    if header['version'] not in (1, 2):
+        raise IOError('TrackVis file version not supported')
+    return header, byte_order
+
+
+def _trk_record_starts(words, header):
+    r'''
+    Position of the record of each tract in the body of a TrackVis
+    file read as int32 words
+    '''
+    point_size = 3 + int(header['n_scalars'])
+    number_of_properties = int(header['n_properties'])
+    number_of_tracts = int(header['n_count'])
+    if number_of_tracts < 0:
+        raise IOError('Negative number of tracts in the TrackVis file')
+
+    # The point counts are the only small positive integers when
+    # the float32 points and scalars are read as int32
+    def record_length(counts):
+        return 1 + numpy.asarray(counts, dtype=int) * point_size + number_of_properties
+
+    size = len(words)
+    candidates = numpy.flatnonzero((words > 0) & (words < size))
+    try:
+        return record_starts(
+            words, candidates, record_length,
+            number_of_tracts if number_of_tracts > 0 else None
+        )
+    except ValueError:
+        raise IOError('Tracts in the TrackVis file are inconsistent')
+
+
+def _trk_points_to_tracts(points, offsets, header, lazy=False):
+    r'''
+    Tracts in RAS mm space and their scalars from the packed
+    points and scalars of a TrackVis file
+    '''
+    # As nibabel, points can not be put in RAS mm space without the
+    # voxel to RAS affine transform of a version 2 header
+    if header['version'] != 2:
+        raise IOError('TrackVis file without a voxel to RAS affine transform')
+    trk_to_ras = _trk_to_ras_affine(header)
+    xyz = numpy.dot(points[:, :3], trk_to_ras[:3, :3].T)
+    xyz += trk_to_ras[:3, 3]
+
+    tracts = split_packed(xyz, offsets)
+
+    if lazy:
+        tracts_data = LazyTractsData(offsets)
+    else:
+        tracts_data = {}
+    column = 3
+    for name, count in _names(
+        header['scalar_name'], int(header['n_scalars']), 'scalar_%02d'
+    ):
+        if lazy:
+            tracts_data.add_field(
+                name, partial(_columns, points, column, column + count)
+            )
+        else:
+            tracts_data[name] = split_packed(
+                _columns(points, column, column + count), offsets
+            )
+        column += count
+
+    return tracts, tracts_data
+
+
+def _columns(array, start, stop):
+    return numpy.ascontiguousarray(array[:, start: stop], dtype='f4')
+
+
+def read_trk(filename, lazy=False):
+    r'''
+    Reads a TrackVis file, with points in RAS mm space.
+    Points, scalars and properties are stored as float32.
+
+    Parameters
+    ----------
+    filename : str
+        TrackVis filename
+    lazy : bool
+        Return the scalars as a LazyTractsData, which are then split
+        into the tracts on their first access
+
+    Returns
+    -------
+    tracts : list of float32 array N_ix3
+        Each element of the list is a tract represented as point array,
+        the length of the i-th tract is N_i
+    tract_data : dict of <data name>= list of float32 array of N_ixM
+        The scalars of each tract.
+    tract_properties : dict of <property name>= float32 array of T x M
+        The properties of each tract.
+    header : numpy record
+        TrackVis header
+    '''
+    with open(filename, 'rb') as file_:
+        header, byte_order = _read_trk_header(file_)
+        words = numpy.fromfile(file_, dtype=byte_order + 'i4')
+
+    number_of_properties = int(header['n_properties'])
+    point_size = 3 + int(header['n_scalars'])
+    starts = _trk_record_starts(words, header)
+
+    size = len(words)
+    counts = words[starts].astype(int)
+    offsets = lengths_to_offsets(counts)
+    values = words.view(byte_order + 'f4')
+
+    point_words = numpy.zeros(size + 1, dtype=numpy.int8)
+    point_words[starts + 1] = 1
+    point_words[starts + 1 + counts * point_size] -= 1
+    point_words = numpy.cumsum(point_words[:-1], dtype=numpy.int8).view(bool)
+    points = values[point_words].reshape(-1, point_size)
+
+    properties_positions = (
+        (starts + 1 + counts * point_size)[:, None] +
+        numpy.arange(number_of_properties)
     )
+    properties = values[properties_positions].astype('f4')
 
-    return tr
+    tracts, tracts_data = _trk_points_to_tracts(
+        points, offsets, header, lazy=lazy
+    )
+
+    tract_properties = {}
+    column = 0
+    for name, count in _names(
+        header['property_name'], number_of_properties, 'property_%02d'
+    ):
+        tract_properties[name] = properties[:, column: column + count]
+        column += count
+
+    return tracts, tracts_data, tract_properties, header
+
+
+def build_trk_offset_index(filename):
+    r'''
+    Scans a TrackVis file for the position of its tracts
+
+    Parameters
+    ----------
+    filename : str
+        TrackVis filename
+
+    Returns
+    -------
+    index : dict of <key>=array
+        starts holds the byte offset of the points of each tract
+        and counts their number of points
+    '''
+    with open(filename, 'rb') as file_:
+        header, byte_order = _read_trk_header(file_)
+        words = numpy.fromfile(file_, dtype=byte_order + 'i4')
+
+    starts = _trk_record_starts(words, header)
+    return {
+        'starts': TRK_HEADER_DTYPE.itemsize + 4 * (starts + 1),
+        'counts': words[starts].astype(int)
+    }
+
+
+def read_trk_tracts(filename, indices):
+    r'''
+    Reads some of the tracts of a TrackVis file, and their scalars,
+    through the offset index of the file. Only the requested tracts
+    are read, adjacent ones at once.
+
+    Parameters
+    ----------
+    filename : str
+        TrackVis filename
+    indices : array of int
+        Indices of the tracts to read
+
+    Returns
+    -------
+    tracts : list of float32 array N_ix3
+        The requested tracts in the order of indices
+    tract_data : dict of <data name>= list of float32 array of N_ixM
+        The scalars of each tract.
+    header : numpy record
+        TrackVis header
+    '''
+    index = load_offset_index(filename, build_trk_offset_index)
+    indices = numpy.asarray(indices, dtype=int).ravel()
+    number_of_tracts = len(index['counts'])
+    if len(indices) > 0 and (
+        indices.min() < -number_of_tracts or indices.max() >= number_of_tracts
+    ):
+        raise IndexError('Tract indices out of range')
+
+    with open(filename, 'rb') as file_:
+        header, byte_order = _read_trk_header(file_)
+        point_size = 3 + int(header['n_scalars'])
+        counts = index['counts'][indices]
+        chunks = read_ranges(
+            file_, index['starts'][indices], counts * point_size * 4
+        )
+
+    points = numpy.frombuffer(
+        ''.join(chunks), dtype=byte_order + 'f4'
+    ).reshape(-1, point_size)
+    tracts, tracts_data = _trk_points_to_tracts(
+        points, lengths_to_offsets(counts), header
+    )
+    return tracts, tracts_data, header
+
+
+def _stack_values(values, number_of_items, kind):
+    r'''
+    Values as a float32 array of number_of_items rows, sorted by name,
+    and their TrackVis names
+    '''
+    if len(values) > 10:
+        raise ValueError('At most 10 %s permitted in a TrackVis file' % kind)
+
+    names = []
+    columns = []
+    for name in sorted(values):
+        value = numpy.asarray(values[name], dtype='f4')
+        if value.size % max(number_of_items, 1) != 0 or (
+            number_of_items > 0 and value.size == 0
+        ):
+            raise ValueError(
+                "Data in %s does not have the correct number of items" % name
+            )
+        value = value.reshape(number_of_items, -1)
+        if value.shape[1] > 1:
+            suffix = '\x00%d' % value.shape[1]
+            name = name[:20 - len(suffix)] + suffix
+        names.append(name[:20])
+        columns.append(value)
+
+    if len(columns) == 0:
+        return numpy.empty((number_of_items, 0), dtype='f4'), names
+    return numpy.hstack(columns), names
+
+
+def write_trk(filename, tracts, tracts_data={}, header=None, tract_properties={}):
+    r'''
+    Writes tracts in RAS mm space, their data and properties as a
+    TrackVis file. All values are stored as float32.
+
+    Parameters
+    ----------
+    filename : str
+        TrackVis filename
+    tracts : list of float array N_ix3
+        Each element of the list is a tract represented as point array,
+        the length of the i-th tract is N_i
+    tract_data : dict of <data name>= list of float array of N_ixM
+        Each element in the list corresponds to a tract,
+        N_i is the length of the i-th tract. At most 10 are
+        stored as the scalars of the points.
+    header : numpy record
+        TrackVis header with the voxel to RAS affine transform set
+    tract_properties : dict of <property name>= float array of T x M
+        At most 10 are stored as the properties of the tracts.
+    '''
+    if header is None:
+        header = empty_trk_header()
+    else:
+        header = numpy.array(header, dtype=TRK_HEADER_DTYPE)
+
+    points, offsets = pack(tracts)
+    points = points.reshape(-1, 3)
+    number_of_tracts = len(tracts)
+    number_of_points = len(points)
+    counts = numpy.diff(offsets)
+
+    scalars, scalar_names = _stack_values(
+        dict(
+            (k, packed_tracts_data(tracts_data, k))
+            for k in array_fields(tracts_data)
+        ),
+        number_of_points, 'scalars'
+    )
+    properties, property_names = _stack_values(
+        tract_properties, number_of_tracts, 'properties'
+    )
+
+    header['n_count'] = number_of_tracts
+    header['n_scalars'] = scalars.shape[1]
+    header['n_properties'] = properties.shape[1]
+    header['scalar_name'] = ''
+    header['scalar_name'][:len(scalar_names)] = scalar_names
+    header['property_name'] = ''
+    header['property_name'][:len(property_names)] = property_names
+
+    ras_to_trk = numpy.dot(
+        numpy.diag(header['voxel_size'].tolist() + [1]),
+        numpy.linalg.inv(header['vox_to_ras'])
+    ).astype('f4')
+
+    point_size = 3 + scalars.shape[1]
+    point_values = numpy.empty((number_of_points, point_size), dtype='<f4')
+    point_values[:, :3] = numpy.dot(points, ras_to_trk[:3, :3].T)
+    point_values[:, :3] += ras_to_trk[:3, 3]
+    point_values[:, 3:] = scalars
+
+    number_of_properties = properties.shape[1]
+    record_lengths = 1 + counts * point_size + number_of_properties
+    starts = lengths_to_offsets(record_lengths)[:-1]
+
+    words = numpy.empty(record_lengths.sum(), dtype='<f4')
+    point_words = numpy.zeros(len(words) + 1, dtype=numpy.int8)
+    point_words[starts + 1] = 1
+    point_words[starts + 1 + counts * point_size] -= 1
+    point_words = numpy.cumsum(point_words[:-1], dtype=numpy.int8).view(bool)
+    words[point_words] = point_values.ravel()
+    words.view('<i4')[starts] = counts
+    if number_of_properties > 0:
+        properties_positions = (
+            (starts + 1 + counts * point_size)[:, None] +
+            numpy.arange(number_of_properties)
+        )
+        words[properties_positions] = properties
+
+    header = header.astype(TRK_HEADER_DTYPE.newbyteorder('<'))
+
+    with open(filename, 'wb') as file_:
+        file_.write(header.tostring())
+        words.tofile(file_)
@@ -1,6 +1,307 @@
+from collections import MutableMapping
+from functools import partial
+from itertools import imap
+from operator import attrgetter
+
 import numpy as np
 
-__all__ = ['Tractography']
+from .packed import (
+    pack, split_packed, lengths_to_offsets, subsample_indices,
+    arc_length_samples, affine_transform_points
+)
+from . import features
+
+__all__ = [
+    'Tractography', 'LazyTractsData', 'TractFeatures', 'packed_tracts_data',
+    'array_fields'
+]
+
+
+class LazyTractsData(MutableMapping):
+
+    r"""
+    Tract data whose fields are decoded on their first access
+
+    Readers add each field as a loader returning the field packed as
+    a single array, which is split into the per tract list when the
+    field is accessed. Writers can get the packed array of a field
+    which has not been accessed without decoding it,
+    see packed_tracts_data.
+
+    Parameters
+    ----------
+    offsets : array of int of length T + 1
+        Offsets of the tracts in the packed fields
+    tracts_data : dict of <data name>= list of float array of N_ixM or str
+        Fields which are already decoded
+    """
+
+    def __init__(self, offsets, tracts_data=None):
+        self._offsets = offsets
+        self._loaders = {}
+        self._data = dict(tracts_data or {})
+
+    @property
+    def offsets(self):
+        r"""
+        Offsets of the tracts in the packed fields
+        """
+        return self._offsets
+
+    def add_field(self, name, loader):
+        r"""
+        Adds a field decoded on its first access
+
+        Parameters
+        ----------
+        name : str
+        loader : callable
+            Returns the field packed as an array of NxM
+        """
+        self._data.pop(name, None)
+        self._loaders[name] = loader
+
+    def is_loaded(self, name):
+        return name not in self._loaders
+
+    def copy(self):
+        tracts_data = LazyTractsData(self._offsets, self._data)
+        tracts_data._loaders = dict(self._loaders)
+        return tracts_data
+
+    def packed_field(self, name):
+        r"""
+        The field packed as an array of NxM, without decoding it into
+        the per tract list if it has not been accessed yet
+        """
+        if name in self._loaders:
+            array = np.asarray(self._loaders[name]())
+            if array.ndim == 1:
+                array = array[:, None]
+            return array
+        return pack(self._data[name])[0]
+
+    def __getitem__(self, name):
+        if name in self._loaders:
+            self._data[name] = split_packed(
+                self.packed_field(name), self._offsets
+            )
+            del self._loaders[name]
+        return self._data[name]
+
+    def __setitem__(self, name, value):
+        self._loaders.pop(name, None)
+        self._data[name] = value
+
+    def __delitem__(self, name):
+        if name in self._loaders:
+            del self._loaders[name]
+        else:
+            del self._data[name]
+
+    def __contains__(self, name):
+        return name in self._data or name in self._loaders
+
+    def __iter__(self):
+        # Accessing a field while iterating moves it to the decoded ones
+        return iter(list(self._data) + list(self._loaders))
+
+    def __len__(self):
+        return len(self._data) + len(self._loaders)
+
+    def __repr__(self):
+        return 'LazyTractsData(%s)' % sorted(self)
+
+
+def array_fields(tracts_data):
+    r"""
+    Names of the fields of tract data holding arrays, as opposed to
+    strings such as ActiveScalars, without decoding lazy fields
+    """
+    return [
+        name for name in tracts_data
+        if (
+            isinstance(tracts_data, LazyTractsData) and
+            not tracts_data.is_loaded(name)
+        ) or not isinstance(tracts_data[name], str)
+    ]
+
+
+def packed_tracts_data(tracts_data, name, dtype=None):
+    r"""
+    A tract data field packed as a single array. Fields of a
+    LazyTractsData which have not been accessed are read from their
+    source instead of being decoded into per tract lists.
+
+    Parameters
+    ----------
+    tracts_data : dict of <data name>= list of float array of N_ixM
+    name : str
+    dtype : numpy dtype, optional
+
+    Returns
+    -------
+    packed : array of NxM or of length N
+    """
+    if isinstance(tracts_data, LazyTractsData) and not tracts_data.is_loaded(name):
+        packed = tracts_data.packed_field(name)
+        if dtype is not None:
+            packed = np.ascontiguousarray(packed, dtype=dtype)
+        return packed
+    return pack(tracts_data[name], dtype=dtype)[0]
+
+
+class TractFeatures(object):
+
+    r"""
+    Features of each tract of a set, computed at once over the packed
+    points of the tracts on their first access. They are the arguments
+    of the vectorized criteria of Tractography.filter_tracts and are
+    cached by Tractography.tract_features.
+
+    Parameters
+    ----------
+    tracts : list of float array :math:`N_i\times 3`
+    tracts_data : dict of <data name>= list of float array of :math:`N_i\times M`
+    """
+
+    def __init__(self, tracts, tracts_data=None):
+        self._tracts = tracts
+        self._tracts_data = {} if tracts_data is None else tracts_data
+        self._packed = None
+        self._features = {}
+
+    def __len__(self):
+        return len(self._tracts)
+
+    def _packed_tracts(self):
+        if self._packed is None:
+            self._packed = pack(self._tracts)
+        return self._packed
+
+    @property
+    def offsets(self):
+        return self._packed_tracts()[1]
+
+    def _feature(self, name, compute):
+        if name not in self._features:
+            self._features[name] = compute(*self._packed_tracts())
+        return self._features[name]
+
+    def computed(self):
+        r"""
+        Features computed so far, as a dict of <feature name>=array,
+        means are named mean:<data name>
+        """
+        return dict(self._features)
+
+    def update(self, computed):
+        r"""
+        Sets features computed beforehand, for instance the ones saved
+        next to the file of the tracts. Features which do not have one
+        element per tract are ignored.
+
+        Parameters
+        ----------
+        computed : dict of <feature name>=array
+            As returned by computed
+        """
+        for name, value in computed.iteritems():
+            if len(value) == len(self):
+                self._features[name] = value
+
+    @property
+    def point_counts(self):
+        r"""
+        Number of points of each tract, array of int of length T
+        """
+        return features.tract_point_counts(self.offsets)
+
+    @property
+    def lengths(self):
+        r"""
+        Length of each tract, array of float of length T
+        """
+        return self._feature('lengths', features.tract_lengths)
+
+    @property
+    def mean_steps(self):
+        r"""
+        Mean distance between consecutive points of each tract, array
+        of float of length T, NaN for tracts of less than two points
+        """
+        segments = (self.point_counts - 1).astype(float)
+        segments[segments < 1] = np.nan
+        return self.lengths / segments
+
+    @property
+    def step_ranges(self):
+        r"""
+        Shortest and longest distance between consecutive points of
+        each tract, array of Tx2
+        """
+        return self._feature('step_ranges', features.tract_step_ranges)
+
+    @property
+    def bounding_boxes(self):
+        r"""
+        Bounding box of each tract, array of Tx6 ordered as a BoundingBox
+        """
+        return self._feature('bounding_boxes', features.tract_bounding_boxes)
+
+    @property
+    def endpoints(self):
+        r"""
+        First and last points of each tract, array of Tx2x3
+        """
+        return self._feature('endpoints', features.tract_endpoints)
+
+    def mean(self, name):
+        r"""
+        Mean of a tract data field over the points of each tract,
+        array of TxM
+        """
+        if 'mean:' + name not in self._features:
+            self._features['mean:' + name] = features.tract_means(
+                packed_tracts_data(self._tracts_data, name), self.offsets
+            )
+        return self._features['mean:' + name]
+
+
+def _tract_mask(selection, number_of_tracts):
+    r"""
+    Boolean mask of the tracts from a mask or an array of tract indices
+    """
+    selection = np.asarray(selection)
+    if selection.dtype == bool:
+        if selection.shape != (number_of_tracts,):
+            raise ValueError(
+                'The tract mask must have one element per tract'
+            )
+        return selection
+    if len(selection) > 0 and not np.issubdtype(selection.dtype, np.integer):
+        raise ValueError('Tracts must be selected by a mask or by indices')
+    mask = np.zeros(number_of_tracts, dtype=bool)
+    mask[selection.astype(int)] = True
+    return mask
+
+
+def _gather_tracts(tracts, tracts_data, name, mask, tract_map):
+    r"""
+    Single packed array of the tracts, or of the tract data field name,
+    selected by mask
+    """
+    if name is None:
+        arrays = tracts
+    elif (
+        isinstance(tracts_data, LazyTractsData) and
+        not tracts_data.is_loaded(name)
+    ):
+        lengths = np.diff(tracts_data.offsets)
+        return tracts_data.packed_field(name)[np.repeat(mask, lengths)]
+    else:
+        arrays = tracts_data[name]
+    return pack([arrays[i] for i in tract_map.tolist()])[0]
 
 
 class Tractography:
@@ -17,19 +318,32 @@ class Tractography:
         Each element in the list corresponds to a tract,
         :math:`N_i` is the length of the i-th tract and M is the
         number of components of that data type.
-    validate : bool
-        Check that tracts and tracts_data are valid
+    validate : bool or str
+        Check that tracts and tracts_data are valid, 'fast' only checks
+        the number of elements of the data and the first tract, for
+        tracts which are known to be consistent such as the ones read
+        from a file, True or 'full' checks every tract
+    dtype : numpy dtype, optional
+        If given, the points of the tracts are converted to it, for
+        instance numpy.float32 halves the memory used by the tracts
     """
 
-    def __init__(self, tracts=None, tracts_data=None, validate=True, **kwargs):
+    def __init__(
+        self, tracts=None, tracts_data=None, validate=True, dtype=None,
+        **kwargs
+    ):
         if tracts is not None and tracts_data is None:
             tracts_data = {}
         self._tracts = []
+        self._dtype = None if dtype is None else np.dtype(dtype)
         self._quantity_of_points_per_tract = None
+        self._subsampling_mode = 'index'
 
         self._tract_map = None
         self._subsampled_tracts = None
         self._subsampled_data = None
+        self._tract_features = None
+        self._affine_transform = None
 
         self._extra_args = []
         for k, v in kwargs.items():
@@ -40,6 +354,13 @@ class Tractography:
         if tracts is not None:
             self.append(tracts, tracts_data, validate=validate)
 
+    @property
+    def dtype(self):
+        r"""
+        Type of the points of the tracts if it was set, None otherwise
+        """
+        return self._dtype
+
     @property
     def extra_args(self):
         ret = {}
@@ -60,55 +381,40 @@ class Tractography:
             Each element in the list corresponds to a tract,
             :math:`N_i` is the length of the i-th tract and M is the
             number of components of that data type.
-        validate : bool
-            Check that tracts and tracts_data are valid
+        validate : bool or str
+            Check that tracts and tracts_data are valid, 'fast' only
+            checks the number of elements of the data and the first
+            tract, True or 'full' checks every tract
         """
         if tracts_data is None:
             tracts_data = {}
+        # The pending transform only applies to the current tracts
+        self._apply_affine_transform()
+
+        if validate:
+            _validate(tracts, tracts_data, full=(validate != 'fast'))
+
+        if self._dtype is not None:
+            tracts = _astype(tracts, self._dtype)
+        self._tract_features = None
 
         if len(self._tracts) == 0:
-            self._tracts = tracts
-            self._tracts_data = tracts_data
+            # The lists are copied as they are extended by later appends,
+            # lazy fields are only decoded when they are appended to
+            self._tracts = list(tracts)
+            if isinstance(tracts_data, LazyTractsData):
+                self._tracts_data = tracts_data
+            else:
+                self._tracts_data = dict(
+                    (k, v if isinstance(v, str) else list(v))
+                    for k, v in tracts_data.iteritems()
+                )
             appending = False
         else:
             appending = True
 
-        if validate:
-            if tracts is not None:
-                try:
-                    if any(
-                        not (
-                            t.ndim == 2 and
-                            t.shape[1] == 3
-                        ) for t in tracts
-                    ):
-                        raise ValueError(
-                            'First argument is not a list of tracts')
-                except AttributeError:
-                    raise ValueError('First argument is not a list of tracts')
-
-                if tracts_data is not None and hasattr(tracts_data, 'iteritems'):
-                    for k, v in tracts_data.iteritems():
-                        if isinstance(v, str):
-                            continue
-                        if len(v) != len(tracts):
-                            raise ValueError(
-                                'Number of elements in attribute %s must '
-                                'be the same as the number of tracts' % k
-                            )
-                        _, M = v[0].shape
-                        for i, tract_v in enumerate(v):
-                            N, tract_M = tract_v.shape
-                            if (
-                                (N != len(tracts[i])) or
-                                (tract_M != M)
-                            ):
-                                raise ValueError(
-                                    "Data for tract %s: %d is inconsistent" % (
-                                        k, i)
-                                )
         if appending:
-            if tracts_data.keys() != self._tracts_data.keys():
+            if set(tracts_data.keys()) != set(self._tracts_data.keys()):
                 raise ValueError("Tract data to append not compatible")
             if any(
                 self._tracts_data[k][0].shape[1] != v[0].shape[1]
@@ -118,14 +424,25 @@ class Tractography:
                 raise ValueError("Tract data to append not compatible")
 
             for k, v in tracts_data.iteritems():
-                self._tracts_data[k] += v
+                if not isinstance(v, str):
+                    self._tracts_data[k] += v
 
+            first_new_tract = len(self._tracts)
             self._tracts += tracts
 
+            # Only the new tracts are subsampled and filtered
             if self.are_tracts_subsampled():
-                self.subsample_tracts(self._quantity_of_points_per_tract)
+                tracts, tracts_data = self._subsample(tracts, tracts_data)
+                self._subsampled_tracts += tracts
+                _extend_data(self._subsampled_data, tracts_data)
             if self.are_tracts_filtered():
-                self.filter_tracts(self._criterium)
+                tract_map, tracts, tracts_data = self._filter(
+                    tracts, tracts_data,
+                    self._criterium(tracts, tracts_data), first_new_tract
+                )
+                self._tract_map = np.r_[self._tract_map, tract_map]
+                self._filtered_tracts += tracts
+                _extend_data(self._filtered_data, tracts_data)
 
     def unsubsample_tracts(self):
         r"""
@@ -133,6 +450,7 @@ class Tractography:
         """
         self._subsampled_tracts = None
         self._subsampled_data = None
+        self._tract_features = None
 
     def unfilter_tracts(self):
         r"""
@@ -140,8 +458,9 @@ class Tractography:
         """
 
         self._tract_map = None
+        self._tract_features = None
 
-    def subsample_tracts(self, points_per_tract):
+    def subsample_tracts(self, points_per_tract, mode='index'):
         r"""
         Subsample the tracts in the dataset to a maximum number of
         points per tract
@@ -151,62 +470,174 @@ class Tractography:
         points_per_tract: int
             Maximum number of points per tract after the operation
             is executed
+        mode: str
+            'index' keeps points evenly spaced in the order of the
+            points of each tract, 'arc_length' interpolates points and
+            data evenly spaced along the length of each tract, which
+            is not biased towards the regions of a tract sampled with
+            shorter steps
         """
+        if mode not in ('index', 'arc_length'):
+            raise ValueError('Subsampling mode %s not supported' % mode)
+        self._apply_affine_transform()
         self._quantity_of_points_per_tract = points_per_tract
-        self._subsampled_tracts = []
-        self._subsampled_data = {}
-
-        for k in self._tracts_data:
-            self._subsampled_data[k] = []
-
-        for i in xrange(len(self._tracts)):
-            f = self._tracts[i]
-            s = np.linspace(
-                0,
-                f.shape[0] - 1,
-                min(f.shape[0], self._quantity_of_points_per_tract)
-            ).round().astype(int)
-
-            self._subsampled_tracts.append(f[s, :])
-
-            for k, v in self._tracts_data.iteritems():
-                if not isinstance(v, str):
-                    self._subsampled_data[k].append(v[i][s])
+        self._subsampling_mode = mode
+        self._subsampled_tracts, self._subsampled_data = self._subsample(
+            self._tracts, self._tracts_data
+        )
+        self._interpolated = mode == 'arc_length'
+        self._tract_features = None
 
-        self._interpolated = False
+    def _subsample(self, tracts, tracts_data):
+        r"""
+        Subsampled tracts and data, views on a single packed array per
+        field, computed with one gather over all the tracts
+        """
+        points, offsets = pack(tracts)
+        if self._subsampling_mode == 'arc_length':
+            indices, next_indices, fractions, new_offsets = arc_length_samples(
+                points, offsets, self._quantity_of_points_per_tract
+            )
+
+            def gather(values):
+                weights = fractions.reshape((-1,) + (1,) * (values.ndim - 1))
+                return (
+                    values[indices] * (1 - weights) +
+                    values[next_indices] * weights
+                ).astype(values.dtype, copy=False)
+        else:
+            indices, new_offsets = subsample_indices(
+                offsets, self._quantity_of_points_per_tract
+            )
+
+            def gather(values):
+                return values[indices]
+
+        subsampled_tracts = split_packed(gather(points), new_offsets)
+        subsampled_data = _gather_data(
+            tracts_data,
+            lambda name: gather(packed_tracts_data(tracts_data, name)),
+            new_offsets
+        )
+        return subsampled_tracts, subsampled_data
 
-    def filter_tracts(self, criterium):
+    def filter_tracts(self, criterium, vectorized=False):
         r"""
-        Filter the tracts in the set according to a criterium function
+        Filter the tracts in the set according to a criterium. The
+        filtered tracts are views on a single packed array and
+        filtered_tracts_map gives their indices in the original set.
 
         Parameters
         ----------
 
-        criterium : function of array :math:`N\times 3` -> Bool
+        criterium : function, array of bool or array of int
             A function taking a tract as an array of
             3D points and returning True or False with
-            specifying if it should be included
+            specifying if it should be included.
+            If vectorized is True, a function taking the TractFeatures
+            of the tracts and returning a boolean array with one
+            element per tract, for instance
+            ``lambda features: features.lengths > 20``.
+            Otherwise a boolean mask over the tracts or the indices of
+            the tracts to include, tracts appended later are excluded.
+        vectorized : bool
+            Whether criterium is evaluated on all the tracts at once
         """
-        if len(self._subsampled_tracts) > 0:
+        self._apply_affine_transform()
+        if self._subsampled_tracts is not None:
             tracts = self._subsampled_tracts
             data = self._subsampled_data
         else:
             tracts = self._tracts
-            data = self._data
+            data = self._tracts_data
 
-        self._tract_map = filter(
-            lambda i: criterium(tracts),
-            xrange(len(tracts))
+        if not callable(criterium):
+            mask = _tract_mask(criterium, len(tracts))
+            criterium = lambda tracts, tracts_data: np.zeros(
+                len(tracts), dtype=bool
+            )
+        else:
+            if vectorized:
+                criterium = _vectorized_criterium(criterium)
+            else:
+                criterium = _tract_criterium(criterium)
+            if vectorized and self._tract_map is None:
+                # The tracts to filter are the ones of tract_features
+                mask = criterium(tracts, data, self.tract_features())
+            else:
+                mask = criterium(tracts, data)
+
+        self._tract_map, self._filtered_tracts, self._filtered_data = (
+            self._filter(tracts, data, mask)
         )
+        self._criterium = criterium
+        self._tract_features = None
 
-        self._filtered_tracts = [tracts[i] for i in self._tract_map]
-        self._filtered_data = {}
-        for k, v in data.iteritems():
-            self._filtered_data[k] = [
-                v[i] for i in self._tract_map
-            ]
+    def _filter(self, tracts, tracts_data, mask, first_tract=0):
+        tract_map = np.flatnonzero(mask)
+        new_offsets = lengths_to_offsets(
+            [len(tracts[i]) for i in tract_map.tolist()]
+        )
 
-        self._criterium = criterium
+        filtered_tracts = split_packed(
+            _gather_tracts(tracts, tracts_data, None, mask, tract_map),
+            new_offsets
+        )
+        filtered_data = _gather_data(
+            tracts_data,
+            lambda name: _gather_tracts(
+                tracts, tracts_data, name, mask, tract_map
+            ),
+            new_offsets
+        )
+
+        return tract_map + first_tract, filtered_tracts, filtered_data
+
+    def affine_transform(self, affine):
+        r"""
+        Applies an affine transform to the points of the tracts. The
+        transform is composed with the ones still pending and the points
+        are transformed all at once the next time they are read, so a
+        chain of transforms copies them a single time.
+
+        Parameters
+        ----------
+        affine : array_like, :math:`4\times 4`
+            Affine transform in RAS space, the tract data is not
+            transformed
+        """
+        affine = np.asarray(affine, dtype=float)
+        if affine.shape != (4, 4):
+            raise ValueError('The affine transform must be a 4x4 matrix')
+        if self._affine_transform is not None:
+            affine = np.dot(affine, self._affine_transform)
+        self._affine_transform = affine
+        self._tract_features = None
+
+    def pending_affine_transform(self):
+        r"""
+        Affine transform not applied to the points of the tracts yet
+
+        Returns
+        -------
+        affine : array of :math:`4\times 4` or None
+        """
+        return self._affine_transform
+
+    def _apply_affine_transform(self):
+        affine = self._affine_transform
+        if affine is None:
+            return
+        self._affine_transform = None
+        self._tracts = _affine_transform_tracts(affine, self._tracts)
+        if self._subsampled_tracts is not None:
+            self._subsampled_tracts = _affine_transform_tracts(
+                affine, self._subsampled_tracts
+            )
+        if self._tract_map is not None:
+            self._filtered_tracts = _affine_transform_tracts(
+                affine, self._filtered_tracts
+            )
 
     def are_tracts_filtered(self):
         return self._tract_map is not None
@@ -226,6 +657,7 @@ class Tractography:
             Each element of the list is a tract represented as point array,
             the length of the i-th tract is :math:`N_i`
         """
+        self._apply_affine_transform()
         return self._tracts
 
     def original_tracts_data(self):
@@ -247,10 +679,26 @@ class Tractography:
 
         Returns
         -------
-        List of tract indices included after the filtering
+        tract_map : array of int
+            Index in the original tracts of each filtered tract
         """
         return self._tract_map
 
+    def tract_features(self):
+        r"""
+        Features of the tracts returned by tracts, computed on their
+        first access and kept until the tracts change
+
+        Returns
+        -------
+        features : TractFeatures
+        """
+        if self._tract_features is None:
+            self._tract_features = TractFeatures(
+                self.tracts(), self.tracts_data()
+            )
+        return self._tract_features
+
     def tracts(self):
         r"""
         Tracts contained in this tractography object after filtering and
@@ -262,6 +710,7 @@ class Tractography:
             Each element of the list is a tract represented as point array,
             the length of the i-th tract is :math:`N_i`
         """
+        self._apply_affine_transform()
         if self._tract_map is not None:
             return self._filtered_tracts
         elif self._subsampled_tracts is not None:
@@ -309,6 +758,163 @@ class Tractography:
         ]
 
         self.original_tracts_data()[name] = data
+        self._tract_features = None
 
         if self._subsampled_tracts is not None:
-            self.subsample_tracts(self._quantity_of_points_per_tract)
+            self.subsample_tracts(
+                self._quantity_of_points_per_tract,
+                mode=self._subsampling_mode
+            )
+
+
+def _tract_criterium(criterium):
+    r"""
+    Mask of the tracts from a function evaluated on each tract
+    """
+    def tract_mask(tracts, tracts_data, tract_features=None):
+        return np.fromiter(
+            imap(criterium, tracts), dtype=bool, count=len(tracts)
+        )
+    return tract_mask
+
+
+def _vectorized_criterium(criterium):
+    r"""
+    Mask of the tracts from a function evaluated on their TractFeatures
+    """
+    def tract_mask(tracts, tracts_data, tract_features=None):
+        if tract_features is None:
+            tract_features = TractFeatures(tracts, tracts_data)
+        return _tract_mask(
+            np.asarray(criterium(tract_features), dtype=bool), len(tracts)
+        )
+    return tract_mask
+
+
+def _affine_transform_tracts(affine, tracts):
+    r"""
+    Views on the transformed points of the tracts, transformed at once
+    """
+    if len(tracts) == 0:
+        return []
+    points, offsets = pack(tracts)
+    return split_packed(affine_transform_points(affine, points), offsets)
+
+
+def _gather_data(tracts_data, gather, new_offsets):
+    r"""
+    Tract data made of the packed arrays gather(name) of the fields of
+    tracts_data. The fields of a LazyTractsData which have not been
+    decoded are gathered on their first access.
+    """
+    lazy = isinstance(tracts_data, LazyTractsData)
+    gathered = LazyTractsData(new_offsets) if lazy else {}
+    arrays = array_fields(tracts_data)
+    for name in list(tracts_data):
+        if name not in arrays:
+            gathered[name] = tracts_data[name]
+        elif lazy and not tracts_data.is_loaded(name):
+            gathered.add_field(name, partial(gather, name))
+        else:
+            gathered[name] = split_packed(gather(name), new_offsets)
+    return gathered
+
+
+def _extend_data(tracts_data, new_tracts_data):
+    for k, v in new_tracts_data.iteritems():
+        if not isinstance(v, str):
+            tracts_data[k] += v
+
+
+def _shapes_and_lengths(arrays):
+    r'''
+    Set of the distinct shapes and array of the lengths of a list of
+    arrays, None if any of them is not an array
+    '''
+    try:
+        shapes = set(imap(attrgetter('shape'), arrays))
+    except AttributeError:
+        return None
+    lengths = np.fromiter(imap(len, arrays), int, len(arrays))
+    return shapes, lengths
+
+
+def _astype(tracts, dtype):
+    r'''
+    Tracts with points of the given type, converted at once
+    '''
+    if len(tracts) == 0 or set(imap(attrgetter('dtype'), tracts)) == set((dtype,)):
+        return tracts
+    points, offsets = pack(tracts, dtype=dtype)
+    return split_packed(points, offsets)
+
+
+def _validate(tracts, tracts_data, full=True):
+    r'''
+    Checks that tracts is a list of arrays of Nx3 and that tracts_data
+    has an array of NxM for each of them. Each list is scanned once for
+    the distinct shapes and the lengths of its arrays, the lengths are
+    compared as arrays.
+
+    Parameters
+    ----------
+    tracts : list of float array N_ix3
+    tracts_data : dict of <data name>= list of float array of N_ixM
+    full : bool
+        Check every tract, otherwise only the first one
+    '''
+    if tracts is None:
+        return
+
+    try:
+        number_of_tracts = len(tracts)
+    except TypeError:
+        raise ValueError('First argument is not a list of tracts')
+    if not full:
+        tracts = tracts[:1]
+    shapes_and_lengths = _shapes_and_lengths(tracts)
+    if shapes_and_lengths is None or any(
+        len(shape) != 2 or shape[1] != 3 for shape in shapes_and_lengths[0]
+    ):
+        raise ValueError('First argument is not a list of tracts')
+    lengths = shapes_and_lengths[1]
+
+    if not hasattr(tracts_data, 'iteritems'):
+        return
+
+    for k in tracts_data:
+        if (
+            isinstance(tracts_data, LazyTractsData) and
+            not tracts_data.is_loaded(k)
+        ):
+            # Fields are checked by their readers, do not decode them
+            continue
+        v = tracts_data[k]
+        if isinstance(v, str):
+            continue
+        if len(v) != number_of_tracts:
+            raise ValueError(
+                'Number of elements in attribute %s must '
+                'be the same as the number of tracts' % k
+            )
+        if not full:
+            v = v[:1]
+        shapes_and_lengths = _shapes_and_lengths(v)
+        if shapes_and_lengths is None:
+            raise ValueError("Data for tract %s is inconsistent" % k)
+        data_shapes, data_lengths = shapes_and_lengths
+        if (
+            all(len(shape) == 2 for shape in data_shapes) and
+            len(set(shape[1] for shape in data_shapes)) <= 1
+        ):
+            inconsistent = np.flatnonzero(data_lengths != lengths)
+        else:
+            number_of_components = v[0].shape[1:]
+            inconsistent = [
+                i for i, data in enumerate(v)
+                if data.shape[1:] != number_of_components or data.ndim != 2
+            ]
+        if len(inconsistent) > 0:
+            raise ValueError(
+                "Data for tract %s: %d is inconsistent" % (k, inconsistent[0])
+            )
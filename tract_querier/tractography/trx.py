@@ -0,0 +1,395 @@
+import json
+import os
+from functools import partial
+import shutil
+import struct
+import tempfile
+import zipfile
+
+import numpy as np
+
+from .tractography import (
+    Tractography, LazyTractsData, packed_tracts_data, array_fields
+)
+from .packed import pack, split_packed
+
+__all__ = [
+    'tractography_from_trx_file', 'tractography_to_trx_file',
+    'read_trx', 'write_trx', 'add_trx_groups'
+]
+
+TRX_TYPES = (
+    'int8', 'int16', 'int32', 'int64',
+    'uint8', 'uint16', 'uint32', 'uint64',
+    'float16', 'float32', 'float64'
+)
+
+# Size of the fixed part of a zip local file header, and the position
+# of the name and extra field lengths in it
+ZIP_LOCAL_HEADER_SIZE = 30
+ZIP_LOCAL_HEADER_LENGTHS = 26
+
+
+def tractography_from_trx_file(filename):
+    trx = read_trx(filename)
+    offsets = trx['offsets']
+
+    tracts = split_packed(trx['positions'], offsets)
+    tracts_data = LazyTractsData(offsets)
+    for name, array in trx['dpv'].iteritems():
+        tracts_data.add_field(name, partial(np.asarray, array))
+
+    return Tractography(
+        tracts, tracts_data, validate='fast',
+        affine=np.array(trx['header']['VOXEL_TO_RASMM'], dtype=float),
+        image_dims=np.array(trx['header']['DIMENSIONS'], dtype=int)
+    )
+
+
+def tractography_to_trx_file(
+    filename, tractography, affine=None, image_dimensions=None, groups={}
+):
+    if affine is None:
+        affine = getattr(tractography, 'affine', np.eye(4))
+    if image_dimensions is None:
+        image_dimensions = getattr(tractography, 'image_dims', np.ones(3))
+
+    return write_trx(
+        filename, tractography.tracts(), tractography.tracts_data(),
+        affine=affine, dimensions=image_dimensions, groups=groups
+    )
+
+
+def _array_name(path):
+    r'''
+    Name, number of components and dtype of a TRX array
+    from its file name, as in name.3.float32 or name.float32
+    '''
+    parts = os.path.basename(path).split('.')
+    if len(parts) < 2 or parts[-1] not in TRX_TYPES:
+        return None
+    if len(parts) > 2 and parts[-2].isdigit():
+        return '.'.join(parts[:-2]), int(parts[-2]), parts[-1]
+    return '.'.join(parts[:-1]), 1, parts[-1]
+
+
+def _file_name(name, number_of_components, dtype):
+    if number_of_components == 1:
+        return '%s.%s' % (name, np.dtype(dtype).name)
+    return '%s.%d.%s' % (name, number_of_components, np.dtype(dtype).name)
+
+
+def _map_array(filename, offset, size, dtype, number_of_components):
+    r'''
+    Read-only memory mapped array of size bytes at offset of a file
+    '''
+    dtype = np.dtype(dtype).newbyteorder('<')
+    number_of_items = size // (dtype.itemsize * number_of_components)
+    if number_of_items == 0:
+        return np.empty((0, number_of_components), dtype=dtype)
+    return np.asarray(np.memmap(
+        filename, dtype=dtype, mode='r', offset=offset,
+        shape=(number_of_items, number_of_components)
+    ))
+
+
+def _trx_members(filename):
+    r'''
+    Arrays and header of a TRX directory or zip file, the arrays are
+    memory mapped unless they are compressed in the zip file
+    '''
+    members = {}
+    header = None
+    if os.path.isdir(filename):
+        for root, _, files in os.walk(filename):
+            for name in files:
+                path = os.path.join(root, name)
+                relative_path = os.path.relpath(path, filename).replace(os.sep, '/')
+                if relative_path == 'header.json':
+                    with open(path) as file_:
+                        header = json.load(file_)
+                    continue
+                array_name = _array_name(relative_path)
+                if array_name is not None:
+                    members[relative_path] = _map_array(
+                        path, 0, os.path.getsize(path),
+                        array_name[2], array_name[1]
+                    )
+    else:
+        with zipfile.ZipFile(filename) as zip_file, open(filename, 'rb') as file_:
+            for info in zip_file.infolist():
+                if info.filename == 'header.json':
+                    header = json.loads(zip_file.read(info))
+                    continue
+                array_name = _array_name(info.filename)
+                if array_name is None:
+                    continue
+                if info.compress_type == zipfile.ZIP_STORED:
+                    file_.seek(info.header_offset + ZIP_LOCAL_HEADER_LENGTHS)
+                    name_length, extra_length = struct.unpack(
+                        '<HH', file_.read(4)
+                    )
+                    members[info.filename] = _map_array(
+                        filename,
+                        info.header_offset + ZIP_LOCAL_HEADER_SIZE +
+                        name_length + extra_length,
+                        info.file_size, array_name[2], array_name[1]
+                    )
+                else:
+                    members[info.filename] = np.frombuffer(
+                        zip_file.read(info),
+                        dtype=np.dtype(array_name[2]).newbyteorder('<')
+                    ).reshape(-1, array_name[1])
+
+    if header is None:
+        raise IOError('%s is not a TRX file, header.json not found' % filename)
+    return header, members
+
+
+def read_trx(filename):
+    r'''
+    Reads a TRX file, either a directory or a zip file. Uncompressed
+    arrays are memory mapped and not copied.
+
+    Parameters
+    ----------
+    filename : str
+        TRX directory or zip filename
+
+    Returns
+    -------
+    trx : dict
+        header : dict
+            Content of header.json
+        positions : array of Nx3
+            Points of all the tracts
+        offsets : array of int of length T + 1
+            The points of the i-th tract are positions[offsets[i]:offsets[i + 1]]
+        dpv : dict of <data name>= array of NxM
+            Data of each point
+        dps : dict of <data name>= array of TxM
+            Data of each tract
+        groups : dict of <group name>= array of int
+            Indices of the tracts in each group
+    '''
+    header, members = _trx_members(filename)
+    number_of_tracts = int(header['NB_STREAMLINES'])
+    number_of_points = int(header['NB_VERTICES'])
+
+    trx = {
+        'header': header, 'positions': None, 'offsets': None,
+        'dpv': {}, 'dps': {}, 'groups': {}
+    }
+    for path, array in members.iteritems():
+        folder = os.path.dirname(path)
+        name, number_of_components, _ = _array_name(path)
+        if folder == '' and name == 'positions':
+            trx['positions'] = array.reshape(-1, 3)
+        elif folder == '' and name == 'offsets':
+            trx['offsets'] = array.ravel()
+        elif folder == 'dpv':
+            trx['dpv'][name] = array
+        elif folder == 'dps':
+            trx['dps'][name] = array
+        elif folder == 'groups':
+            trx['groups'][name] = array.ravel()
+
+    if trx['positions'] is None or trx['offsets'] is None:
+        raise IOError('TRX file %s without positions or offsets' % filename)
+
+    offsets = trx['offsets'].astype(int)
+    if len(offsets) == number_of_tracts:
+        offsets = np.r_[offsets, number_of_points]
+    if (
+        len(offsets) != number_of_tracts + 1 or
+        len(trx['positions']) != number_of_points or
+        (number_of_tracts > 0 and (
+            offsets[0] != 0 or offsets[-1] != number_of_points or
+            np.any(offsets[1:] < offsets[:-1])
+        ))
+    ):
+        raise IOError('Offsets of the TRX file %s are inconsistent' % filename)
+    trx['offsets'] = offsets
+
+    for kind, number_of_items in (
+        ('dpv', number_of_points), ('dps', number_of_tracts)
+    ):
+        for name, array in trx[kind].iteritems():
+            if len(array) != number_of_items:
+                raise IOError(
+                    'Data %s of the TRX file %s does not have the correct '
+                    'number of items' % (name, filename)
+                )
+
+    return trx
+
+
+def _trx_arrays(tracts, tracts_data, dps, groups, dtype):
+    r'''
+    Relative paths and arrays stored in a TRX file
+    '''
+    positions, offsets = pack(tracts, dtype=dtype)
+    positions = positions.reshape(-1, 3)
+    number_of_points = len(positions)
+
+    arrays = [
+        (_file_name('positions', 3, dtype), positions),
+        (_file_name('offsets', 1, 'uint64'), offsets[:-1].astype('<u8')),
+    ]
+    for name in sorted(array_fields(tracts_data)):
+        value = packed_tracts_data(tracts_data, name, dtype=dtype)
+        if value.size % max(number_of_points, 1) != 0:
+            raise ValueError(
+                "Data in %s does not have the correct number of items" % name
+            )
+        value = value.reshape(number_of_points, -1)
+        arrays.append((
+            'dpv/' + _file_name(name, value.shape[1], dtype), value
+        ))
+    for name, value in sorted(dps.iteritems()):
+        value = np.asarray(value, dtype=dtype).reshape(len(tracts), -1)
+        arrays.append((
+            'dps/' + _file_name(name, value.shape[1], dtype), value
+        ))
+    for name, value in sorted(groups.iteritems()):
+        arrays.append((
+            'groups/' + _file_name(name, 1, 'uint32'),
+            np.asarray(list(value) if isinstance(value, set) else value).astype('<u4')
+        ))
+
+    return arrays, number_of_points
+
+
+def write_trx(
+    filename, tracts, tracts_data={}, affine=np.eye(4),
+    dimensions=(1, 1, 1), dps={}, groups={}, dtype='float32'
+):
+    r'''
+    Writes a TRX file. If the filename ends with .trx an uncompressed
+    zip file is written, otherwise a directory.
+
+    Parameters
+    ----------
+    filename : str
+        TRX filename
+    tracts : list of float array N_ix3
+        Each element of the list is a tract represented as point array,
+        the length of the i-th tract is N_i
+    tract_data : dict of <data name>= list of float array of N_ixM
+        Each element in the list corresponds to a tract,
+        N_i is the length of the i-th tract and M is the
+        number of components of that data type.
+    affine : array of 4x4
+        Voxel to RAS mm transform of the reference image
+    dimensions : sequence of 3 int
+        Dimensions of the reference image
+    dps : dict of <data name>= array of TxM
+        Data of each tract
+    groups : dict of <group name>= sequence of int
+        Indices of the tracts in each group
+    dtype : numpy dtype
+        Type of the stored points and data
+    '''
+    arrays, number_of_points = _trx_arrays(
+        tracts, tracts_data, dps, groups, dtype
+    )
+    header = json.dumps({
+        'VOXEL_TO_RASMM': np.asarray(affine, dtype=float).tolist(),
+        'DIMENSIONS': [int(d) for d in dimensions],
+        'NB_VERTICES': int(number_of_points),
+        'NB_STREAMLINES': len(tracts),
+    })
+
+    if filename.endswith('.trx'):
+        with zipfile.ZipFile(
+            filename, 'w', zipfile.ZIP_STORED, allowZip64=True
+        ) as zip_file:
+            zip_file.writestr('header.json', header)
+            for path, array in arrays:
+                zip_file.writestr(path, np.ascontiguousarray(array).tostring())
+    else:
+        if os.path.exists(filename):
+            # Only a previous TRX directory is replaced
+            if not os.path.isfile(os.path.join(filename, 'header.json')):
+                raise IOError(
+                    '%s exists and is not a TRX directory' % filename
+                )
+            shutil.rmtree(filename)
+        os.makedirs(filename)
+        with open(os.path.join(filename, 'header.json'), 'w') as file_:
+            file_.write(header)
+        for path, array in arrays:
+            path = os.path.join(filename, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            np.ascontiguousarray(array).tofile(path)
+
+
+def add_trx_groups(filename, groups):
+    r'''
+    Adds groups of tracts to an existing TRX file, replacing the
+    groups with the same names. The geometry is not rewritten unless
+    a group of a zip file is replaced.
+
+    Parameters
+    ----------
+    filename : str
+        TRX directory or zip filename
+    groups : dict of <group name>= sequence of int
+        Indices of the tracts in each group
+    '''
+    group_arrays = dict(
+        (
+            'groups/' + _file_name(name, 1, 'uint32'),
+            np.asarray(list(value) if isinstance(value, set) else value).astype('<u4')
+        )
+        for name, value in groups.iteritems()
+    )
+    group_names = set(groups)
+
+    if os.path.isdir(filename):
+        group_folder = os.path.join(filename, 'groups')
+        if not os.path.isdir(group_folder):
+            os.makedirs(group_folder)
+        for name in os.listdir(group_folder):
+            array_name = _array_name(name)
+            if array_name is not None and array_name[0] in group_names:
+                os.remove(os.path.join(group_folder, name))
+        for path, array in group_arrays.iteritems():
+            array.tofile(os.path.join(filename, *path.split('/')))
+        return
+
+    with zipfile.ZipFile(filename) as zip_file:
+        replaced = [
+            info for info in zip_file.infolist()
+            if os.path.dirname(info.filename) == 'groups' and
+            _array_name(info.filename) is not None and
+            _array_name(info.filename)[0] in group_names
+        ]
+
+    if len(replaced) == 0:
+        with zipfile.ZipFile(
+            filename, 'a', zipfile.ZIP_STORED, allowZip64=True
+        ) as zip_file:
+            for path, array in sorted(group_arrays.iteritems()):
+                zip_file.writestr(path, array.tostring())
+        return
+
+    replaced = set(info.filename for info in replaced)
+    file_descriptor, temporary_filename = tempfile.mkstemp(
+        '.trx', dir=os.path.dirname(os.path.abspath(filename))
+    )
+    os.close(file_descriptor)
+    try:
+        with zipfile.ZipFile(filename) as zip_file, zipfile.ZipFile(
+            temporary_filename, 'w', zipfile.ZIP_STORED, allowZip64=True
+        ) as new_zip_file:
+            for info in zip_file.infolist():
+                if info.filename not in replaced:
+                    new_zip_file.writestr(info, zip_file.read(info))
+            for path, array in sorted(group_arrays.iteritems()):
+                new_zip_file.writestr(path, array.tostring())
+        shutil.move(temporary_filename, filename)
+    finally:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
@@ -0,0 +1,660 @@
+import re
+from functools import partial
+from itertools import islice
+
+import numpy as np
+
+from .tractography import (
+    Tractography, LazyTractsData, packed_tracts_data, array_fields
+)
+from .packed import (
+    cell_array_to_offsets, offsets_to_cell_array, lines_to_tracts, pack,
+    lengths_to_offsets, split_packed, _contiguous_line_starts
+)
+from .offset_index import load_offset_index, read_ranges
+
+__all__ = [
+    'tractography_from_vtk_legacy_file', 'tractography_to_vtk_legacy_file',
+    'read_vtk_legacy', 'write_vtk_legacy',
+    'build_vtk_legacy_offset_index', 'read_vtk_legacy_tracts'
+]
+
+VTK_TYPES = {
+    'bit': 'u1',
+    'unsigned_char': 'u1', 'char': 'i1',
+    'unsigned_short': 'u2', 'short': 'i2',
+    'unsigned_int': 'u4', 'int': 'i4',
+    'unsigned_long': 'u8', 'long': 'i8',
+    'float': 'f4', 'double': 'f8',
+    'vtkidtype': 'i4',
+    'vtktypeint8': 'i1', 'vtktypeuint8': 'u1',
+    'vtktypeint16': 'i2', 'vtktypeuint16': 'u2',
+    'vtktypeint32': 'i4', 'vtktypeuint32': 'u4',
+    'vtktypeint64': 'i8', 'vtktypeuint64': 'u8',
+    'vtktypefloat32': 'f4', 'vtktypefloat64': 'f8',
+}
+
+ATTRIBUTE_COMPONENTS = {
+    'VECTORS': 3, 'NORMALS': 3, 'TENSORS': 9, 'TENSORS6': 6
+}
+
+ACTIVE_ATTRIBUTES = (
+    ('ActiveScalars', 'SCALARS', None),
+    ('ActiveVectors', 'VECTORS', 3),
+    ('ActiveTensors', 'TENSORS', 9),
+)
+
+_token = re.compile(r'\S+')
+_escaped_character = re.compile(r'%([0-9A-Fa-f]{2})')
+_character_to_escape = re.compile(r'[\s%"]')
+
+
+def tractography_from_vtk_legacy_file(filename, indices=None):
+    if indices is None:
+        tracts, tracts_data = read_vtk_legacy(filename, lazy=True)
+    else:
+        tracts, tracts_data = read_vtk_legacy_tracts(filename, indices)
+    return Tractography(tracts, tracts_data, validate='fast')
+
+
+def tractography_to_vtk_legacy_file(filename, tractography):
+    return write_vtk_legacy(
+        filename,
+        tractography.tracts(),
+        tractography.tracts_data()
+    )
+
+
+class _LegacyVTKBuffer(object):
+
+    r"""
+    Sequential access to the contents of a legacy VTK file, header
+    lines are read as text and arrays are decoded in bulk. The position
+    of the last array read is kept in array_position.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.position = 0
+        self.binary = False
+        self.array_position = None
+
+    def readline(self, skip_blank=True):
+        if skip_blank:
+            while (
+                self.position < len(self.buffer) and
+                self.buffer[self.position].isspace()
+            ):
+                self.position += 1
+        if self.position >= len(self.buffer):
+            return None
+        end = self.buffer.find('\n', self.position)
+        if end < 0:
+            end = len(self.buffer)
+        line = self.buffer[self.position:end].strip()
+        self.position = end + 1
+        return line
+
+    def peek(self, prefix):
+        position = self.position
+        while (
+            position < len(self.buffer) and
+            self.buffer[position].isspace()
+        ):
+            position += 1
+        return self.buffer.startswith(prefix, position)
+
+    def read_array(self, count, vtk_type, decode=True):
+        vtk_type = vtk_type.lower()
+        if vtk_type not in VTK_TYPES:
+            raise IOError('VTK data type %s not supported' % vtk_type)
+
+        self.array_position = self.position
+        if self.binary and not decode and vtk_type != 'bit':
+            # Binary arrays can be skipped, and read later from the file
+            nbytes = count * np.dtype(VTK_TYPES[vtk_type]).itemsize
+            if self.position + nbytes > len(self.buffer):
+                raise IOError('Unexpected end of the VTK file')
+            self.position += nbytes
+            return None
+
+        if self.binary:
+            if vtk_type == 'bit':
+                nbytes = (count + 7) // 8
+                array = np.unpackbits(np.frombuffer(
+                    self.buffer, dtype=np.uint8,
+                    count=nbytes, offset=self.position
+                ))[:count]
+            else:
+                dtype = np.dtype('>' + VTK_TYPES[vtk_type])
+                nbytes = count * dtype.itemsize
+                if self.position + nbytes > len(self.buffer):
+                    raise IOError('Unexpected end of the VTK file')
+                array = np.frombuffer(
+                    self.buffer, dtype=dtype,
+                    count=count, offset=self.position
+                ).astype(dtype.newbyteorder('='))
+            self.position += nbytes
+        else:
+            matches = list(
+                islice(_token.finditer(self.buffer, self.position), count)
+            )
+            if len(matches) < count:
+                raise IOError('Unexpected end of the VTK file')
+            if count > 0:
+                self.position = matches[-1].end()
+            array = np.array(
+                [match.group() for match in matches], dtype=float
+            ).astype(VTK_TYPES[vtk_type])
+
+        return array
+
+
+def _unescape_name(name):
+    return _escaped_character.sub(lambda m: chr(int(m.group(1), 16)), name)
+
+
+def _escape_name(name):
+    return _character_to_escape.sub(lambda m: '%%%02X' % ord(m.group()), name)
+
+
+def _read_cells(vtk_buffer, number_of_cells, size):
+    if vtk_buffer.peek('OFFSETS'):
+        offsets_type = vtk_buffer.readline().split()[1]
+        offsets = vtk_buffer.read_array(number_of_cells, offsets_type)
+        connectivity_type = vtk_buffer.readline().split()[1]
+        connectivity = vtk_buffer.read_array(size, connectivity_type)
+        return offsets.astype(int), connectivity
+
+    cell_array = vtk_buffer.read_array(size, 'int')
+    try:
+        return cell_array_to_offsets(cell_array, number_of_cells)
+    except ValueError:
+        raise IOError('Lines in the VTK file are inconsistent')
+
+
+def _read_attribute(vtk_buffer, keyword, arguments, number_of_items, decode=True):
+    if keyword == 'SCALARS':
+        name, vtk_type = arguments[:2]
+        number_of_components = int(arguments[2]) if len(arguments) > 2 else 1
+        if vtk_buffer.peek('LOOKUP_TABLE'):
+            vtk_buffer.readline()
+    elif keyword == 'COLOR_SCALARS':
+        name = arguments[0]
+        number_of_components = int(arguments[1])
+        vtk_type = 'unsigned_char' if vtk_buffer.binary else 'float'
+    elif keyword == 'TEXTURE_COORDINATES':
+        name = arguments[0]
+        number_of_components = int(arguments[1])
+        vtk_type = arguments[2]
+    else:
+        name, vtk_type = arguments[:2]
+        number_of_components = ATTRIBUTE_COMPONENTS[keyword]
+
+    array = vtk_buffer.read_array(
+        number_of_items * number_of_components, vtk_type, decode=decode
+    )
+    if array is not None:
+        array = array.reshape(number_of_items, number_of_components)
+    layout = (vtk_buffer.array_position, vtk_type, number_of_components)
+
+    return _unescape_name(name), array, layout
+
+
+def _read_field(vtk_buffer, number_of_arrays, decode=True):
+    arrays = []
+    for _ in xrange(number_of_arrays):
+        line = vtk_buffer.readline().split()
+        if line[0] == 'NULL_ARRAY':
+            continue
+        name = _unescape_name(line[0])
+        number_of_components, number_of_tuples = int(line[1]), int(line[2])
+        array = vtk_buffer.read_array(
+            number_of_components * number_of_tuples, line[3], decode=decode
+        )
+        if array is not None:
+            array = array.reshape(number_of_tuples, number_of_components)
+        layout = (vtk_buffer.array_position, line[3], number_of_components)
+        arrays.append((name, array, layout))
+        if vtk_buffer.peek('METADATA'):
+            vtk_buffer.readline()
+            _skip_metadata(vtk_buffer)
+    return arrays
+
+
+def _skip_metadata(vtk_buffer):
+    line = vtk_buffer.readline(skip_blank=False)
+    while line:
+        line = vtk_buffer.readline(skip_blank=False)
+
+
+def _read_polydata(filename, lazy=False):
+    r'''
+    Points, lines and point data arrays of a legacy VTK PolyData file.
+    If lazy, the point data arrays of binary files are not decoded and
+    set to None.
+
+    Returns
+    -------
+    points : array of Nx3
+    offsets : array of int of length T + 1
+    connectivity : array of int
+    point_data : dict of <data name>= array of NxM or str
+    layout : dict of <data name>= (int, str, int)
+        Position in the file, VTK type and number of components of
+        the points, under None, and of the point data arrays
+    binary : bool
+    '''
+    with open(filename, 'rb') as file_:
+        vtk_buffer = _LegacyVTKBuffer(file_.read())
+
+    version = vtk_buffer.readline()
+    if version is None or not version.lower().startswith('# vtk datafile'):
+        raise IOError('File %s is not a legacy VTK file' % filename)
+    vtk_buffer.readline(skip_blank=False)
+    vtk_buffer.binary = vtk_buffer.readline().upper() == 'BINARY'
+    dataset = vtk_buffer.readline().split()
+    if len(dataset) != 2 or dataset[1].upper() != 'POLYDATA':
+        raise IOError('File %s does not contain PolyData' % filename)
+
+    points = np.empty((0, 3))
+    offsets = np.zeros(1, dtype=int)
+    connectivity = np.empty(0, dtype=int)
+    point_data = {}
+    layout = {}
+    data_section = None
+    number_of_items = 0
+
+    line = vtk_buffer.readline()
+    while line is not None:
+        if not line:
+            line = vtk_buffer.readline()
+            continue
+        words = line.split()
+        keyword = words[0].upper()
+        if keyword == 'POINTS':
+            number_of_points = int(words[1])
+            points = vtk_buffer.read_array(
+                number_of_points * 3, words[2]
+            ).reshape(number_of_points, 3)
+            layout[None] = (vtk_buffer.array_position, words[2], 3)
+        elif keyword in ('LINES', 'VERTICES', 'POLYGONS', 'TRIANGLE_STRIPS'):
+            cells = _read_cells(vtk_buffer, int(words[1]), int(words[2]))
+            if keyword == 'LINES':
+                offsets, connectivity = cells
+        elif keyword in ('POINT_DATA', 'CELL_DATA'):
+            data_section = keyword
+            number_of_items = int(words[1])
+        elif keyword == 'METADATA':
+            _skip_metadata(vtk_buffer)
+        elif keyword == 'FIELD':
+            arrays = _read_field(vtk_buffer, int(words[2]), decode=not lazy)
+            if data_section == 'POINT_DATA':
+                for name, array, array_layout in arrays:
+                    point_data[name] = array
+                    layout[name] = array_layout
+        elif keyword == 'LOOKUP_TABLE':
+            number_of_colors = int(words[2])
+            if vtk_buffer.binary:
+                vtk_buffer.read_array(number_of_colors * 4, 'unsigned_char')
+            else:
+                vtk_buffer.read_array(number_of_colors * 4, 'float')
+        elif keyword in (
+            'SCALARS', 'COLOR_SCALARS', 'VECTORS', 'NORMALS',
+            'TENSORS', 'TENSORS6', 'TEXTURE_COORDINATES'
+        ) and data_section is not None:
+            name, array, array_layout = _read_attribute(
+                vtk_buffer, keyword, words[1:], number_of_items,
+                decode=not lazy
+            )
+            if data_section == 'POINT_DATA':
+                point_data[name] = array
+                layout[name] = array_layout
+                for active_key, active_keyword, _ in ACTIVE_ATTRIBUTES:
+                    if keyword == active_keyword:
+                        point_data[active_key] = name
+        else:
+            raise IOError('VTK keyword %s not supported' % words[0])
+        line = vtk_buffer.readline()
+
+    return (
+        points, offsets, connectivity, point_data, layout, vtk_buffer.binary
+    )
+
+
+def read_vtk_legacy(filename, lazy=False):
+    r'''
+    Reads a legacy VTK PolyData file, ASCII or binary, and outputs a
+    tracts/tracts_data pair. Only numpy is needed.
+
+    Parameters
+    ----------
+    filename : str
+        VTK PolyData filename
+    lazy : bool
+        Return the tract data as a LazyTractsData, the point data of
+        binary files is then read from the file on its first access
+
+    Returns
+    -------
+    tracts : list of float array N_ix3
+        Each element of the list is a tract represented as point array,
+        the length of the i-th tract is N_i
+    tract_data : dict of <data name>= list of float array of N_ixM
+        Each element in the list corresponds to a tract,
+        N_i is the length of the i-th tract and M is the
+        number of components of that data type.
+    '''
+    points, offsets, connectivity, point_data, layout, _ = _read_polydata(
+        filename, lazy=lazy
+    )
+    lazy_fields = [
+        name for name, value in point_data.iteritems() if value is None
+    ]
+    for name in lazy_fields:
+        del point_data[name]
+
+    try:
+        tracts, tracts_data = lines_to_tracts(
+            points, offsets, connectivity, point_data
+        )
+    except ValueError:
+        raise IOError('Lines in the VTK file refer to non-existent points')
+
+    if not lazy:
+        return tracts, tracts_data
+
+    tracts_data = LazyTractsData(offsets, tracts_data)
+    if len(connectivity) > 0 and np.array_equal(
+        connectivity - connectivity[0], np.arange(len(connectivity))
+    ):
+        selection = slice(connectivity[0], connectivity[0] + len(connectivity))
+    else:
+        selection = connectivity
+    for name in lazy_fields:
+        tracts_data.add_field(name, partial(
+            _read_point_data, filename, layout[name], len(points), selection
+        ))
+    return tracts, tracts_data
+
+
+def _read_point_data(filename, layout, number_of_points, selection):
+    r'''
+    Point data array of a binary legacy VTK file, packed along
+    the lines
+    '''
+    position, vtk_type, number_of_components = layout
+    dtype = np.dtype('>' + VTK_TYPES[vtk_type.lower()])
+    count = number_of_points * number_of_components
+    with open(filename, 'rb') as file_:
+        file_.seek(position)
+        buffer = file_.read(count * dtype.itemsize)
+    if len(buffer) != count * dtype.itemsize:
+        raise IOError('Unexpected end of the VTK file')
+    array = np.frombuffer(buffer, dtype=dtype).astype(dtype.newbyteorder('='))
+    return array.reshape(number_of_points, number_of_components)[selection]
+
+
+def build_vtk_legacy_offset_index(filename):
+    r'''
+    Scans a legacy VTK PolyData file for the position of its tracts
+
+    Random access is only possible in binary files where every line
+    uses consecutive point ids, otherwise the index flags that the
+    whole file has to be read.
+
+    Parameters
+    ----------
+    filename : str
+        VTK PolyData filename
+
+    Returns
+    -------
+    index : dict of <key>=array
+        first_points holds the first point id of each tract and counts
+        their number of points, names, positions, types and components
+        describe the arrays of the file, the points being the first one
+    '''
+    points, offsets, connectivity, point_data, layout, binary = (
+        _read_polydata(filename, lazy=True)
+    )
+    lengths = np.diff(offsets)
+    if len(lengths) > 0:
+        first_points = _contiguous_line_starts(offsets, connectivity)
+    else:
+        first_points = np.empty(0, dtype=int)
+    names = [None] + sorted(
+        name for name, value in point_data.iteritems()
+        if not isinstance(value, str)
+    )
+    random_access = (
+        binary and first_points is not None and
+        None in layout and
+        all(layout[name][1].lower() != 'bit' for name in names) and
+        (len(lengths) == 0 or (first_points + lengths).max() <= len(points))
+    )
+    if not random_access:
+        return {'random_access': np.array(False)}
+
+    active = sorted(
+        (key, value) for key, value in point_data.iteritems()
+        if isinstance(value, str)
+    )
+    return {
+        'random_access': np.array(True),
+        'first_points': first_points,
+        'counts': lengths,
+        'names': np.array([name or '' for name in names]),
+        'positions': np.array([layout[name][0] for name in names]),
+        'types': np.array([layout[name][1].lower() for name in names]),
+        'components': np.array([layout[name][2] for name in names]),
+        'active_keys': np.array([key for key, _ in active], dtype=str),
+        'active_names': np.array([value for _, value in active], dtype=str),
+    }
+
+
+def read_vtk_legacy_tracts(filename, indices):
+    r'''
+    Reads some of the tracts of a legacy VTK PolyData file, and their
+    data, through the offset index of the file. Only the requested
+    tracts are read, adjacent ones at once.
+
+    Parameters
+    ----------
+    filename : str
+        VTK PolyData filename
+    indices : array of int
+        Indices of the tracts to read
+
+    Returns
+    -------
+    tracts : list of float array N_ix3
+        The requested tracts in the order of indices
+    tract_data : dict of <data name>= list of float array of N_ixM
+        Each element in the list corresponds to a tract,
+        N_i is the length of the i-th tract and M is the
+        number of components of that data type.
+    '''
+    index = load_offset_index(filename, build_vtk_legacy_offset_index)
+    indices = np.asarray(indices, dtype=int).ravel()
+    if not index['random_access']:
+        tracts, tracts_data = read_vtk_legacy(filename)
+        indices = indices.tolist()
+        return [tracts[i] for i in indices], dict(
+            (name, value if isinstance(value, str) else [value[i] for i in indices])
+            for name, value in tracts_data.iteritems()
+        )
+
+    number_of_tracts = len(index['counts'])
+    if len(indices) > 0 and (
+        indices.min() < -number_of_tracts or indices.max() >= number_of_tracts
+    ):
+        raise IndexError('Tract indices out of range')
+
+    first_points = index['first_points'][indices]
+    counts = index['counts'][indices]
+    offsets = lengths_to_offsets(counts)
+    arrays = []
+    with open(filename, 'rb') as file_:
+        for name, position, vtk_type, number_of_components in zip(
+            index['names'], index['positions'],
+            index['types'], index['components']
+        ):
+            dtype = np.dtype('>' + VTK_TYPES[str(vtk_type)])
+            row_size = int(number_of_components) * dtype.itemsize
+            chunks = read_ranges(
+                file_, position + first_points * row_size, counts * row_size
+            )
+            array = np.frombuffer(''.join(chunks), dtype=dtype).astype(
+                dtype.newbyteorder('=')
+            ).reshape(-1, number_of_components)
+            arrays.append((str(name), split_packed(array, offsets)))
+
+    tracts = arrays[0][1]
+    tracts_data = dict(arrays[1:])
+    tracts_data.update(zip(
+        [str(key) for key in index['active_keys']],
+        [str(name) for name in index['active_names']]
+    ))
+    return tracts, tracts_data
+
+
+def _write_array(file_, array, dtype):
+    np.ascontiguousarray(array, dtype=dtype).tofile(file_)
+    file_.write('\n')
+
+
+def _stack_data(tracts_data, name, number_of_tracts, number_of_points):
+    if (
+        isinstance(tracts_data, LazyTractsData) and
+        not tracts_data.is_loaded(name)
+    ):
+        # Fields which were not accessed are read as they are stored
+        value = packed_tracts_data(tracts_data, name)
+        if len(value) != number_of_points:
+            raise ValueError(
+                "Data in %s does not have the correct number of items" % name
+            )
+        return value.reshape(number_of_points, -1)
+
+    value = tracts_data[name]
+    if len(value) == number_of_tracts and number_of_tracts > 0:
+        value = pack(value)[0]
+    elif len(value) == number_of_points:
+        value = np.asarray(value)
+    else:
+        raise ValueError(
+            "Data in %s does not have the correct number of items" % name
+        )
+    return value.reshape(number_of_points, -1)
+
+
+def point_data_arrays(tracts_data, number_of_tracts, number_of_points):
+    r'''
+    Point data arrays of a PolyData from tract data
+
+    Returns
+    -------
+    active_arrays : dict of <data name>= (attribute, array of N x M)
+        Data set as the active SCALARS, VECTORS or TENSORS
+    field_arrays : list of (<data name>, array of N x M)
+        Rest of the data
+    '''
+    active_arrays = {}
+    for active_key, keyword, number_of_components in ACTIVE_ATTRIBUTES:
+        name = tracts_data.get(active_key, None)
+        if name is None and active_key.replace('Active', '') + '_' in tracts_data:
+            name = active_key.replace('Active', '') + '_'
+        if not isinstance(name, str) or name not in tracts_data:
+            continue
+        array = _stack_data(
+            tracts_data, name, number_of_tracts, number_of_points
+        )
+        if (
+            number_of_components is not None and
+            array.shape[1] != number_of_components
+        ):
+            continue
+        if keyword == 'SCALARS' and array.shape[1] > 4:
+            continue
+        active_arrays[name] = (keyword, array)
+
+    field_arrays = []
+    for name in sorted(array_fields(tracts_data)):
+        if name in active_arrays:
+            continue
+        field_arrays.append((
+            name,
+            _stack_data(tracts_data, name, number_of_tracts, number_of_points)
+        ))
+
+    return active_arrays, field_arrays
+
+
+def write_vtk_legacy(filename, tracts, tracts_data={}):
+    r'''
+    Writes tracts and their data as a binary legacy VTK PolyData file.
+    Points are stored as double, unless they are float32, and point
+    data as float, as the writer in the VTK library does.
+
+    Parameters
+    ----------
+    filename : str
+        VTK PolyData filename
+    tracts : list of float array N_ix3
+        Each element of the list is a tract represented as point array,
+        the length of the i-th tract is N_i
+    tract_data : dict of <data name>= list of float array of N_ixM
+        Each element in the list corresponds to a tract,
+        N_i is the length of the i-th tract and M is the
+        number of components of that data type.
+    '''
+    number_of_tracts = len(tracts)
+    points, offsets = pack(tracts)
+    points = points.reshape(-1, 3)
+    number_of_points = len(points)
+
+    cell_array = offsets_to_cell_array(offsets, dtype='>i4')
+
+    active_arrays, field_arrays = point_data_arrays(
+        tracts_data, number_of_tracts, number_of_points
+    )
+
+    with open(filename, 'wb') as file_:
+        file_.write(
+            '# vtk DataFile Version 3.0\n'
+            'vtk output\n'
+            'BINARY\n'
+            'DATASET POLYDATA\n'
+        )
+        if points.dtype == np.float32:
+            file_.write('POINTS %d float\n' % number_of_points)
+            _write_array(file_, points, '>f4')
+        else:
+            file_.write('POINTS %d double\n' % number_of_points)
+            _write_array(file_, points, '>f8')
+        file_.write('LINES %d %d\n' % (number_of_tracts, len(cell_array)))
+        _write_array(file_, cell_array, '>i4')
+
+        if len(active_arrays) == 0 and len(field_arrays) == 0:
+            return
+
+        file_.write('POINT_DATA %d\n' % number_of_points)
+        for name, (keyword, array) in active_arrays.iteritems():
+            if keyword == 'SCALARS':
+                file_.write('SCALARS %s float %d\nLOOKUP_TABLE default\n' % (
+                    _escape_name(name), array.shape[1]
+                ))
+            else:
+                file_.write('%s %s float\n' % (keyword, _escape_name(name)))
+            _write_array(file_, array, '>f4')
+
+        if len(field_arrays) == 0:
+            return
+
+        file_.write('FIELD FieldData %d\n' % len(field_arrays))
+        for name, array in field_arrays:
+            file_.write('%s %d %d float\n' % (
+                _escape_name(name), array.shape[1], number_of_points
+            ))
+            _write_array(file_, array, '>f4')
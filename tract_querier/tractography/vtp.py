@@ -0,0 +1,444 @@
+import base64
+import zlib
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from xml.etree import cElementTree as ElementTree
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+from .tractography import Tractography, LazyTractsData
+from .packed import lines_to_tracts, pack
+from .vtk_legacy import ACTIVE_ATTRIBUTES, point_data_arrays
+
+__all__ = [
+    'tractography_from_vtp_file', 'tractography_to_vtp_file',
+    'read_vtp', 'write_vtp'
+]
+
+VTP_TYPES = {
+    'Int8': 'i1', 'UInt8': 'u1',
+    'Int16': 'i2', 'UInt16': 'u2',
+    'Int32': 'i4', 'UInt32': 'u4',
+    'Int64': 'i8', 'UInt64': 'u8',
+    'Float32': 'f4', 'Float64': 'f8',
+}
+
+BYTE_ORDERS = {'LittleEndian': '<', 'BigEndian': '>'}
+
+ACTIVE_ATTRIBUTE_NAMES = {
+    'ActiveScalars': 'Scalars',
+    'ActiveVectors': 'Vectors',
+    'ActiveTensors': 'Tensors',
+}
+
+DEFAULT_BLOCK_SIZE = 1 << 16
+
+
+def tractography_from_vtp_file(filename):
+    tracts, tracts_data = read_vtp(filename, lazy=True)
+    return Tractography(tracts, tracts_data, validate='fast')
+
+
+def tractography_to_vtp_file(filename, tractography, **kwargs):
+    return write_vtp(
+        filename,
+        tractography.tracts(),
+        tractography.tracts_data(),
+        **kwargs
+    )
+
+
+def _map_blocks(function, blocks):
+    r"""
+    Apply function to every block, in a thread pool if there is more than
+    one block. zlib releases the GIL so blocks are processed in parallel.
+    """
+    if len(blocks) < 2:
+        return [function(block) for block in blocks]
+
+    pool = ThreadPool(min(cpu_count(), len(blocks)))
+    try:
+        return pool.map(function, blocks)
+    finally:
+        pool.close()
+
+
+def _base64_length(number_of_bytes):
+    return (number_of_bytes + 2) // 3 * 4
+
+
+class _VTPData(object):
+
+    r"""
+    Decoding of the data arrays of a VTK XML file according to the
+    byte order, header type and compression specified in its root element
+    """
+
+    def __init__(self, root, appended_data, appended_encoding):
+        byte_order = BYTE_ORDERS[root.get('byte_order', 'LittleEndian')]
+        self.byte_order = byte_order
+        self.header_dtype = np.dtype(
+            byte_order + VTP_TYPES[root.get('header_type', 'UInt32')]
+        )
+
+        compressor = root.get('compressor', None)
+        if compressor not in (None, '', 'vtkZLibDataCompressor'):
+            raise IOError('VTP compressor %s not supported' % compressor)
+        self.compressed = compressor == 'vtkZLibDataCompressor'
+
+        self.appended_data = appended_data
+        self.appended_encoding = appended_encoding
+
+    def _header(self, data, position, count, encoded):
+        header_size = self.header_dtype.itemsize
+        if encoded:
+            length = _base64_length(count * header_size)
+            header = base64.b64decode(str(data[position: position + length]))
+            return np.frombuffer(header, self.header_dtype, count), length
+        else:
+            header = np.frombuffer(
+                data, self.header_dtype, count, offset=position
+            )
+            return header, count * header_size
+
+    def decode(self, data, position, encoded):
+        if self.compressed:
+            # The compression header and the compressed blocks are
+            # encoded separately
+            number_of_blocks, _ = self._header(data, position, 1, encoded)
+            number_of_blocks = int(number_of_blocks[0])
+            header, length = self._header(
+                data, position, 3 + number_of_blocks, encoded
+            )
+            position += length
+
+            compressed_sizes = header[3:].astype(int)
+            if encoded:
+                data = base64.b64decode(str(data[
+                    position: position +
+                    _base64_length(compressed_sizes.sum())
+                ]))
+                position = 0
+            bounds = position + np.r_[0, np.cumsum(compressed_sizes)]
+            blocks = [
+                data[bounds[i]: bounds[i + 1]]
+                for i in xrange(number_of_blocks)
+            ]
+            return ''.join(_map_blocks(
+                lambda block: zlib.decompress(str(block)), blocks
+            ))
+        else:
+            # The size header and the data are encoded together
+            header_size = self.header_dtype.itemsize
+            if encoded:
+                number_of_bytes, _ = self._header(data, position, 1, encoded)
+                number_of_bytes = int(number_of_bytes[0])
+                block = base64.b64decode(str(data[
+                    position: position +
+                    _base64_length(header_size + number_of_bytes)
+                ]))
+                return block[header_size: header_size + number_of_bytes]
+            else:
+                number_of_bytes, _ = self._header(data, position, 1, encoded)
+                position += header_size
+                return data[position: position + int(number_of_bytes[0])]
+
+    def read_array(self, element):
+        dtype = np.dtype(self.byte_order + VTP_TYPES[element.get('type')])
+        number_of_components = int(element.get('NumberOfComponents', 1))
+        data_format = element.get('format', 'ascii')
+
+        if data_format == 'ascii':
+            array = np.array((element.text or '').split(), dtype=float)
+        else:
+            if data_format == 'binary':
+                data = (element.text or '').strip()
+                buffer = self.decode(data, 0, True)
+            elif data_format == 'appended':
+                buffer = self.decode(
+                    self.appended_data, int(element.get('offset')),
+                    self.appended_encoding == 'base64'
+                )
+            else:
+                raise IOError('VTP data format %s not supported' % data_format)
+            array = np.frombuffer(buffer, dtype=dtype)
+
+        array = array.astype(dtype.newbyteorder('='))
+        return array.reshape(-1, number_of_components)
+
+    def read_point_data(self, element, selection):
+        r"""
+        Point data array of the points of the lines, in their order
+        """
+        return self.read_array(element)[selection]
+
+
+def read_vtp(filename, lazy=False):
+    r'''
+    Reads a VTK XML PolyData file and outputs a tracts/tracts_data pair.
+    Only numpy is needed, data arrays can be ascii, inline binary or
+    appended, raw or base64 encoded and zlib compressed.
+
+    Parameters
+    ----------
+    filename : str
+        VTK XML PolyData filename
+    lazy : bool
+        Return the tract data as a LazyTractsData, the binary and
+        appended point data arrays are then decoded on their first
+        access
+
+    Returns
+    -------
+    tracts : list of float array N_ix3
+        Each element of the list is a tract represented as point array,
+        the length of the i-th tract is N_i
+    tract_data : dict of <data name>= list of float array of N_ixM
+        Each element in the list corresponds to a tract,
+        N_i is the length of the i-th tract and M is the
+        number of components of that data type.
+    '''
+    with open(filename, 'rb') as file_:
+        buffer = file_.read()
+
+    appended_start = buffer.find('<AppendedData')
+    if appended_start >= 0:
+        appended_tag_end = buffer.find('>', appended_start)
+        appended_tag = ElementTree.fromstring(
+            buffer[appended_start: appended_tag_end] + '/>'
+        )
+        appended_encoding = appended_tag.get('encoding', 'raw')
+        appended_data_start = buffer.find('_', appended_tag_end) + 1
+        root = ElementTree.fromstring(
+            buffer[:appended_start] + '</VTKFile>'
+        )
+        appended_data = buffer[appended_data_start:]
+    else:
+        root = ElementTree.fromstring(buffer)
+        appended_encoding = None
+        appended_data = None
+
+    if root.get('type') != 'PolyData':
+        raise IOError('File %s does not contain PolyData' % filename)
+
+    vtp_data = _VTPData(root, appended_data, appended_encoding)
+
+    pieces = root.findall('PolyData/Piece')
+    if len(pieces) != 1:
+        raise IOError('Only VTP files with one piece are supported')
+    piece = pieces[0]
+
+    points_element = piece.find('Points/DataArray')
+    if points_element is not None:
+        points = vtp_data.read_array(points_element)
+    else:
+        points = np.empty((0, 3))
+
+    offsets = np.zeros(1, dtype=int)
+    connectivity = np.empty(0, dtype=int)
+    lines = piece.find('Lines')
+    if lines is not None and int(piece.get('NumberOfLines', 0)) > 0:
+        for data_array in lines.findall('DataArray'):
+            if data_array.get('Name') == 'connectivity':
+                connectivity = vtp_data.read_array(data_array).ravel()
+            elif data_array.get('Name') == 'offsets':
+                offsets = np.r_[0, vtp_data.read_array(data_array).ravel()]
+
+    point_data = {}
+    lazy_fields = {}
+    point_data_element = piece.find('PointData')
+    if point_data_element is not None:
+        for data_array in point_data_element.findall('DataArray'):
+            name = data_array.get('Name')
+            if lazy and data_array.get('format', 'ascii') != 'ascii':
+                lazy_fields[name] = data_array
+                continue
+            point_data[name] = vtp_data.read_array(data_array)
+        for active_key, attribute in ACTIVE_ATTRIBUTE_NAMES.iteritems():
+            name = point_data_element.get(attribute, None)
+            if name is not None and (name in point_data or name in lazy_fields):
+                point_data[active_key] = name
+
+    try:
+        tracts, tracts_data = lines_to_tracts(
+            points, offsets, connectivity, point_data
+        )
+    except ValueError:
+        raise IOError('Lines in the VTP file refer to non-existent points')
+
+    if not lazy:
+        return tracts, tracts_data
+
+    tracts_data = LazyTractsData(offsets, tracts_data)
+    if len(connectivity) > 0 and np.array_equal(
+        connectivity - connectivity[0], np.arange(len(connectivity))
+    ):
+        selection = slice(connectivity[0], connectivity[0] + len(connectivity))
+    else:
+        selection = connectivity
+    for name, data_array in lazy_fields.iteritems():
+        tracts_data.add_field(name, partial(
+            vtp_data.read_point_data, data_array, selection
+        ))
+    return tracts, tracts_data
+
+
+def _data_array_tag(vtp_type, name, number_of_components, offset):
+    return (
+        '<DataArray type="%s" Name=%s NumberOfComponents="%d" '
+        'format="appended" offset="%d"/>' % (
+            vtp_type, quoteattr(name), number_of_components, offset
+        )
+    )
+
+
+def write_vtp(
+    filename, tracts, tracts_data={},
+    compress=True, block_size=DEFAULT_BLOCK_SIZE
+):
+    r'''
+    Writes tracts and their data as a VTK XML PolyData file with the
+    data arrays appended as raw binary. Points are stored as Float64,
+    unless they are float32, and point data as Float32, as the writer
+    in the VTK library does.
+
+    Parameters
+    ----------
+    filename : str
+        VTK XML PolyData filename
+    tracts : list of float array N_ix3
+        Each element of the list is a tract represented as point array,
+        the length of the i-th tract is N_i
+    tract_data : dict of <data name>= list of float array of N_ixM
+        Each element in the list corresponds to a tract,
+        N_i is the length of the i-th tract and M is the
+        number of components of that data type.
+    compress : bool
+        Compress the data arrays with zlib, the blocks of every array
+        are compressed in parallel
+    block_size : int
+        Size in bytes of the compressed blocks
+    '''
+    number_of_tracts = len(tracts)
+    points, offsets = pack(tracts)
+    points = points.reshape(-1, 3)
+    number_of_points = len(points)
+    if points.dtype == np.float32:
+        points_type, points_dtype = 'Float32', '<f4'
+    else:
+        points_type, points_dtype = 'Float64', '<f8'
+
+    active_arrays, field_arrays = point_data_arrays(
+        tracts_data, number_of_tracts, number_of_points
+    )
+
+    point_data_attributes = ''
+    for active_key, keyword, _ in ACTIVE_ATTRIBUTES:
+        for name, (array_keyword, _) in active_arrays.iteritems():
+            if array_keyword == keyword:
+                point_data_attributes += ' %s=%s' % (
+                    ACTIVE_ATTRIBUTE_NAMES[active_key], quoteattr(name)
+                )
+
+    point_data = (
+        [(name, array) for name, (_, array) in active_arrays.iteritems()] +
+        field_arrays
+    )
+
+    arrays = (
+        [
+            ('PointData', 'Float32', name, array, '<f4')
+            for name, array in point_data
+        ] + [
+            ('Points', points_type, 'Points', points, points_dtype),
+            (
+                'Lines', 'Int64', 'connectivity',
+                np.arange(number_of_points)[:, None], '<i8'
+            ),
+            ('Lines', 'Int64', 'offsets', offsets[1:, None], '<i8'),
+        ]
+    )
+
+    header_dtype = np.dtype('<u8')
+    raw_blocks = []
+    array_blocks = []
+    for _, _, _, array, dtype in arrays:
+        data = np.ascontiguousarray(array, dtype=dtype).tostring()
+        if compress:
+            blocks = [
+                data[i: i + block_size]
+                for i in xrange(0, len(data), block_size)
+            ]
+        else:
+            blocks = [data]
+        array_blocks.append((len(raw_blocks), len(blocks), len(data)))
+        raw_blocks += blocks
+
+    if compress:
+        encoded_blocks = _map_blocks(zlib.compress, raw_blocks)
+    else:
+        encoded_blocks = raw_blocks
+
+    encoded_arrays = []
+    for first_block, number_of_blocks, number_of_bytes in array_blocks:
+        blocks = encoded_blocks[first_block: first_block + number_of_blocks]
+        if compress:
+            if number_of_blocks > 0:
+                last_block_size = number_of_bytes - block_size * (number_of_blocks - 1)
+            else:
+                last_block_size = 0
+            header = np.r_[
+                number_of_blocks, block_size, last_block_size,
+                [len(block) for block in blocks]
+            ]
+        else:
+            header = np.r_[number_of_bytes]
+        encoded_arrays.append(
+            [header.astype(header_dtype).tostring()] + blocks
+        )
+
+    sections = {'PointData': [], 'Points': [], 'Lines': []}
+    offset = 0
+    for (section, vtp_type, name, array, _), encoded in zip(arrays, encoded_arrays):
+        sections[section].append(_data_array_tag(
+            vtp_type, name, array.shape[1], offset
+        ))
+        offset += sum(len(block) for block in encoded)
+
+    if compress:
+        compressor = ' compressor="vtkZLibDataCompressor"'
+    else:
+        compressor = ''
+
+    with open(filename, 'wb') as file_:
+        file_.write(
+            '<?xml version="1.0"?>\n'
+            '<VTKFile type="PolyData" version="1.0" byte_order="LittleEndian" '
+            'header_type="UInt64"%s>\n' % compressor
+        )
+        file_.write('  <PolyData>\n')
+        file_.write(
+            '    <Piece NumberOfPoints="%d" NumberOfVerts="0" '
+            'NumberOfLines="%d" NumberOfStrips="0" NumberOfPolys="0">\n' % (
+                number_of_points, number_of_tracts
+            )
+        )
+        for section, attributes in (
+            ('PointData', point_data_attributes),
+            ('Points', ''),
+            ('Lines', '')
+        ):
+            file_.write('      <%s%s>\n' % (section, attributes))
+            for tag in sections[section]:
+                file_.write('        %s\n' % tag)
+            file_.write('      </%s>\n' % section)
+        file_.write('    </Piece>\n')
+        file_.write('  </PolyData>\n')
+        file_.write('  <AppendedData encoding="raw">\n   _')
+        for encoded in encoded_arrays:
+            for block in encoded:
+                file_.write(block)
+        file_.write('\n  </AppendedData>\n')
+        file_.write('</VTKFile>\n')